@@ -52,6 +52,31 @@ def clean_workflow_library(library_path='./data/workflow_library', confirm=True)
     if os.path.exists(mapping_file):
         items_to_delete.append(f"  - embeddings.faiss.mapping.json")
     
+    # 4.0 向量索引二进制ID映射
+    ids_file = os.path.join(library_path, 'embeddings.faiss.ids.npy')
+    if os.path.exists(ids_file):
+        items_to_delete.append(f"  - embeddings.faiss.ids.npy")
+    
+    # 4.1 向量索引追加日志
+    delta_file = os.path.join(library_path, 'embeddings.faiss.delta')
+    if os.path.exists(delta_file):
+        items_to_delete.append(f"  - embeddings.faiss.delta")
+    
+    # 4.2 单文件工作流存储（含SQLite的WAL/SHM文件）
+    store_files = [
+        os.path.join(library_path, name)
+        for name in ('library.sqlite', 'library.sqlite-wal', 'library.sqlite-shm')
+        if os.path.exists(os.path.join(library_path, name))
+    ]
+    if store_files:
+        items_to_delete.append(f"  - library.sqlite")
+    
+    # 4.3 意图embedding矩阵
+    embedding_matrix_file = os.path.join(library_path, 'intent_embeddings.f32')
+    if os.path.exists(embedding_matrix_file):
+        size_mb = os.path.getsize(embedding_matrix_file) / 1024 / 1024
+        items_to_delete.append(f"  - intent_embeddings.f32 ({size_mb:.2f} MB)")
+    
     # 5. 节点元数据
     node_meta_file = os.path.join(library_path, 'node_meta.json')
     if os.path.exists(node_meta_file):
@@ -124,6 +149,31 @@ def clean_workflow_library(library_path='./data/workflow_library', confirm=True)
         print("  ✓ 删除 embeddings.faiss.mapping.json")
         deleted_count += 1
     
+    # 删除二进制ID映射
+    if os.path.exists(ids_file):
+        os.remove(ids_file)
+        print("  ✓ 删除 embeddings.faiss.ids.npy")
+        deleted_count += 1
+    
+    # 删除追加日志
+    if os.path.exists(delta_file):
+        os.remove(delta_file)
+        print("  ✓ 删除 embeddings.faiss.delta")
+        deleted_count += 1
+    
+    # 删除单文件工作流存储
+    if store_files:
+        for path in store_files:
+            os.remove(path)
+        print("  ✓ 删除 library.sqlite")
+        deleted_count += 1
+    
+    # 删除意图embedding矩阵
+    if os.path.exists(embedding_matrix_file):
+        os.remove(embedding_matrix_file)
+        print("  ✓ 删除 intent_embeddings.f32")
+        deleted_count += 1
+    
     # 删除节点元数据
     if os.path.exists(node_meta_file):
         os.remove(node_meta_file)
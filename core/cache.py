@@ -0,0 +1,443 @@
+"""
+持久化缓存模块
+基于SQLite的本地缓存，避免重复调用远程API
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+import numpy as np
+
+
+def content_hash(*parts: str) -> str:
+    """
+    计算内容哈希（各部分以\\0分隔，避免拼接歧义）
+    
+    Args:
+        parts: 参与哈希的字符串
+    
+    Returns:
+        sha256十六进制摘要
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class SQLiteCache:
+    """SQLite缓存基类（连接管理、LRU淘汰和命中统计）"""
+    
+    # 子类定义表名和列（必须包含 key 主键和 last_access）
+    TABLE = ''
+    COLUMNS = ''
+    
+    # 命中时的访问时间先记在内存中，积累到一定数量或间隔后批量写回，避免每次命中都写盘
+    ACCESS_FLUSH_SIZE = 256
+    ACCESS_FLUSH_INTERVAL = 10.0
+    
+    def __init__(self, path: str, max_entries: int = 100000):
+        """
+        初始化缓存
+        
+        Args:
+            path: SQLite数据库文件路径
+            max_entries: 最多缓存的条目数，超出时淘汰最久未访问的条目
+        """
+        self.path = path
+        self.max_entries = max_entries
+        
+        # 命中统计（仅当前进程）
+        self.hits = 0
+        self.misses = 0
+        
+        # 尚未写回的访问时间 {key: last_access}
+        self._pending_access: Dict[str, float] = {}
+        self._last_access_flush = time.time()
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        # 检索和入库可能在多个线程中调用
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f'CREATE TABLE IF NOT EXISTS {self.TABLE} ({self.COLUMNS})')
+        self._conn.execute(
+            f'CREATE INDEX IF NOT EXISTS idx_{self.TABLE}_access ON {self.TABLE}(last_access)'
+        )
+        self._conn.commit()
+        # 条目数只在启动时统计一次，之后随写入和删除在内存中维护
+        self._count = self._conn.execute(f'SELECT COUNT(*) FROM {self.TABLE}').fetchone()[0]
+    
+    def _touch(self, keys: List[str], now: float):
+        """
+        记录命中条目的访问时间（调用方持有锁）
+        
+        Args:
+            keys: 命中的缓存键
+            now: 访问时间
+        """
+        for key in keys:
+            self._pending_access[key] = now
+        if (len(self._pending_access) >= self.ACCESS_FLUSH_SIZE
+                or now - self._last_access_flush >= self.ACCESS_FLUSH_INTERVAL):
+            self._flush_access()
+            self._conn.commit()
+    
+    def _flush_access(self):
+        """将内存中的访问时间写回数据库（调用方持有锁并负责提交）"""
+        if self._pending_access:
+            self._conn.executemany(
+                f'UPDATE {self.TABLE} SET last_access = ? WHERE key = ?',
+                [(last_access, key) for key, last_access in self._pending_access.items()]
+            )
+            self._pending_access = {}
+        self._last_access_flush = time.time()
+    
+    def _count_new(self, keys: List[str]) -> int:
+        """
+        统计尚不在缓存中的键（按主键查询，调用方持有锁）
+        
+        Args:
+            keys: 即将写入的缓存键
+        
+        Returns:
+            新键数量
+        """
+        unique_keys = list(set(keys))
+        existing = 0
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            existing += self._conn.execute(
+                f'SELECT COUNT(*) FROM {self.TABLE} WHERE key IN ({placeholders})', chunk
+            ).fetchone()[0]
+        return len(unique_keys) - existing
+    
+    def _evict(self):
+        """淘汰最久未访问的条目，使缓存大小不超过max_entries（调用方持有锁）"""
+        overflow = self._count - self.max_entries
+        if overflow > 0:
+            # 淘汰依据最新的访问时间
+            self._flush_access()
+            cursor = self._conn.execute(
+                f'DELETE FROM {self.TABLE} WHERE key IN '
+                f'(SELECT key FROM {self.TABLE} ORDER BY last_access LIMIT ?)',
+                (overflow,)
+            )
+            self._count -= cursor.rowcount
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存统计
+        
+        Returns:
+            {'hits', 'misses', 'hit_rate', 'size'}
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self)
+        }
+    
+    def close(self):
+        """写回访问时间并关闭数据库连接"""
+        with self._lock:
+            self._flush_access()
+            self._conn.commit()
+            self._conn.close()
+
+
+class EmbeddingCache(SQLiteCache):
+    """Embedding缓存（按模型名+文本内容哈希索引，LRU淘汰）"""
+    
+    TABLE = 'embeddings'
+    COLUMNS = 'key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, last_access REAL NOT NULL'
+    
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """
+        查询缓存
+        
+        Args:
+            model: embedding模型名
+            text: 输入文本
+        
+        Returns:
+            Embedding向量，未命中返回None
+        """
+        return self.get_many(model, [text])[0]
+    
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        批量查询缓存
+        
+        Args:
+            model: embedding模型名
+            texts: 输入文本列表
+        
+        Returns:
+            与输入一一对应的向量列表，未命中的位置为None
+        """
+        keys = [content_hash(model, text) for text in texts]
+        found: Dict[str, List[float]] = {}
+        
+        with self._lock:
+            unique_keys = list(set(keys))
+            # 分批查询，避免超出SQLite的参数数量上限
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype='<f4').tolist()
+            
+            if found:
+                self._touch(list(found), time.time())
+            
+            results = [found.get(key) for key in keys]
+            hits = sum(1 for vector in results if vector is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+        
+        return results
+    
+    def put(self, model: str, text: str, vector: List[float]):
+        """
+        写入缓存
+        
+        Args:
+            model: embedding模型名
+            text: 输入文本
+            vector: Embedding向量
+        """
+        self.put_many(model, [text], [vector])
+    
+    def put_many(self, model: str, texts: List[str], vectors: List[Optional[List[float]]]):
+        """
+        批量写入缓存（跳过为None的向量）
+        
+        Args:
+            model: embedding模型名
+            texts: 输入文本列表
+            vectors: 与文本一一对应的向量列表
+        """
+        now = time.time()
+        rows = [
+            (content_hash(model, text), model, np.asarray(vector, dtype='<f4').tobytes(), now)
+            for text, vector in zip(texts, vectors)
+            if vector is not None
+        ]
+        if not rows:
+            return
+        
+        with self._lock:
+            self._count += self._count_new([row[0] for row in rows])
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, model, vector, last_access) VALUES (?, ?, ?, ?)',
+                rows
+            )
+            self._evict()
+            self._conn.commit()
+
+
+class RerankCache(SQLiteCache):
+    """
+    Rerank相关性分数缓存（按reranker模型、规范化查询、workflow_id和工作流描述索引，LRU淘汰）
+    
+    描述参与键的计算，工作流意图描述变化后旧分数自然失效
+    """
+    
+    TABLE = 'rerank_scores'
+    COLUMNS = 'key TEXT PRIMARY KEY, workflow_id TEXT NOT NULL, score REAL NOT NULL, last_access REAL NOT NULL'
+    
+    @staticmethod
+    def make_key(model: str, query: str, workflow_id: str, description: str) -> str:
+        """
+        计算缓存键（查询忽略大小写和多余空白）
+        
+        Args:
+            model: reranker模型名
+            query: 查询文本
+            workflow_id: 工作流ID
+            description: 参与打分的工作流描述
+            
+        Returns:
+            缓存键
+        """
+        normalized_query = ' '.join(query.split()).lower()
+        return content_hash(model, normalized_query, workflow_id, description)
+    
+    def get_many(self, keys: List[str]) -> List[Optional[float]]:
+        """
+        批量查询缓存
+        
+        Args:
+            keys: 缓存键列表（见make_key）
+            
+        Returns:
+            与键一一对应的分数列表，未命中的位置为None
+        """
+        found: Dict[str, float] = {}
+        
+        with self._lock:
+            unique_keys = list(set(keys))
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT key, score FROM rerank_scores WHERE key IN ({placeholders})', chunk
+                ).fetchall()
+                found.update(rows)
+            
+            if found:
+                self._touch(list(found), time.time())
+            
+            results = [found.get(key) for key in keys]
+            hits = sum(1 for score in results if score is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+        
+        return results
+    
+    def put_many(self, rows: List[Tuple[str, str, float]]):
+        """
+        批量写入缓存
+        
+        Args:
+            rows: [(缓存键, workflow_id, 分数)]
+        """
+        if not rows:
+            return
+        
+        now = time.time()
+        with self._lock:
+            self._count += self._count_new([row[0] for row in rows])
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO rerank_scores (key, workflow_id, score, last_access) VALUES (?, ?, ?, ?)',
+                [(key, workflow_id, float(score), now) for key, workflow_id, score in rows]
+            )
+            self._evict()
+            self._conn.commit()
+
+
+class ResponseCache(SQLiteCache):
+    """Chat回复缓存（按模型、系统消息、提示词、温度和JSON模式索引，支持TTL和LRU淘汰）"""
+    
+    TABLE = 'responses'
+    COLUMNS = (
+        'key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, '
+        'created_at REAL NOT NULL, last_access REAL NOT NULL'
+    )
+    
+    def __init__(self, path: str, max_entries: int = 10000, ttl_seconds: Optional[float] = None):
+        """
+        初始化缓存
+        
+        Args:
+            path: SQLite数据库文件路径
+            max_entries: 最多缓存的回复数，超出时淘汰最久未访问的条目
+            ttl_seconds: 回复的有效期（秒），None或0表示不过期
+        """
+        super().__init__(path, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.expired = 0
+    
+    @staticmethod
+    def make_key(
+        model: str,
+        system_message: Optional[str],
+        prompt: str,
+        temperature: float,
+        json_mode: bool
+    ) -> str:
+        """
+        计算缓存键
+        
+        Args:
+            model: 模型名
+            system_message: 系统消息
+            prompt: 用户提示
+            temperature: 实际使用的温度
+            json_mode: 是否使用JSON模式
+            
+        Returns:
+            缓存键
+        """
+        return content_hash(model, system_message or '', prompt, repr(float(temperature)), str(bool(json_mode)))
+    
+    def get(self, key: str) -> Optional[str]:
+        """
+        查询缓存（过期条目视为未命中并删除）
+        
+        Args:
+            key: 缓存键（见make_key）
+            
+        Returns:
+            缓存的回复，未命中返回None
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response, created_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            
+            if row is not None and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._conn.commit()
+                self._pending_access.pop(key, None)
+                self._count -= 1
+                self.expired += 1
+                row = None
+            
+            if row is None:
+                self.misses += 1
+                return None
+            
+            self._touch([key], now)
+            self.hits += 1
+            return row[0]
+    
+    def put(self, key: str, model: str, response: str):
+        """
+        写入缓存
+        
+        Args:
+            key: 缓存键（见make_key）
+            model: 模型名
+            response: 回复文本
+        """
+        now = time.time()
+        with self._lock:
+            self._count += self._count_new([key])
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, created_at, last_access) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, model, response, now, now)
+            )
+            self._evict()
+            self._conn.commit()
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存统计
+        
+        Returns:
+            {'hits', 'misses', 'expired', 'hit_rate', 'size'}
+        """
+        stats = super().stats()
+        stats['expired'] = self.expired
+        return stats
@@ -0,0 +1,188 @@
+"""
+本地交叉编码器模块
+加载 models/reranker 这类序列分类模型（如 train_script.py 训练的交叉编码器），
+在CPU上按批对 (查询, 文档) 打分；可选ONNX Runtime推理和int8动态量化
+"""
+
+import os
+from typing import List, Dict, Any, Optional
+import numpy as np
+
+
+def _sigmoid(x: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _relevance(logits: np.ndarray) -> np.ndarray:
+    """
+    将模型输出转换为0-1相关性分数（与rerank API的relevance_score同一量纲）
+    
+    Args:
+        logits: [batch, num_labels] 模型输出
+    
+    Returns:
+        [batch] 分数
+    """
+    logits = np.asarray(logits, dtype='float32')
+    if logits.ndim == 1 or logits.shape[-1] == 1:
+        return _sigmoid(logits.reshape(-1))
+    # 多分类头：取最后一类（相关）的softmax概率
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    probs = np.exp(shifted) / np.exp(shifted).sum(axis=-1, keepdims=True)
+    return probs[:, -1]
+
+
+class LocalCrossEncoder:
+    """本地交叉编码器（CPU批量推理，backend为 "torch" 或 "onnx"）"""
+    
+    def __init__(
+        self,
+        model_path: str,
+        backend: str = 'torch',
+        quantize: bool = False,
+        batch_size: int = 32,
+        max_length: int = 256,
+        num_threads: Optional[int] = None
+    ):
+        """
+        初始化交叉编码器
+        
+        Args:
+            model_path: 模型目录（含tokenizer和config；onnx后端还需 model.onnx）
+            backend: 推理后端，"torch" 或 "onnx"
+            quantize: 是否使用int8动态量化（torch后端量化Linear层；
+                onnx后端使用 model.int8.onnx，不存在时由 model.onnx 生成）
+            batch_size: 每批打分的 (查询, 文档) 对数
+            max_length: 单个文本对的最大token数
+            num_threads: CPU推理线程数，None表示使用默认值
+        """
+        if backend not in ('torch', 'onnx'):
+            raise ValueError(f"不支持的推理后端: {backend}")
+        
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            raise ImportError("本地reranker需要transformers: pip install sentence-transformers")
+        
+        self.model_path = model_path
+        self.backend = backend
+        self.quantize = quantize
+        self.batch_size = batch_size
+        self.max_length = max_length
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        
+        if backend == 'torch':
+            self._load_torch(num_threads)
+        else:
+            self._load_onnx(num_threads)
+        
+        print(f"[CrossEncoder] 已加载本地模型: {model_path} ({backend}{', int8' if quantize else ''})")
+    
+    def _load_torch(self, num_threads: Optional[int]):
+        """加载PyTorch模型"""
+        try:
+            import torch
+            from transformers import AutoModelForSequenceClassification
+        except ImportError:
+            raise ImportError("torch后端需要PyTorch: pip install torch")
+        
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        
+        model = AutoModelForSequenceClassification.from_pretrained(self.model_path)
+        model.eval()
+        if self.quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        
+        self._torch = torch
+        self.model = model
+        self.session = None
+    
+    def _load_onnx(self, num_threads: Optional[int]):
+        """加载ONNX模型（需要量化且量化模型不存在时先生成）"""
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("onnx后端需要onnxruntime: pip install onnxruntime")
+        
+        onnx_path = os.path.join(self.model_path, 'model.onnx')
+        if self.quantize:
+            quantized_path = os.path.join(self.model_path, 'model.int8.onnx')
+            if not os.path.exists(quantized_path):
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                print(f"[CrossEncoder] 生成int8量化模型: {quantized_path}")
+                quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+            onnx_path = quantized_path
+        
+        if not os.path.exists(onnx_path):
+            raise FileNotFoundError(
+                f"未找到ONNX模型: {onnx_path}（可用 optimum-cli export onnx --task text-classification 导出）"
+            )
+        
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self._input_names = {node.name for node in self.session.get_inputs()}
+        self.model = None
+    
+    def _score_batch(self, queries: List[str], documents: List[str]) -> np.ndarray:
+        """
+        对一批 (查询, 文档) 对打分
+        
+        Args:
+            queries: 查询列表
+            documents: 与查询一一对应的文档列表
+        
+        Returns:
+            [len(documents)] 0-1相关性分数
+        """
+        if self.session is not None:
+            features = self.tokenizer(
+                queries, documents, padding=True, truncation=True,
+                max_length=self.max_length, return_tensors='np'
+            )
+            feed: Dict[str, Any] = {
+                name: value.astype('int64') for name, value in features.items() if name in self._input_names
+            }
+            logits = self.session.run(None, feed)[0]
+        else:
+            features = self.tokenizer(
+                queries, documents, padding=True, truncation=True,
+                max_length=self.max_length, return_tensors='pt'
+            )
+            with self._torch.no_grad():
+                logits = self.model(**features).logits.float().numpy()
+        
+        return _relevance(logits)
+    
+    def score_pairs(self, queries: List[str], documents: List[str]) -> List[float]:
+        """
+        对 (查询, 文档) 对打分（多个查询的文本对可以打包在同一批中）
+        
+        Args:
+            queries: 查询列表
+            documents: 与查询一一对应的文档列表
+        
+        Returns:
+            与文本对一一对应的0-1相关性分数
+        """
+        scores: List[float] = []
+        for start in range(0, len(documents), self.batch_size):
+            end = start + self.batch_size
+            scores.extend(self._score_batch(queries[start:end], documents[start:end]).tolist())
+        return scores
+    
+    def score(self, query: str, documents: List[str]) -> List[float]:
+        """
+        对同一查询的多个文档打分
+        
+        Args:
+            query: 查询文本
+            documents: 文档列表
+        
+        Returns:
+            与文档一一对应的0-1相关性分数
+        """
+        return self.score_pairs([query] * len(documents), documents)
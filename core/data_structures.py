@@ -4,7 +4,7 @@
 """
 
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Callable, Sequence, Tuple
 from enum import Enum
 
 
@@ -44,8 +44,9 @@ class WorkflowEntry:
     # 意图（自动标注或人工标注）
     intent: WorkflowIntent
     
-    # 向量表示（用于检索）
-    intent_embedding: Optional[List[float]] = None
+    # 向量表示（用于检索；库中的条目为embedding矩阵中一行的只读视图）
+    intent_embedding: Optional[Sequence[float]] = None
+    embedding_row: Optional[int] = None  # 在embedding矩阵中的行号
     
     # 元数据
     source: str = "unknown"             # "comfybench", "openart", "manual"
@@ -59,6 +60,66 @@ class WorkflowEntry:
     avg_execution_time: float = 0.0
 
 
+# 尚未加载的工作流内容
+_NOT_LOADED = object()
+
+
+class LazyWorkflowEntry(WorkflowEntry):
+    """
+    按需加载的工作流条目
+    
+    workflow_json 和 workflow_code 在访问时才通过loader读取（由loader负责LRU缓存，条目本身不持有），
+    检索阶段只用到意图和embedding，不会触发加载；
+    node_types 和 code_hash 为入库时保存的摘要，供词法索引和片段指纹使用
+    """
+    
+    def __init__(
+        self,
+        loader: Callable[[str], Tuple[Dict[str, Any], str]],
+        node_types: Optional[List[str]] = None,
+        code_hash: Optional[str] = None,
+        **kwargs
+    ):
+        """
+        初始化条目
+        
+        Args:
+            loader: 按workflow_id返回 (workflow_json, workflow_code) 的函数
+            node_types: 工作流中的节点类型
+            code_hash: workflow_code的内容哈希
+            kwargs: WorkflowEntry的其余字段
+        """
+        self._loader = loader
+        self._assigned: Dict[str, Any] = {}
+        self.node_types = node_types
+        self.code_hash = code_hash
+        super().__init__(workflow_json=_NOT_LOADED, workflow_code=_NOT_LOADED, **kwargs)
+    
+    @property
+    def workflow_json(self) -> Dict[str, Any]:
+        if 'workflow_json' in self._assigned:
+            return self._assigned['workflow_json']
+        return self._loader(self.workflow_id)[0]
+    
+    @workflow_json.setter
+    def workflow_json(self, value: Dict[str, Any]):
+        if value is not _NOT_LOADED:
+            self._assigned['workflow_json'] = value
+            self.node_types = None
+    
+    @property
+    def workflow_code(self) -> str:
+        if 'workflow_code' in self._assigned:
+            return self._assigned['workflow_code']
+        return self._loader(self.workflow_id)[1]
+    
+    @workflow_code.setter
+    def workflow_code(self, value: str):
+        if value is not _NOT_LOADED:
+            self._assigned['workflow_code'] = value
+            self.code_hash = None
+
+
 @dataclass
 class AtomicNeed:
     """
@@ -118,6 +179,9 @@ class WorkflowFragment:
     inputs: Dict[str, str] = field(default_factory=dict)   # {"clip": "CLIP", "text": "STRING"}
     outputs: Dict[str, str] = field(default_factory=dict)  # {"conditioning": "CONDITIONING"}
     
+    # 描述（或代码）的向量表示（匹配前预筛选时生成；片段存储中的片段为片段embedding矩阵中一行的只读视图）
+    embedding: Optional[Sequence[float]] = None
+    
     # 映射到的原子需求（匹配后填充）
     mapped_need_id: Optional[str] = None
     match_confidence: float = 0.0
@@ -0,0 +1,276 @@
+"""
+意图embedding存储模块
+所有工作流的意图embedding保存在一个连续的float32矩阵文件中（内存映射读取），
+工作流条目只记录行号并持有该行的只读视图，元数据中不再内联embedding列表
+"""
+
+import os
+import struct
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows上没有fcntl，退化为只在进程内加锁
+    fcntl = None
+
+
+class EmbeddingMatrix:
+    """
+    float32 embedding矩阵（文件头 + 按行存放的向量，行号即工作流条目的embedding_row）
+    
+    文件按块预分配容量，只有容量用完时才重新映射，已发出的行视图因此只引用少数几个映射；
+    分配行号时持有文件锁并以文件头中的行数为准，多个进程向同一文件追加时行号不会重复。
+    行只追加不复用（删除的工作流留下的空行由离线的compact回收），
+    其他进程持有的行号和视图因此不会被改写
+    """
+    
+    FILENAME = 'intent_embeddings.f32'
+    
+    # 文件头：魔数 + 向量维度 + 已分配行数（之后的预分配空间未使用）
+    MAGIC = b'WEM2'
+    HEADER_FORMAT = '<4sIQ'
+    # 旧版文件头（无预分配，行数由文件大小决定）
+    LEGACY_MAGIC = b'WEMB'
+    LEGACY_HEADER_FORMAT = '<4sI'
+    
+    # 容量用完时至少扩到原来的两倍，且不少于该行数
+    MIN_CAPACITY = 1024
+    
+    def __init__(self, path: str, dimension: Optional[int] = None):
+        """
+        初始化矩阵
+        
+        Args:
+            path: 矩阵文件路径
+            dimension: 向量维度，None时从已有文件读取或由第一个写入的向量决定
+        """
+        self.path = path
+        self.dimension = dimension
+        self.header_size = struct.calcsize(self.HEADER_FORMAT)
+        
+        self._lock = threading.Lock()
+        self._file = None
+        self._matrix: np.ndarray = np.empty((0, dimension or 0), dtype='<f4')
+        # 已分配的行数
+        self._rows = 0
+        
+        if os.path.exists(path):
+            self._open()
+    
+    def __len__(self) -> int:
+        return self._rows
+    
+    def _open(self):
+        """打开已有文件（旧版文件先转换为预分配格式）并映射"""
+        with open(self.path, 'rb') as f:
+            magic = f.read(4)
+        if magic == self.LEGACY_MAGIC:
+            self._convert_legacy()
+        elif magic != self.MAGIC:
+            raise ValueError(f"不是embedding矩阵文件: {self.path}")
+        
+        # 无缓冲：文件头可能被其他进程改写，每次都要从文件读取
+        self._file = open(self.path, 'r+b', buffering=0)
+        _, file_dimension, self._rows = self._read_header()
+        if self.dimension is not None and self.dimension != file_dimension:
+            raise ValueError(f"embedding矩阵维度 {file_dimension} 与配置的维度 {self.dimension} 不一致")
+        self.dimension = file_dimension
+        self._remap()
+    
+    def _convert_legacy(self):
+        """将旧版文件（文件头后直接是所有行）改写为带行数的文件头"""
+        legacy_header_size = struct.calcsize(self.LEGACY_HEADER_FORMAT)
+        with open(self.path, 'rb') as f:
+            _, dimension = struct.unpack(self.LEGACY_HEADER_FORMAT, f.read(legacy_header_size))
+            data = f.read()
+        rows = len(data) // (4 * dimension)
+        
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, dimension, rows))
+            f.write(data[:rows * 4 * dimension])
+        os.replace(temp_path, self.path)
+        print(f"[EmbeddingMatrix] 已转换旧版embedding矩阵文件（{rows} 行）")
+    
+    def _create(self):
+        """创建空文件（维度确定后调用）"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 'x'模式：其他进程已创建时直接使用已有文件
+        try:
+            with open(self.path, 'xb') as f:
+                f.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.dimension, 0))
+        except FileExistsError:
+            pass
+        self._open()
+    
+    def _read_header(self):
+        """读取文件头 (魔数, 维度, 行数)"""
+        self._file.seek(0)
+        return struct.unpack(self.HEADER_FORMAT, self._file.read(self.header_size))
+    
+    def _capacity(self) -> int:
+        """文件当前可容纳的行数"""
+        return (os.fstat(self._file.fileno()).st_size - self.header_size) // (4 * self.dimension)
+    
+    def _remap(self):
+        """按文件当前容量重新映射（只在容量增长后调用）"""
+        capacity = self._capacity()
+        if capacity == 0:
+            self._matrix = np.empty((0, self.dimension), dtype='<f4')
+            return
+        self._matrix = np.memmap(
+            self._file, dtype='<f4', mode='r+', offset=self.header_size, shape=(capacity, self.dimension)
+        )
+    
+    def _ensure_mapped(self, rows: int):
+        """确保映射覆盖前rows行（其他进程扩容后按需重新映射）"""
+        if rows > len(self._matrix):
+            self._remap()
+    
+    def _allocate(self, count: int) -> int:
+        """
+        在文件末尾分配count行（调用方持有进程内锁）
+        
+        持有文件锁读取文件头中的行数，必要时扩容，再写回新的行数
+        
+        Args:
+            count: 行数
+        
+        Returns:
+            第一行的行号
+        """
+        fd = self._file.fileno()
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            _, _, start = self._read_header()
+            needed = start + count
+            capacity = self._capacity()
+            if needed > capacity:
+                capacity = max(needed, capacity * 2, self.MIN_CAPACITY)
+                os.ftruncate(fd, self.header_size + capacity * 4 * self.dimension)
+            self._file.seek(0)
+            self._file.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.dimension, needed))
+            self._rows = needed
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        
+        self._ensure_mapped(needed)
+        return start
+    
+    def row(self, index: int) -> np.ndarray:
+        """
+        获取一行的只读视图
+        
+        Args:
+            index: 行号
+        
+        Returns:
+            [dimension] float32视图
+        """
+        self._ensure_mapped(index + 1)
+        view = self._matrix[index].view(np.ndarray)
+        view.flags.writeable = False
+        return view
+    
+    def _as_rows(self, embeddings: Sequence[Sequence[float]]) -> np.ndarray:
+        """转换为float32矩阵并校验维度（第一次写入时确定维度）"""
+        matrix = np.asarray(embeddings, dtype='<f4')
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        if self.dimension is None:
+            self.dimension = matrix.shape[-1]
+        if matrix.ndim != 2 or matrix.shape[-1] != self.dimension:
+            raise ValueError(f"embedding维度 {matrix.shape[-1]} 与矩阵维度 {self.dimension} 不一致")
+        return matrix
+    
+    def add_many(self, embeddings: Sequence[Sequence[float]]) -> List[int]:
+        """
+        追加多个向量
+        
+        Args:
+            embeddings: 向量列表
+        
+        Returns:
+            与向量一一对应的行号
+        """
+        with self._lock:
+            matrix = self._as_rows(embeddings)
+            if self._file is None:
+                self._create()
+            
+            start = self._allocate(len(matrix))
+            self._matrix[start:start + len(matrix)] = matrix
+            self._matrix.flush()
+            return list(range(start, start + len(matrix)))
+    
+    def add(self, embedding: Sequence[float]) -> int:
+        """
+        写入一个向量
+        
+        Args:
+            embedding: 向量
+        
+        Returns:
+            行号
+        """
+        return self.add_many([embedding])[0]
+    
+    def write(self, index: int, embedding: Sequence[float]):
+        """
+        原地覆盖一行（该行已发出的视图同步看到新值）
+        
+        Args:
+            index: 行号
+            embedding: 新向量
+        """
+        with self._lock:
+            vector = self._as_rows([embedding])[0]
+            self._ensure_mapped(index + 1)
+            self._matrix[index] = vector
+            self._matrix.flush()
+    
+    def compact(self, keep: Iterable[int]) -> Dict[int, int]:
+        """
+        只保留仍被引用的行，按原顺序重写文件（离线维护时调用，其他进程不能同时使用该文件）
+        
+        重写后本实例之前发出的行视图不再对应文件内容，调用方需按返回的映射更新行号并重新获取视图
+        
+        Args:
+            keep: 仍被引用的行号
+        
+        Returns:
+            {旧行号: 新行号}
+        """
+        with self._lock:
+            kept = sorted(set(keep))
+            if self._file is None:
+                return {}
+            self._ensure_mapped(self._rows)
+            
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.dimension, len(kept)))
+                if kept:
+                    f.write(np.ascontiguousarray(self._matrix[kept], dtype='<f4').tobytes())
+            
+            self._file.close()
+            os.replace(temp_path, self.path)
+            reclaimed = self._rows - len(kept)
+            self._open()
+        
+        print(f"[EmbeddingMatrix] 已压缩 {self.path}，回收 {reclaimed} 行")
+        return {old: new for new, old in enumerate(kept)}
+    
+    def close(self):
+        """关闭文件（已发出的行视图仍然有效）"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -3,9 +3,12 @@
 使用LLM判断片段是否能满足需求（意图满足 > 语义相似度）
 """
 
+from concurrent.futures import Executor
 from typing import List, Dict, Any, Tuple, Optional
+import numpy as np
 from .data_structures import WorkflowFragment, AtomicNeed
 from .llm_client import LLMClient
+from .utils import fragment_embedding_text
 import prompts
 
 
@@ -16,7 +19,11 @@ class FragmentMatcher:
         self,
         llm_client: LLMClient,
         matching_threshold: float = 0.65,
-        use_llm: bool = True
+        use_llm: bool = True,
+        batch_size: int = 1,
+        max_batch_chars: int = 12000,
+        prefilter_top_n: int = 0,
+        prefilter_rule_weight: float = 0.3
     ):
         """
         初始化片段匹配器
@@ -25,15 +32,24 @@ class FragmentMatcher:
             llm_client: LLM客户端
             matching_threshold: 匹配阈值
             use_llm: 是否使用LLM判断（否则使用简单规则）
+            batch_size: 一次LLM调用中判断的片段数上限，1表示每个需求-片段对单独调用
+            max_batch_chars: 一次批量判断中片段代码的总字符数上限（控制提示词不超出上下文窗口）
+            prefilter_top_n: LLM判断前按向量相似度+规则分预筛选，每个需求只保留前N个片段，0表示不预筛选
+            prefilter_rule_weight: 预筛选分数中规则匹配分的权重（其余为余弦相似度）
         """
         self.llm = llm_client
         self.matching_threshold = matching_threshold
         self.use_llm = use_llm
+        self.batch_size = max(1, batch_size)
+        self.max_batch_chars = max_batch_chars
+        self.prefilter_top_n = prefilter_top_n
+        self.prefilter_rule_weight = prefilter_rule_weight
     
     def match_fragments_to_needs(
         self,
         fragments: List[WorkflowFragment],
-        atomic_needs: List[AtomicNeed]
+        atomic_needs: List[AtomicNeed],
+        executor: Optional[Executor] = None
     ) -> Dict[str, List[WorkflowFragment]]:
         """
         将片段匹配到原子需求
@@ -41,16 +57,32 @@ class FragmentMatcher:
         Args:
             fragments: 片段列表
             atomic_needs: 原子需求列表
+            executor: 线程池，提供时各需求的判断并发执行（结果与顺序执行一致）
             
         Returns:
             {need_id: [matched_fragments]} 映射
         """
         mapping = {need.need_id: [] for need in atomic_needs}
         
-        for need in atomic_needs:
-            # 为每个需求找匹配的片段
-            matched_fragments = self._find_matching_fragments(need, fragments)
-            mapping[need.need_id] = matched_fragments
+        if executor is None:
+            judgements = [self._judge_fragments(need, fragments) for need in atomic_needs]
+        elif self.use_llm:
+            # 先按向量预筛选（片段向量只生成一次），再只为各需求保留片段的并集生成描述：
+            # 描述被多个需求共用，集中生成可避免多个线程重复生成同一片段的描述
+            self._ensure_embeddings(fragments)
+            survivors = list(executor.map(lambda need: self._prefilter_fragments(need, fragments), atomic_needs))
+            shared = {id(f): f for need_fragments in survivors for f in need_fragments if not f.description}
+            list(executor.map(self._ensure_description, shared.values()))
+            judgements = list(executor.map(
+                lambda args: self._judge_fragments(args[0], args[1], prefiltered=True),
+                zip(atomic_needs, survivors)
+            ))
+        else:
+            judgements = list(executor.map(lambda need: self._judge_fragments(need, fragments), atomic_needs))
+        
+        # 片段的匹配信息按需求顺序写回
+        for need, need_judgements in zip(atomic_needs, judgements):
+            mapping[need.need_id] = self._collect_matches(need, need_judgements)
         
         return mapping
     
@@ -69,12 +101,214 @@ class FragmentMatcher:
         Returns:
             匹配的片段列表（按置信度排序）
         """
-        scored_fragments = []
+        return self._collect_matches(need, self._judge_fragments(need, fragments))
+    
+    def _judge_fragments(
+        self,
+        need: AtomicNeed,
+        fragments: List[WorkflowFragment],
+        prefiltered: bool = False
+    ) -> List[Tuple[WorkflowFragment, bool, float]]:
+        """
+        逐个判断片段是否匹配需求（不修改片段的匹配信息，可并发调用）
+        
+        Args:
+            need: 原子需求
+            fragments: 候选片段
+            prefiltered: 候选片段是否已经过该需求的预筛选
+            
+        Returns:
+            [(片段, 是否匹配, 置信度)]
+        """
+        judgements = []
+        
+        if self.use_llm and not prefiltered:
+            # 只有预筛选保留下来的片段送给LLM判断
+            fragments = self._prefilter_fragments(need, fragments)
+        
+        if self.use_llm and self.batch_size > 1:
+            # 批量模式：一次调用判断一组片段
+            for chunk in self._chunk_fragments(fragments):
+                for fragment, (matched, confidence, reason) in zip(chunk, self._llm_judge_batch(need, chunk)):
+                    judgements.append((fragment, matched, confidence))
+            return judgements
         
         for fragment in fragments:
-            # 判断是否匹配
             matched, confidence, reason = self._judge_match(need, fragment)
+            judgements.append((fragment, matched, confidence))
+        return judgements
+    
+    def _ensure_embeddings(self, fragments: List[WorkflowFragment]):
+        """
+        为还没有向量的片段批量生成embedding（预筛选关闭时不生成）
+        
+        Args:
+            fragments: 片段列表
+        """
+        if not self.prefilter_top_n:
+            return
+        missing = [fragment for fragment in fragments if fragment.embedding is None]
+        if not missing:
+            return
+        
+        # 描述尚未生成时用代码本身（节点名和参数），不为预筛选额外调用LLM
+        vectors = self.llm.embed_batch([fragment_embedding_text(fragment) for fragment in missing])
+        for fragment, vector in zip(missing, vectors):
+            fragment.embedding = vector
+    
+    def _prefilter_fragments(
+        self,
+        need: AtomicNeed,
+        fragments: List[WorkflowFragment]
+    ) -> List[WorkflowFragment]:
+        """
+        按 余弦相似度 与 规则匹配分 的加权和预筛选片段
+        
+        Args:
+            need: 原子需求
+            fragments: 候选片段
+            
+        Returns:
+            保留的片段（保持原有顺序）；没有向量的片段总是保留
+        """
+        if not self.prefilter_top_n or len(fragments) <= self.prefilter_top_n:
+            return fragments
+        
+        self._ensure_embeddings(fragments)
+        need_embedding = self.llm.embed(need.description)
+        if need_embedding is None:
+            return fragments
+        need_vec = np.asarray(need_embedding, dtype=np.float32)
+        need_norm = np.linalg.norm(need_vec) or 1.0
+        
+        scored = []
+        for i, fragment in enumerate(fragments):
+            if fragment.embedding is None:
+                continue
+            vec = np.asarray(fragment.embedding, dtype=np.float32)
+            cosine = float(np.dot(need_vec, vec) / (need_norm * (np.linalg.norm(vec) or 1.0)))
+            _, rule_score, _ = self._rule_based_match(need, fragment)
+            score = (1 - self.prefilter_rule_weight) * max(cosine, 0.0) + self.prefilter_rule_weight * rule_score
+            scored.append((score, i))
+        
+        scored.sort(reverse=True)
+        keep = {i for _, i in scored[:self.prefilter_top_n]}
+        survivors = [
+            fragment for i, fragment in enumerate(fragments)
+            if i in keep or fragment.embedding is None
+        ]
+        print(f"[FragmentMatcher] 需求 {need.need_id} 预筛选: {len(fragments)} -> {len(survivors)} 个片段")
+        return survivors
+    
+    def _chunk_fragments(self, fragments: List[WorkflowFragment]) -> List[List[WorkflowFragment]]:
+        """
+        按片段数和代码总长度把片段分组（单个超长片段独占一组）
+        
+        Args:
+            fragments: 候选片段
             
+        Returns:
+            片段分组列表
+        """
+        chunks = []
+        current = []
+        current_chars = 0
+        for fragment in fragments:
+            size = len(fragment.code)
+            if current and (len(current) >= self.batch_size or current_chars + size > self.max_batch_chars):
+                chunks.append(current)
+                current = []
+                current_chars = 0
+            current.append(fragment)
+            current_chars += size
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    def _llm_judge_batch(
+        self,
+        need: AtomicNeed,
+        fragments: List[WorkflowFragment]
+    ) -> List[Tuple[bool, float, str]]:
+        """
+        使用一次LLM调用判断一组片段是否匹配需求
+        
+        Args:
+            need: 原子需求
+            fragments: 一组候选片段
+            
+        Returns:
+            与片段一一对应的 [(是否匹配, 置信度, 理由)]，解析失败或缺失的片段回退到规则匹配
+        """
+        for fragment in fragments:
+            self._ensure_description(fragment)
+        
+        fragments_text = "\n\n".join(
+            prompts.FRAGMENT_BATCH_ITEM_TEMPLATE.format(
+                index=i,
+                fragment_function=fragment.description,
+                code_fragment=fragment.code
+            )
+            for i, fragment in enumerate(fragments)
+        )
+        prompt = prompts.FRAGMENT_NEED_BATCH_MATCHING_PROMPT.format(
+            need_description=need.description,
+            need_category=need.category,
+            need_modality=need.modality,
+            need_constraints=need.constraints,
+            fragment_count=len(fragments),
+            fragments=fragments_text
+        )
+        
+        response = self.llm.chat(
+            prompt=prompt,
+            system_message="你是ComfyUI工作流专家，擅长判断代码片段是否能满足用户需求。",
+            json_mode=True,
+            temperature=0.3  # 降低温度以获得更一致的判断
+        )
+        
+        parsed = self.llm.parse_json_response(response)
+        results = parsed.get('results') if isinstance(parsed, dict) else None
+        if not isinstance(results, list):
+            print(f"LLM批量判断失败，{len(fragments)}个片段回退到规则匹配")
+            results = []
+        
+        # 按编号收集分数表
+        table = {}
+        for item in results:
+            if not isinstance(item, dict):
+                continue
+            try:
+                index = int(item.get('index'))
+                confidence = float(item.get('confidence', 0.0))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= index < len(fragments):
+                table[index] = (bool(item.get('matched', False)), confidence, item.get('reason', ''))
+        
+        return [
+            table[i] if i in table else self._rule_based_match(need, fragment)
+            for i, fragment in enumerate(fragments)
+        ]
+    
+    def _collect_matches(
+        self,
+        need: AtomicNeed,
+        judgements: List[Tuple[WorkflowFragment, bool, float]]
+    ) -> List[WorkflowFragment]:
+        """
+        筛选达到阈值的片段并写入匹配信息
+        
+        Args:
+            need: 原子需求
+            judgements: _judge_fragments的结果
+            
+        Returns:
+            匹配的片段列表（按置信度排序）
+        """
+        scored_fragments = []
+        
+        for fragment, matched, confidence in judgements:
             if matched and confidence >= self.matching_threshold:
                 # 更新片段的匹配信息
                 fragment.mapped_need_id = need.need_id
@@ -123,8 +357,7 @@ class FragmentMatcher:
             (是否匹配, 置信度, 理由)
         """
         # 如果片段没有描述，先生成描述
-        if not fragment.description:
-            fragment.description = self._generate_fragment_description(fragment)
+        self._ensure_description(fragment)
         
         # 构建提示词
         prompt = prompts.FRAGMENT_NEED_MATCHING_PROMPT.format(
@@ -157,6 +390,16 @@ class FragmentMatcher:
         
         return matched, confidence, reason
     
+    def _ensure_description(self, fragment: WorkflowFragment):
+        """
+        为没有描述的片段生成功能描述
+        
+        Args:
+            fragment: 工作流片段
+        """
+        if not fragment.description:
+            fragment.description = self._generate_fragment_description(fragment)
+    
     def _rule_based_match(
         self,
         need: AtomicNeed,
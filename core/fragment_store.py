@@ -0,0 +1,375 @@
+"""
+片段存储模块
+入库时将工作流拆分为片段（含描述、输入输出类型和embedding）并持久化，
+请求时直接查表，不再对同一个工作流反复拆分和描述
+
+片段的embedding保存在一个float32矩阵文件中（与意图embedding相同的EmbeddingMatrix），
+每个工作流的指纹和embedding行号记录在一个追加写的清单文件中，
+启动时只读取清单和矩阵即可构建片段索引，不再逐个读取片段文件
+"""
+
+import dataclasses
+import json
+import os
+import threading
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from .cache import content_hash
+from .data_structures import WorkflowEntry, WorkflowFragment
+from .embedding_store import EmbeddingMatrix
+from .llm_client import LLMClient
+from .utils import fragment_embedding_text, workflow_code_hash, save_json, load_json
+
+try:
+    import fcntl
+except ImportError:
+    # Windows上没有fcntl，退化为只在进程内加锁
+    fcntl = None
+
+
+class FragmentStore:
+    """工作流片段存储（每个工作流一个文件，工作流代码或拆分策略变化时失效）"""
+    
+    SUFFIX = '.fragments.json'
+    MATRIX_FILENAME = 'fragment_embeddings.f32'
+    MANIFEST_FILENAME = 'fragments.manifest.jsonl'
+    
+    # 清单中失效的记录超过有效记录数 + 该值时，启动时压缩清单
+    MANIFEST_COMPACT_SLACK = 256
+    
+    def __init__(
+        self,
+        directory: str,
+        code_splitter=None,
+        llm_client: Optional[LLMClient] = None
+    ):
+        """
+        初始化片段存储
+        
+        Args:
+            directory: 片段文件目录（与工作流元数据文件放在一起）
+            code_splitter: 代码拆分器（CodeSplitter），None时只能读取已有片段
+            llm_client: LLM客户端（用于生成片段embedding），None时不生成embedding
+        """
+        self.directory = directory
+        self.code_splitter = code_splitter
+        self.llm = llm_client
+        
+        # 内存缓存 {workflow_id: (指纹, 片段列表)}，片段的embedding是矩阵行的只读视图
+        self._cache: Dict[str, Tuple[str, List[WorkflowFragment]]] = {}
+        # 请求时可能在多个流水线线程中查询
+        self._lock = threading.Lock()
+        # 每个工作流一把锁：同一工作流的 检查 → 拆分 → 保存 只由一个线程执行
+        self._workflow_locks: Dict[str, threading.Lock] = {}
+        
+        os.makedirs(directory, exist_ok=True)
+        
+        self.embeddings = EmbeddingMatrix(os.path.join(directory, self.MATRIX_FILENAME))
+        self.manifest_path = os.path.join(directory, self.MANIFEST_FILENAME)
+        # 清单 {workflow_id: (指纹, 每个片段的embedding行号，没有embedding的片段为None)}
+        self._rows: Dict[str, Tuple[str, List[Optional[int]]]] = self._read_manifest(compact=True)
+    
+    def _path(self, workflow_id: str) -> str:
+        """片段文件路径"""
+        return os.path.join(self.directory, f'{workflow_id}{self.SUFFIX}')
+    
+    def _fingerprint(self, entry: WorkflowEntry) -> str:
+        """片段的有效性指纹：工作流代码 + 拆分策略"""
+        strategy = getattr(self.code_splitter, 'strategy', '')
+        return content_hash(strategy, workflow_code_hash(entry))
+    
+    def get(self, entry: WorkflowEntry, compute: bool = True) -> Optional[List[WorkflowFragment]]:
+        """
+        获取工作流的片段（内存缓存 → 文件 → 现场拆分并保存）
+        
+        返回的是副本，匹配阶段写入的匹配信息不会污染存储
+        
+        Args:
+            entry: 工作流条目
+            compute: 没有有效的已存片段时是否现场拆分
+        
+        Returns:
+            片段列表；没有有效的已存片段且无法拆分时返回None
+        """
+        fingerprint = self._fingerprint(entry)
+        
+        with self._lock:
+            cached = self._cache.get(entry.workflow_id)
+        if cached is None or cached[0] != fingerprint:
+            # 其他线程正在拆分同一工作流时等待其完成，完成后直接使用其结果
+            with self._workflow_lock(entry.workflow_id):
+                with self._lock:
+                    cached = self._cache.get(entry.workflow_id)
+                if cached is not None and cached[0] == fingerprint:
+                    fragments = cached[1]
+                else:
+                    fragments = self._load(entry.workflow_id, fingerprint)
+                    if fragments is None:
+                        if self.code_splitter is None or not compute:
+                            return None
+                        fragments = self._compute(entry)
+                    else:
+                        with self._lock:
+                            self._cache[entry.workflow_id] = (fingerprint, fragments)
+        else:
+            fragments = cached[1]
+        
+        return [dataclasses.replace(fragment) for fragment in fragments]
+    
+    def _workflow_lock(self, workflow_id: str) -> threading.Lock:
+        """获取工作流的锁（不存在时创建）"""
+        with self._lock:
+            return self._workflow_locks.setdefault(workflow_id, threading.Lock())
+    
+    def has_valid(self, entry: WorkflowEntry) -> bool:
+        """
+        工作流是否已有有效的片段（内存、清单或文件中）
+        
+        Args:
+            entry: 工作流条目
+        
+        Returns:
+            是否有效
+        """
+        fingerprint = self._fingerprint(entry)
+        with self._lock:
+            cached = self._cache.get(entry.workflow_id)
+            record = self._rows.get(entry.workflow_id)
+        if cached is not None and cached[0] == fingerprint:
+            return True
+        if record is not None and record[0] == fingerprint and os.path.exists(self._path(entry.workflow_id)):
+            return True
+        return self._load(entry.workflow_id, fingerprint) is not None
+    
+    def stored_embeddings(self, entry: WorkflowEntry) -> Optional[List[Optional[np.ndarray]]]:
+        """
+        工作流已存片段的embedding（按片段顺序，用于启动时构建片段索引）
+        
+        只查清单和矩阵，不读取片段文件
+        
+        Args:
+            entry: 工作流条目
+        
+        Returns:
+            与片段一一对应的只读向量视图（没有embedding的片段为None），没有有效的已存片段时返回None
+        """
+        fingerprint = self._fingerprint(entry)
+        with self._lock:
+            record = self._rows.get(entry.workflow_id)
+        if record is None or record[0] != fingerprint:
+            return None
+        return [self.embeddings.row(row) if row is not None else None for row in record[1]]
+    
+    def compute(self, entry: WorkflowEntry) -> List[WorkflowFragment]:
+        """
+        拆分工作流、生成片段embedding并保存（覆盖已有片段）
+        
+        Args:
+            entry: 工作流条目
+        
+        Returns:
+            片段列表
+        """
+        if self.code_splitter is None:
+            raise ValueError("未配置代码拆分器，无法预计算片段")
+        
+        with self._workflow_lock(entry.workflow_id):
+            return self._compute(entry)
+    
+    def _compute(self, entry: WorkflowEntry) -> List[WorkflowFragment]:
+        """拆分、生成embedding并保存（调用方持有该工作流的锁）"""
+        fragments = self.code_splitter.split(entry)
+        
+        vectors: Sequence[Optional[List[float]]] = [None] * len(fragments)
+        if self.llm and fragments:
+            vectors = self.llm.embed_batch([fragment_embedding_text(fragment) for fragment in fragments])
+        
+        fingerprint = self._fingerprint(entry)
+        self._save(entry.workflow_id, fingerprint, fragments, vectors)
+        
+        with self._lock:
+            self._cache[entry.workflow_id] = (fingerprint, fragments)
+        return fragments
+    
+    def remove(self, workflow_id: str):
+        """
+        删除工作流的片段（embedding行由compact_embeddings离线回收）
+        
+        Args:
+            workflow_id: 工作流ID
+        """
+        with self._workflow_lock(workflow_id):
+            with self._lock:
+                self._cache.pop(workflow_id, None)
+                record = self._rows.pop(workflow_id, None)
+            if record is not None:
+                self._append_manifest({'workflow_id': workflow_id, 'removed': True})
+            path = self._path(workflow_id)
+            if os.path.exists(path):
+                os.remove(path)
+        with self._lock:
+            self._workflow_locks.pop(workflow_id, None)
+    
+    def _save(
+        self,
+        workflow_id: str,
+        fingerprint: str,
+        fragments: List[WorkflowFragment],
+        vectors: Sequence[Optional[Sequence[float]]]
+    ):
+        """
+        将片段的embedding追加到矩阵，片段写入文件，行号记入清单（该工作流旧的行由compact_embeddings离线回收）
+        
+        完成后片段的embedding改为矩阵行的只读视图
+        
+        Args:
+            workflow_id: 工作流ID
+            fingerprint: 有效性指纹
+            fragments: 片段列表
+            vectors: 与片段一一对应的embedding（None表示没有）
+        """
+        positions = [i for i, vector in enumerate(vectors) if vector is not None]
+        rows: List[Optional[int]] = [None] * len(fragments)
+        if positions:
+            for i, row in zip(positions, self.embeddings.add_many([vectors[i] for i in positions])):
+                rows[i] = row
+        for fragment, row in zip(fragments, rows):
+            fragment.embedding = self.embeddings.row(row) if row is not None else None
+        
+        save_json({
+            'workflow_id': workflow_id,
+            'fingerprint': fingerprint,
+            'fragments': [self._serialize(fragment) for fragment in fragments]
+        }, self._path(workflow_id))
+        
+        with self._lock:
+            self._rows[workflow_id] = (fingerprint, rows)
+        self._append_manifest({'workflow_id': workflow_id, 'fingerprint': fingerprint, 'rows': rows})
+    
+    def _load(self, workflow_id: str, fingerprint: str) -> Optional[List[WorkflowFragment]]:
+        """
+        从文件加载片段并从矩阵取回embedding，指纹不一致（工作流已变化）时视为无效
+        
+        Args:
+            workflow_id: 工作流ID
+            fingerprint: 当前的有效性指纹
+        
+        Returns:
+            片段列表，不存在或已失效时返回None
+        """
+        path = self._path(workflow_id)
+        if not os.path.exists(path):
+            return None
+        
+        try:
+            data = load_json(path)
+            if data.get('fingerprint') != fingerprint:
+                return None
+            fragments = [WorkflowFragment(**fragment) for fragment in data['fragments']]
+        except Exception as e:
+            print(f"加载片段 {workflow_id} 失败: {e}")
+            return None
+        
+        with self._lock:
+            record = self._rows.get(workflow_id)
+        if record is None or record[0] != fingerprint:
+            # 片段可能由其他进程（如recorder）刚写入，重新读取清单
+            rows = self._read_manifest()
+            with self._lock:
+                self._rows.update(rows)
+                record = self._rows.get(workflow_id)
+        if record is not None and record[0] == fingerprint and len(record[1]) == len(fragments):
+            for fragment, row in zip(fragments, record[1]):
+                fragment.embedding = self.embeddings.row(row) if row is not None else None
+        return fragments
+    
+    def compact_embeddings(self) -> int:
+        """
+        回收片段embedding矩阵中失效片段留下的行并重写清单（离线维护时调用，其他进程不能同时打开该目录）
+        
+        Returns:
+            回收的行数
+        """
+        total = len(self.embeddings)
+        with self._lock:
+            mapping = self.embeddings.compact(
+                row for _, rows in self._rows.values() for row in rows if row is not None
+            )
+            self._rows = {
+                workflow_id: (fingerprint, [mapping[row] if row is not None else None for row in rows])
+                for workflow_id, (fingerprint, rows) in self._rows.items()
+            }
+            # 缓存中的片段持有旧行的视图
+            self._cache.clear()
+            with self._locked_manifest('w') as manifest:
+                self._write_records(manifest, self._rows)
+        return total - len(self.embeddings)
+    
+    @staticmethod
+    def _write_records(manifest, rows: Dict[str, Tuple[str, List[Optional[int]]]]):
+        """写入每个工作流的一条清单记录"""
+        for workflow_id, (fingerprint, workflow_rows) in rows.items():
+            manifest.write(json.dumps({
+                'workflow_id': workflow_id, 'fingerprint': fingerprint, 'rows': workflow_rows
+            }) + '\n')
+    
+    def _locked_manifest(self, mode: str):
+        """打开清单文件并持有文件锁（多个进程共用同一个清单）"""
+        manifest = open(self.manifest_path, mode, encoding='utf-8')
+        if fcntl is not None:
+            fcntl.flock(manifest.fileno(), fcntl.LOCK_EX)
+        return manifest
+    
+    def _append_manifest(self, record: Dict):
+        """向清单追加一条记录（后写的记录覆盖同一工作流之前的记录）"""
+        with self._locked_manifest('a') as manifest:
+            manifest.write(json.dumps(record) + '\n')
+    
+    @staticmethod
+    def _parse_manifest(lines: Iterator[str]) -> Tuple[Dict[str, Tuple[str, List[Optional[int]]]], int]:
+        """解析清单，返回 (有效记录, 总记录数)；写到一半的行跳过"""
+        rows: Dict[str, Tuple[str, List[Optional[int]]]] = {}
+        total = 0
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            total += 1
+            if record.get('removed'):
+                rows.pop(record['workflow_id'], None)
+            else:
+                rows[record['workflow_id']] = (record['fingerprint'], record['rows'])
+        return rows, total
+    
+    def _read_manifest(self, compact: bool = False) -> Dict[str, Tuple[str, List[Optional[int]]]]:
+        """
+        读取清单
+        
+        Args:
+            compact: 失效记录过多时是否原地重写清单（只保留有效记录）
+        
+        Returns:
+            {workflow_id: (指纹, embedding行号)}
+        """
+        if not os.path.exists(self.manifest_path):
+            return {}
+        
+        with self._locked_manifest('r+') as manifest:
+            rows, total = self._parse_manifest(manifest)
+            if compact and total > len(rows) + self.MANIFEST_COMPACT_SLACK:
+                # 原地重写，其他进程持有的是同一个文件，追加时仍受同一把锁保护
+                manifest.seek(0)
+                manifest.truncate()
+                self._write_records(manifest, rows)
+                print(f"[FragmentStore] 片段清单已压缩: {total} → {len(rows)} 条记录")
+        return rows
+    
+    @staticmethod
+    def _serialize(fragment: WorkflowFragment) -> Dict:
+        """序列化片段（不保存请求时的匹配信息；embedding保存在矩阵中）"""
+        return {
+            field.name: getattr(fragment, field.name)
+            for field in dataclasses.fields(fragment)
+            if field.name not in ('mapped_need_id', 'match_confidence', 'embedding')
+        }
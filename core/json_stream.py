@@ -0,0 +1,164 @@
+"""
+流式JSON解析模块
+在LLM逐token输出时增量扫描JSON文本，顶层字段或顶层数组中的元素一闭合就立即解析返回，
+下游不必等待整个回复结束
+"""
+
+import json
+from typing import List, Dict, Any, Tuple, Optional
+
+
+# 片段无法解析时的标记（与合法的null区分）
+_INVALID = object()
+
+
+class IncrementalJSONParser:
+    """
+    增量JSON解析器（只解析第一个顶层对象，忽略其前后的说明文字和```json标记）
+    
+    feed() 返回本次新闭合的事件 (path, value)：
+      - (key,)        顶层字段 key 的完整值
+      - (key, index)  顶层数组字段 key 的第 index 个元素（数组整体闭合前即可得到）
+    """
+    
+    def __init__(self):
+        self.buffer = ''
+        # 已闭合的顶层字段
+        self.result: Dict[str, Any] = {}
+        
+        self._pos = 0
+        # 容器栈（'{' 或 '['），为空表示还未进入顶层对象
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._done = False
+        
+        # 顶层对象中的状态：期待键还是值，当前键，值/键/数组元素的起始位置
+        self._expect_key = True
+        self._key: Optional[str] = None
+        self._key_start: Optional[int] = None
+        self._value_start: Optional[int] = None
+        self._element_start: Optional[int] = None
+        self._element_index = 0
+    
+    @property
+    def done(self) -> bool:
+        """顶层对象是否已闭合"""
+        return self._done
+    
+    def feed(self, chunk: str) -> List[Tuple[Tuple, Any]]:
+        """
+        输入一段文本
+        
+        Args:
+            chunk: 新到达的文本片段
+        
+        Returns:
+            本次新闭合的 [(path, value)] 事件列表（无法解析的片段被跳过）
+        """
+        self.buffer += chunk
+        events: List[Tuple[Tuple, Any]] = []
+        
+        while self._pos < len(self.buffer) and not self._done:
+            char = self.buffer[self._pos]
+            if self._in_string:
+                self._scan_string_char(char)
+            else:
+                self._scan_char(char, events)
+            self._pos += 1
+        
+        return events
+    
+    def _in_top_array(self) -> bool:
+        """当前是否直接位于顶层字段的数组值中"""
+        return len(self._stack) == 2 and self._stack[1] == '['
+    
+    def _mark_value_start(self):
+        """在顶层值或顶层数组元素开始处记录位置"""
+        if len(self._stack) == 1 and not self._expect_key and self._value_start is None:
+            self._value_start = self._pos
+        elif self._in_top_array() and self._element_start is None:
+            self._element_start = self._pos
+    
+    def _scan_string_char(self, char: str):
+        """扫描字符串内部的字符"""
+        if self._escape:
+            self._escape = False
+        elif char == '\\':
+            self._escape = True
+        elif char == '"':
+            self._in_string = False
+            if self._key_start is not None:
+                key = self._decode(self._key_start, self._pos + 1)
+                self._key = key if isinstance(key, str) else None
+                self._key_start = None
+    
+    def _scan_char(self, char: str, events: List[Tuple[Tuple, Any]]):
+        """扫描字符串外部的字符"""
+        if not self._stack:
+            # 顶层对象之前的文字全部忽略
+            if char == '{':
+                self._stack.append('{')
+            return
+        
+        if char == '"':
+            if len(self._stack) == 1 and self._expect_key:
+                self._key_start = self._pos
+            else:
+                self._mark_value_start()
+            self._in_string = True
+        elif char in '{[':
+            self._mark_value_start()
+            self._stack.append(char)
+        elif char in '}]':
+            if self._in_top_array():
+                # 数组闭合前，最后一个标量元素也随之结束
+                self._emit_element(self._pos, events)
+            self._stack.pop()
+            if self._in_top_array() and self._element_start is not None:
+                self._emit_element(self._pos + 1, events)
+            elif len(self._stack) == 1 and self._value_start is not None:
+                self._emit_field(self._pos + 1, events)
+            elif not self._stack:
+                self._emit_field(self._pos, events)
+                self._done = True
+        elif char == ',':
+            if len(self._stack) == 1:
+                self._emit_field(self._pos, events)
+                self._expect_key = True
+            elif self._in_top_array():
+                self._emit_element(self._pos, events)
+        elif char == ':':
+            if len(self._stack) == 1:
+                self._expect_key = False
+        elif not char.isspace():
+            # 数字、true/false/null
+            self._mark_value_start()
+    
+    def _decode(self, start: int, end: int) -> Any:
+        """解析buffer[start:end]，失败返回_INVALID"""
+        try:
+            return json.loads(self.buffer[start:end])
+        except json.JSONDecodeError:
+            return _INVALID
+    
+    def _emit_field(self, end: int, events: List[Tuple[Tuple, Any]]):
+        """结束当前顶层字段"""
+        if self._value_start is not None and self._key is not None:
+            value = self._decode(self._value_start, end)
+            if value is not _INVALID:
+                self.result[self._key] = value
+                events.append(((self._key,), value))
+        self._value_start = None
+        self._element_start = None
+        self._element_index = 0
+    
+    def _emit_element(self, end: int, events: List[Tuple[Tuple, Any]]):
+        """结束当前顶层数组元素"""
+        if self._element_start is None:
+            return
+        value = self._decode(self._element_start, end)
+        if value is not _INVALID:
+            events.append(((self._key, self._element_index), value))
+        self._element_index += 1
+        self._element_start = None
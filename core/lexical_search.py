@@ -0,0 +1,177 @@
+"""
+词法检索模块
+基于BM25的内存倒排索引 + 倒数排名融合（RRF），弥补纯向量检索对节点名、关键词等精确词的弱匹配
+"""
+
+import math
+import re
+from typing import List, Dict, Optional, Tuple, Iterable
+
+
+# 拉丁字母/数字词 与 连续的中日韩字符
+_WORD_PATTERN = re.compile(r'[A-Za-z0-9]+|[一-鿿㐀-䶿]+')
+
+# 驼峰拆分：IPAdapterAdvanced -> IP / Adapter / Advanced
+_CAMEL_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+')
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    分词：英文按词（同时拆分驼峰），中文按二元组
+    
+    例如 "使用AnimateDiff生成视频" -> ["使用", "animatediff", "animate", "diff", "生成", "成视", "视频"]
+    驼峰拆分出的单字符片段（如KSampler中的K）不作为词项
+    
+    Args:
+        text: 文本
+    
+    Returns:
+        小写的词项列表
+    """
+    tokens = []
+    for word in _WORD_PATTERN.findall(text or ''):
+        if word[0].isascii():
+            tokens.append(word.lower())
+            parts = _CAMEL_PATTERN.findall(word)
+            if len(parts) > 1:
+                tokens.extend(part.lower() for part in parts if len(part) > 1)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class BM25Index:
+    """BM25倒排索引（支持增量添加和删除文档）"""
+    
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """
+        初始化索引
+        
+        Args:
+            k1: 词频饱和参数
+            b: 文档长度归一化参数
+        """
+        self.k1 = k1
+        self.b = b
+        
+        # 倒排表 {term: {doc_id: 词频}}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        # 文档长度 {doc_id: 词项数}
+        self.doc_lengths: Dict[str, int] = {}
+        self.total_length = 0
+        # 文档包含的词项（删除时只需遍历这些倒排表）
+        self._doc_terms: Dict[str, List[str]] = {}
+    
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+    
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.doc_lengths
+    
+    def add_document(self, doc_id: str, text: str):
+        """
+        添加文档（已存在时替换）
+        
+        Args:
+            doc_id: 文档ID
+            text: 文档文本
+        """
+        if doc_id in self.doc_lengths:
+            self.remove_document(doc_id)
+        
+        tokens = tokenize(text)
+        for token in tokens:
+            doc_freqs = self.postings.setdefault(token, {})
+            doc_freqs[doc_id] = doc_freqs.get(doc_id, 0) + 1
+        
+        self.doc_lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+        self._doc_terms[doc_id] = list(set(tokens))
+    
+    def remove_document(self, doc_id: str) -> bool:
+        """
+        删除文档
+        
+        Args:
+            doc_id: 文档ID
+        
+        Returns:
+            文档是否存在
+        """
+        if doc_id not in self.doc_lengths:
+            return False
+        
+        self.total_length -= self.doc_lengths.pop(doc_id)
+        for token in self._doc_terms.pop(doc_id):
+            del self.postings[token][doc_id]
+            if not self.postings[token]:
+                del self.postings[token]
+        return True
+    
+    def search(
+        self,
+        query: str,
+        top_k: int = 20,
+        doc_ids: Optional[Iterable[str]] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        BM25检索
+        
+        Args:
+            query: 查询文本
+            top_k: 返回数量
+            doc_ids: 只在这些文档中检索，None表示不限制
+        
+        Returns:
+            按分数降序的 [(doc_id, 分数)] 列表（只包含至少命中一个词项的文档）
+        """
+        num_docs = len(self.doc_lengths)
+        if num_docs == 0:
+            return []
+        
+        allowed = set(doc_ids) if doc_ids is not None else None
+        avg_length = self.total_length / num_docs or 1.0
+        
+        scores: Dict[str, float] = {}
+        for token in set(tokenize(query)):
+            doc_freqs = self.postings.get(token)
+            if not doc_freqs:
+                continue
+            
+            idf = math.log(1 + (num_docs - len(doc_freqs) + 0.5) / (len(doc_freqs) + 0.5))
+            for doc_id, tf in doc_freqs.items():
+                if allowed is not None and doc_id not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:top_k]
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[str]],
+    k: int = 60,
+    weights: Optional[List[float]] = None
+) -> List[Tuple[str, float]]:
+    """
+    倒数排名融合：score(d) = Σ weight_i / (k + rank_i(d))
+    
+    Args:
+        rankings: 多路检索结果，每路为按相关性降序的ID列表
+        k: 平滑常数，越大越削弱头部排名的优势
+        weights: 每路结果的权重，默认均为1
+    
+    Returns:
+        按融合分数降序的 [(ID, 分数)] 列表
+    """
+    weights = weights or [1.0] * len(rankings)
+    
+    scores: Dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (k + rank)
+    
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
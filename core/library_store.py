@@ -0,0 +1,366 @@
+"""
+工作流库存储模块
+将所有工作流（JSON、代码、意图和元数据）合并存放在一个SQLite文件中，
+启动时一次顺序读取，不再逐个打开 metadata/{id}.meta.json 和 workflows/{id}.json；
+按需加载模式下启动时只读元数据和embedding，工作流JSON和代码在首次访问时按主键读取
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple
+import numpy as np
+from .data_structures import WorkflowEntry, LazyWorkflowEntry, WorkflowIntent, WorkflowComplexity
+from .utils import load_json, workflow_node_types, workflow_code_hash
+
+
+def entry_metadata(entry: WorkflowEntry) -> Dict[str, Any]:
+    """
+    工作流条目的元数据（旧版 .meta.json 文件的内容）
+    
+    embedding已写入embedding矩阵的条目只记录行号；尚未迁移的条目仍内联embedding列表
+    
+    Args:
+        entry: 工作流条目
+    
+    Returns:
+        元数据字典
+    """
+    embedding = None
+    if entry.embedding_row is None and entry.intent_embedding is not None:
+        embedding = np.asarray(entry.intent_embedding, dtype='float32').tolist()
+    
+    return {
+        'workflow_id': entry.workflow_id,
+        'workflow_code': entry.workflow_code,
+        'intent': {
+            'task': entry.intent.task,
+            'description': entry.intent.description,
+            'keywords': entry.intent.keywords,
+            'modality': entry.intent.modality,
+            'operation': entry.intent.operation,
+            'style': entry.intent.style
+        },
+        'intent_embedding': embedding,
+        'embedding_row': entry.embedding_row,
+        'source': entry.source,
+        'complexity': entry.complexity.value,
+        'tags': entry.tags,
+        'node_count': entry.node_count,
+        'usage_count': entry.usage_count,
+        'success_rate': entry.success_rate,
+        'avg_execution_time': entry.avg_execution_time
+    }
+
+
+def entry_from_metadata(
+    workflow_id: str,
+    metadata: Dict[str, Any],
+    workflow_json: Optional[Dict[str, Any]] = None,
+    loader: Optional[Callable[[str], Tuple[Dict[str, Any], str]]] = None
+) -> WorkflowEntry:
+    """
+    由元数据和工作流JSON构建工作流条目
+    
+    Args:
+        workflow_id: 工作流ID
+        metadata: 元数据字典（见entry_metadata）
+        workflow_json: 工作流JSON
+        loader: 提供时构建按需加载的条目（忽略workflow_json，元数据中不需要workflow_code）
+    
+    Returns:
+        工作流条目
+    """
+    intent_data = metadata['intent']
+    intent = WorkflowIntent(
+        task=intent_data['task'],
+        description=intent_data['description'],
+        keywords=intent_data['keywords'],
+        modality=intent_data['modality'],
+        operation=intent_data['operation'],
+        style=intent_data.get('style')
+    )
+    
+    fields = dict(
+        workflow_id=workflow_id,
+        intent=intent,
+        intent_embedding=metadata.get('intent_embedding'),
+        embedding_row=metadata.get('embedding_row'),
+        source=metadata.get('source', 'unknown'),
+        complexity=WorkflowComplexity(metadata.get('complexity', 'vanilla')),
+        tags=metadata.get('tags', []),
+        node_count=metadata.get('node_count', 0),
+        usage_count=metadata.get('usage_count', 0),
+        success_rate=metadata.get('success_rate', 1.0),
+        avg_execution_time=metadata.get('avg_execution_time', 0.0)
+    )
+    
+    if loader is not None:
+        return LazyWorkflowEntry(
+            loader=loader,
+            node_types=metadata.get('node_types'),
+            code_hash=metadata.get('code_hash'),
+            **fields
+        )
+    return WorkflowEntry(workflow_json=workflow_json, workflow_code=metadata['workflow_code'], **fields)
+
+
+def has_legacy_files(data_path: str) -> bool:
+    """
+    库目录中是否有旧版的逐工作流JSON文件
+    
+    Args:
+        data_path: 工作流库目录
+    
+    Returns:
+        是否存在 .meta.json 文件
+    """
+    metadata_dir = os.path.join(data_path, 'metadata')
+    if not os.path.exists(metadata_dir):
+        return False
+    return any(filename.endswith('.meta.json') for filename in os.listdir(metadata_dir))
+
+
+def load_legacy_entries(data_path: str) -> Iterator[WorkflowEntry]:
+    """
+    从旧版目录结构（metadata/{id}.meta.json + workflows/{id}.json）逐个加载工作流
+    
+    Args:
+        data_path: 工作流库目录
+    
+    Returns:
+        工作流条目迭代器（加载失败的工作流被跳过）
+    """
+    metadata_dir = os.path.join(data_path, 'metadata')
+    workflows_dir = os.path.join(data_path, 'workflows')
+    
+    if not os.path.exists(metadata_dir):
+        return
+    
+    for filename in sorted(os.listdir(metadata_dir)):
+        if not filename.endswith('.meta.json'):
+            continue
+        
+        workflow_id = filename[:-len('.meta.json')]
+        try:
+            metadata = load_json(os.path.join(metadata_dir, filename))
+            workflow_json = load_json(os.path.join(workflows_dir, f'{workflow_id}.json'))
+            yield entry_from_metadata(workflow_id, metadata, workflow_json)
+        except Exception as e:
+            print(f"加载工作流 {workflow_id} 失败: {e}")
+
+
+class LibraryStore:
+    """工作流库的单文件SQLite存储（每个工作流一行；尚未迁移到embedding矩阵的embedding以float32二进制保存）"""
+    
+    FILENAME = 'library.sqlite'
+    
+    def __init__(self, path: str, body_cache_size: int = 256):
+        """
+        初始化存储
+        
+        Args:
+            path: SQLite数据库文件路径
+            body_cache_size: 按需加载时内存中保留的工作流JSON和代码数量（LRU）
+        """
+        self.path = path
+        self.body_cache_size = body_cache_size
+        # 最近访问的工作流内容 {workflow_id: (workflow_json, workflow_code)}
+        self._bodies: OrderedDict = OrderedDict()
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS workflows ('
+            'workflow_id TEXT PRIMARY KEY, metadata TEXT NOT NULL, '
+            'workflow_json TEXT NOT NULL, intent_embedding BLOB, workflow_code TEXT)'
+        )
+        self._migrate()
+        self._conn.commit()
+    
+    def _migrate(self):
+        """旧版数据库的代码保存在元数据JSON中：移到 workflow_code 列，并补上节点类型和代码哈希"""
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(workflows)')}
+        if 'workflow_code' in columns:
+            return
+        
+        self._conn.execute('ALTER TABLE workflows ADD COLUMN workflow_code TEXT')
+        rows = self._conn.execute('SELECT workflow_id, metadata, workflow_json FROM workflows').fetchall()
+        updates = []
+        for workflow_id, metadata, workflow_json in rows:
+            metadata = json.loads(metadata)
+            metadata['intent_embedding'] = None
+            entry = entry_from_metadata(workflow_id, metadata, json.loads(workflow_json))
+            metadata = self._metadata(entry)
+            updates.append((json.dumps(metadata, ensure_ascii=False), entry.workflow_code, workflow_id))
+        self._conn.executemany('UPDATE workflows SET metadata = ?, workflow_code = ? WHERE workflow_id = ?', updates)
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM workflows').fetchone()[0]
+    
+    @staticmethod
+    def _metadata(entry: WorkflowEntry) -> Dict[str, Any]:
+        """
+        元数据列的内容：不含embedding和代码，附带节点类型和代码哈希，
+        使按需加载的条目在建索引和校验片段时不必读取工作流内容
+        """
+        metadata = entry_metadata(entry)
+        metadata.pop('intent_embedding')
+        metadata.pop('workflow_code')
+        metadata['node_types'] = workflow_node_types(entry)
+        metadata['code_hash'] = workflow_code_hash(entry)
+        return metadata
+    
+    @classmethod
+    def _row(cls, entry: WorkflowEntry) -> Tuple[str, str, str, Optional[bytes], str]:
+        """序列化工作流条目（未迁移的embedding单独存为float32二进制，代码单独一列）"""
+        metadata = cls._metadata(entry)
+        embedding = None
+        if entry.embedding_row is None and entry.intent_embedding is not None:
+            embedding = np.asarray(entry.intent_embedding, dtype='<f4').tobytes()
+        return (
+            entry.workflow_id,
+            json.dumps(metadata, ensure_ascii=False),
+            json.dumps(entry.workflow_json, ensure_ascii=False),
+            embedding,
+            entry.workflow_code
+        )
+    
+    def put(self, entry: WorkflowEntry):
+        """
+        写入（覆盖）一个工作流
+        
+        Args:
+            entry: 工作流条目
+        """
+        self.put_many([entry])
+    
+    def put_many(self, entries: List[WorkflowEntry]):
+        """
+        在一个事务中写入多个工作流
+        
+        Args:
+            entries: 工作流条目列表
+        """
+        rows = [self._row(entry) for entry in entries]
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO workflows '
+                '(workflow_id, metadata, workflow_json, intent_embedding, workflow_code) '
+                'VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            self._conn.commit()
+            for entry in entries:
+                self._bodies.pop(entry.workflow_id, None)
+    
+    def delete(self, workflow_id: str) -> bool:
+        """
+        删除一个工作流
+        
+        Args:
+            workflow_id: 工作流ID
+        
+        Returns:
+            是否存在并已删除
+        """
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM workflows WHERE workflow_id = ?', (workflow_id,))
+            self._conn.commit()
+            self._bodies.pop(workflow_id, None)
+            return cursor.rowcount > 0
+    
+    def get_body(self, workflow_id: str) -> Tuple[Dict[str, Any], str]:
+        """
+        读取一个工作流的JSON和代码（最近访问的保留在LRU中）
+        
+        Args:
+            workflow_id: 工作流ID
+        
+        Returns:
+            (workflow_json, workflow_code)
+        """
+        with self._lock:
+            body = self._bodies.get(workflow_id)
+            if body is not None:
+                self._bodies.move_to_end(workflow_id)
+                return body
+            
+            row = self._conn.execute(
+                'SELECT workflow_json, workflow_code FROM workflows WHERE workflow_id = ?', (workflow_id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(f"工作流不存在: {workflow_id}")
+            
+            body = (json.loads(row[0]), row[1] or '')
+            if self.body_cache_size > 0:
+                self._bodies[workflow_id] = body
+                while len(self._bodies) > self.body_cache_size:
+                    self._bodies.popitem(last=False)
+            return body
+    
+    def load_all(self, lazy: bool = False) -> Iterator[WorkflowEntry]:
+        """
+        顺序读取所有工作流
+        
+        Args:
+            lazy: 是否只读取元数据和embedding（工作流JSON和代码在首次访问时通过get_body读取）
+        
+        Returns:
+            工作流条目迭代器（解析失败的工作流被跳过）
+        """
+        columns = 'workflow_id, metadata, intent_embedding'
+        if not lazy:
+            columns += ', workflow_json, workflow_code'
+        with self._lock:
+            rows = self._conn.execute(f'SELECT {columns} FROM workflows ORDER BY rowid').fetchall()
+        
+        for row in rows:
+            workflow_id, metadata, embedding = row[:3]
+            try:
+                metadata = json.loads(metadata)
+                if embedding is not None:
+                    metadata['intent_embedding'] = np.frombuffer(embedding, dtype='<f4').tolist()
+                if lazy:
+                    yield entry_from_metadata(workflow_id, metadata, loader=self.get_body)
+                else:
+                    metadata['workflow_code'] = row[4] or ''
+                    yield entry_from_metadata(workflow_id, metadata, json.loads(row[3]))
+            except Exception as e:
+                print(f"加载工作流 {workflow_id} 失败: {e}")
+    
+    def import_legacy(self, data_path: str) -> int:
+        """
+        从旧版目录结构导入所有工作流（已存在的同ID工作流被覆盖，旧文件保留）
+        
+        Args:
+            data_path: 工作流库目录
+        
+        Returns:
+            导入的工作流数量
+        """
+        count = 0
+        batch: List[WorkflowEntry] = []
+        for entry in load_legacy_entries(data_path):
+            batch.append(entry)
+            if len(batch) >= 500:
+                self.put_many(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.put_many(batch)
+            count += len(batch)
+        return count
+    
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
@@ -1,21 +1,29 @@
 """
 LLM客户端封装
-支持OpenAI API调用和Gemini Embedding API
+支持OpenAI API调用和Gemini Embedding API（同步 + asyncio异步）
 """
 
+import asyncio
 import json
 import http.client
 import urllib.parse
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Iterator
 import openai
+from .cache import EmbeddingCache, ResponseCache
+from .rate_limiter import get_rate_limiter, estimate_tokens, parse_retry_after, HTTPStatusError, RETRYABLE_STATUS_CODES
 
-# 检查OpenAI版本以处理API兼容性
-if hasattr(openai, '__version__') and ('1.' in openai.__version__ or '2.' in openai.__version__):
-    # OpenAI v1.x+ or v2.x+ 使用新API
-    from openai import OpenAI
-else:
+# 检查OpenAI版本以处理API兼容性（v1.x及以上提供OpenAI客户端类）
+try:
+    from openai import OpenAI, AsyncOpenAI
+except ImportError:
     # OpenAI v0.x 使用旧API
     OpenAI = None
+    AsyncOpenAI = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 
 class LLMClient:
@@ -34,9 +42,11 @@ class LLMClient:
         # 初始化OpenAI客户端 - 根据版本处理兼容性
         if OpenAI is not None:
             # 使用新API (v1.x+)
+            # 重试由限流器统一处理，关闭SDK自带重试
             self.openai_client = OpenAI(
                 api_key=openai_config.get('api_key', ''),
-                base_url=openai_config.get('api_base', 'https://api.openai.com/v1')
+                base_url=openai_config.get('api_base', 'https://api.openai.com/v1'),
+                max_retries=0
             )
             self.use_new_api = True
         else:
@@ -55,13 +65,44 @@ class LLMClient:
         self.gemini_config = config.get('gemini', {})
         self.use_gemini_embedding = bool(self.gemini_config.get('api_key'))
         
+        # Embedding缓存（按模型名+文本哈希，检索和入库共用）
+        cache_config = config.get('embedding_cache', {})
+        self.embedding_cache = None
+        if cache_config.get('enabled', False):
+            self.embedding_cache = EmbeddingCache(
+                path=cache_config.get('path', './data/cache/embeddings.sqlite'),
+                max_entries=cache_config.get('max_entries', 100000)
+            )
+        
+        # Chat回复缓存（相同模型/系统消息/提示词/温度/JSON模式直接返回缓存结果）
+        chat_cache_config = config.get('chat_cache', {})
+        self.chat_cache = None
+        if chat_cache_config.get('enabled', False):
+            self.chat_cache = ResponseCache(
+                path=chat_cache_config.get('path', './data/cache/chat_responses.sqlite'),
+                max_entries=chat_cache_config.get('max_entries', 10000),
+                ttl_seconds=chat_cache_config.get('ttl_seconds')
+            )
+        
+        # 按端点共享的限流器（令牌桶 + 退避重试）
+        rate_limits = config.get('rate_limits', {})
+        self.chat_limiter = get_rate_limiter('chat', rate_limits.get('chat'))
+        self.embedding_limiter = get_rate_limiter('embedding', rate_limits.get('embedding'))
+        
+        # 异步客户端（绑定到事件循环，首次异步调用时创建）
+        self._async_loop = None
+        self._async_openai_client = None
+        self._async_http_client = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        
     def chat(
         self, 
         prompt: str, 
         system_message: Optional[str] = None,
         temperature: Optional[float] = None,
         max_tokens: Optional[int] = None,
-        json_mode: bool = False
+        json_mode: bool = False,
+        use_cache: bool = True
     ) -> str:
         """
         调用Chat API
@@ -72,10 +113,170 @@ class LLMClient:
             temperature: 温度参数
             max_tokens: 最大token数
             json_mode: 是否使用JSON模式
+            use_cache: 是否使用回复缓存（需要每次重新采样的调用点传False）
             
         Returns:
             LLM回复
         """
+        kwargs = self._chat_kwargs(prompt, system_message, temperature, max_tokens, json_mode)
+        
+        cache_key = self._chat_cache_key(kwargs, prompt, system_message, json_mode) if use_cache else None
+        if cache_key:
+            cached = self.chat_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        estimated = self._estimate_chat_tokens(kwargs)
+        try:
+            if self.use_new_api:
+                # 使用新API (v1.x+)
+                create = self.openai_client.chat.completions.create
+            else:
+                # 使用旧API (v0.x)
+                create = openai.ChatCompletion.create
+            
+            response = self.chat_limiter.call(create, tokens=estimated, **kwargs)
+            self._record_chat_usage(response, estimated)
+            content = response.choices[0].message.content
+            
+        except Exception as e:
+            print(f"LLM调用失败: {e}")
+            return ""
+        
+        if cache_key and self._cacheable(content, json_mode):
+            self.chat_cache.put(cache_key, self.chat_model, content)
+        
+        return content
+    
+    def chat_stream(
+        self,
+        prompt: str,
+        system_message: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        json_mode: bool = False,
+        use_cache: bool = True
+    ) -> Iterator[str]:
+        """
+        流式调用Chat API，逐段返回生成的文本
+        
+        命中回复缓存时一次性返回缓存内容；完整回复结束后写入缓存。
+        只有建立连接的请求受限流器重试保护，中途断开不重试（已输出的片段无法撤回）
+        
+        Args:
+            prompt: 用户提示
+            system_message: 系统消息
+            temperature: 温度参数
+            max_tokens: 最大token数
+            json_mode: 是否使用JSON模式
+            use_cache: 是否使用回复缓存
+        
+        Yields:
+            文本片段，失败时提前结束
+        """
+        if not self.use_new_api:
+            # 旧版SDK的流式响应格式不同，退化为一次性返回
+            content = self.chat(prompt, system_message, temperature, max_tokens, json_mode, use_cache)
+            if content:
+                yield content
+            return
+        
+        kwargs = self._chat_kwargs(prompt, system_message, temperature, max_tokens, json_mode)
+        
+        cache_key = self._chat_cache_key(kwargs, prompt, system_message, json_mode) if use_cache else None
+        if cache_key:
+            cached = self.chat_cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        
+        estimated = self._estimate_chat_tokens(kwargs)
+        parts = []
+        try:
+            stream = self.chat_limiter.call(
+                self.openai_client.chat.completions.create, tokens=estimated, stream=True, **kwargs
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            print(f"LLM流式调用失败: {e}")
+            return
+        
+        content = ''.join(parts)
+        # 流式响应默认不带usage，按输出长度估算修正
+        self.chat_limiter.record_usage(estimated + estimate_tokens(content), estimated)
+        
+        if cache_key and self._cacheable(content, json_mode):
+            self.chat_cache.put(cache_key, self.chat_model, content)
+    
+    
+    @staticmethod
+    def _estimate_chat_tokens(kwargs: Dict[str, Any]) -> int:
+        """预估请求的输入token数（用于token/分钟限流）"""
+        return sum(estimate_tokens(message['content']) for message in kwargs['messages'])
+    
+    def _record_chat_usage(self, response: Any, estimated: int):
+        """按响应中的实际用量（输入+输出）修正token限流配额"""
+        usage = getattr(response, 'usage', None)
+        total_tokens = getattr(usage, 'total_tokens', None)
+        if isinstance(total_tokens, int):
+            self.chat_limiter.record_usage(total_tokens, estimated)
+    
+    def _cacheable(self, content: Optional[str], json_mode: bool) -> bool:
+        """JSON模式下只缓存可解析的回复，避免一次格式错误被反复复用"""
+        if not content:
+            return False
+        return not json_mode or self.parse_json_response(content) is not None
+    
+    def _chat_cache_key(
+        self,
+        kwargs: Dict[str, Any],
+        prompt: str,
+        system_message: Optional[str],
+        json_mode: bool
+    ) -> Optional[str]:
+        """
+        计算Chat回复的缓存键
+        
+        Args:
+            kwargs: 请求参数（取实际使用的模型和温度）
+            prompt: 用户提示
+            system_message: 系统消息
+            json_mode: 是否使用JSON模式
+            
+        Returns:
+            缓存键，未启用缓存时返回None
+        """
+        if self.chat_cache is None:
+            return None
+        return ResponseCache.make_key(kwargs['model'], system_message, prompt, kwargs['temperature'], json_mode)
+    
+    def _chat_kwargs(
+        self,
+        prompt: str,
+        system_message: Optional[str],
+        temperature: Optional[float],
+        max_tokens: Optional[int],
+        json_mode: bool
+    ) -> Dict[str, Any]:
+        """
+        构造Chat API请求参数
+        
+        Args:
+            prompt: 用户提示
+            system_message: 系统消息
+            temperature: 温度参数
+            max_tokens: 最大token数
+            json_mode: 是否使用JSON模式
+            
+        Returns:
+            请求参数
+        """
         messages = []
         
         if system_message:
@@ -89,43 +290,245 @@ class LLMClient:
             "content": prompt
         })
         
-        try:
-            if self.use_new_api:
-                # 使用新API (v1.x+)
-                kwargs = {
-                    "model": self.chat_model,
-                    "messages": messages,
-                    "temperature": temperature or self.temperature,
-                    "max_tokens": max_tokens or self.max_tokens,
-                }
-                
-                # GPT-4-turbo及以上支持JSON模式
-                if json_mode and 'gpt-4' in self.chat_model:
-                    kwargs["response_format"] = {"type": "json_object"}
-                
-                response = self.openai_client.chat.completions.create(**kwargs)
-                
-                return response.choices[0].message.content
-            else:
-                # 使用旧API (v0.x)
-                kwargs = {
-                    "model": self.chat_model,
-                    "messages": messages,
-                    "temperature": temperature or self.temperature,
-                    "max_tokens": max_tokens or self.max_tokens,
-                }
-                
-                # GPT-4-turbo及以上支持JSON模式
-                if json_mode and 'gpt-4' in self.chat_model:
-                    kwargs["response_format"] = {"type": "json_object"}
-                
-                response = openai.ChatCompletion.create(**kwargs)
-                
-                return response.choices[0].message.content
+        kwargs = {
+            "model": self.chat_model,
+            "messages": messages,
+            "temperature": temperature or self.temperature,
+            "max_tokens": max_tokens or self.max_tokens,
+        }
+        
+        # GPT-4-turbo及以上支持JSON模式
+        if json_mode and 'gpt-4' in self.chat_model:
+            kwargs["response_format"] = {"type": "json_object"}
+        
+        return kwargs
+    
+    async def _ensure_async_clients(self):
+        """
+        为当前事件循环创建连接池客户端和并发信号量
+        
+        httpx连接池和asyncio信号量都绑定到事件循环，循环变化（如多次asyncio.run）时重新创建，
+        并关闭上一个循环留下的客户端，避免连接池泄漏
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_loop is loop:
+            return
+        
+        # 先同步换上新客户端（期间不让出控制权，并发协程不会看到半初始化的状态），再关闭旧客户端
+        stale_clients = (self._async_openai_client, self._async_http_client)
+        self._async_openai_client = None
+        self._async_http_client = None
+        self._async_loop = loop
+        openai_config = self.config.get('openai', {})
+        
+        if AsyncOpenAI is not None:
+            # AsyncOpenAI内部使用httpx连接池（keep-alive）
+            self._async_openai_client = AsyncOpenAI(
+                api_key=openai_config.get('api_key', ''),
+                base_url=openai_config.get('api_base', 'https://api.openai.com/v1'),
+                max_retries=0
+            )
+        
+        gemini_concurrency = self.gemini_config.get('max_concurrency', 8)
+        if httpx is not None:
+            self._async_http_client = httpx.AsyncClient(
+                timeout=60.0,
+                limits=httpx.Limits(
+                    max_connections=gemini_concurrency,
+                    max_keepalive_connections=gemini_concurrency
+                )
+            )
+        
+        self._semaphores = {
+            'openai': asyncio.Semaphore(openai_config.get('max_concurrency', 8)),
+            'gemini': asyncio.Semaphore(gemini_concurrency)
+        }
+        
+        await self._close_async_clients(*stale_clients)
+    
+    @staticmethod
+    async def _close_async_clients(openai_client, http_client):
+        """
+        关闭异步客户端的连接池（客户端所属的事件循环已结束时，关闭失败只记录不抛出）
+        
+        Args:
+            openai_client: AsyncOpenAI客户端或None
+            http_client: httpx.AsyncClient或None
+        """
+        for client, close_method in ((openai_client, 'close'), (http_client, 'aclose')):
+            if client is None:
+                continue
+            try:
+                await getattr(client, close_method)()
+            except Exception as e:
+                print(f"关闭异步客户端失败: {e}")
+    
+    async def achat(
+        self,
+        prompt: str,
+        system_message: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        json_mode: bool = False,
+        use_cache: bool = True
+    ) -> str:
+        """
+        异步调用Chat API（复用连接池，受openai.max_concurrency限制）
+        
+        Args:
+            prompt: 用户提示
+            system_message: 系统消息
+            temperature: 温度参数
+            max_tokens: 最大token数
+            json_mode: 是否使用JSON模式
+            use_cache: 是否使用回复缓存
             
+        Returns:
+            LLM回复，失败返回空字符串
+        """
+        if AsyncOpenAI is None:
+            # 旧版SDK没有异步客户端，在线程池中执行同步调用
+            return await asyncio.to_thread(
+                self.chat, prompt, system_message, temperature, max_tokens, json_mode, use_cache
+            )
+        
+        kwargs = self._chat_kwargs(prompt, system_message, temperature, max_tokens, json_mode)
+        
+        cache_key = self._chat_cache_key(kwargs, prompt, system_message, json_mode) if use_cache else None
+        if cache_key:
+            cached = self.chat_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        await self._ensure_async_clients()
+        estimated = self._estimate_chat_tokens(kwargs)
+        try:
+            async with self._semaphores['openai']:
+                response = await self.chat_limiter.acall(
+                    self._async_openai_client.chat.completions.create, tokens=estimated, **kwargs
+                )
+            self._record_chat_usage(response, estimated)
+            content = response.choices[0].message.content
         except Exception as e:
             print(f"LLM调用失败: {e}")
             return ""
+        
+        if cache_key and self._cacheable(content, json_mode):
+            self.chat_cache.put(cache_key, self.chat_model, content)
+        
+        return content
+    
+    async def aembed(self, text: str) -> Optional[list]:
+        """
+        异步生成文本的embedding（使用缓存，受对应provider的max_concurrency限制）
+        
+        Args:
+            text: 输入文本
+            
+        Returns:
+            Embedding向量
+        """
+        model = self.embedding_model
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.get(model, text)
+            if cached is not None:
+                return cached
+        
+        await self._ensure_async_clients()
+        if self.use_gemini_embedding:
+            embedding = await self._aembed_with_gemini(text)
+        else:
+            embedding = await self._aembed_with_openai(text)
+        
+        if self.embedding_cache is not None and embedding is not None:
+            self.embedding_cache.put(model, text, embedding)
+        
+        return embedding
+    
+    async def _aembed_with_openai(self, text: str) -> Optional[list]:
+        """
+        使用OpenAI API异步生成embedding
+        
+        Args:
+            text: 输入文本
+            
+        Returns:
+            Embedding向量
+        """
+        if self._async_openai_client is None:
+            return await asyncio.to_thread(self._embed_with_openai, text)
+        
+        try:
+            async with self._semaphores['openai']:
+                response = await self.embedding_limiter.acall(
+                    self._async_openai_client.embeddings.create,
+                    tokens=estimate_tokens(text),
+                    model=self.embedding_model,
+                    input=text
+                )
+            return response.data[0].embedding
+        except Exception as e:
+            print(f"OpenAI Embedding生成失败: {e}")
+            return None
+    
+    async def _aembed_with_gemini(self, text: str) -> Optional[list]:
+        """
+        使用Gemini API异步生成embedding（与同步版本请求相同的端点）
+        
+        Args:
+            text: 输入文本
+            
+        Returns:
+            Embedding向量
+        """
+        if self._async_http_client is None:
+            return await asyncio.to_thread(self._embed_with_gemini, text)
+        
+        try:
+            api_key = self.gemini_config.get('api_key', '')
+            api_base = self.gemini_config.get('api_base', 'https://xiaoai.plus/v1')
+            
+            parsed_url = urllib.parse.urlparse(api_base)
+            path = parsed_url.path if parsed_url.path else '/v1/embeddings'
+            url = f"https://{parsed_url.netloc}{path}"
+            
+            async def post():
+                response = await self._async_http_client.post(
+                    url,
+                    json={
+                        "input": text,
+                        "model": self.embedding_model,
+                        "encoding_format": "float"
+                    },
+                    headers={'Authorization': f'Bearer {api_key}'}
+                )
+                if response.status_code in RETRYABLE_STATUS_CODES:
+                    raise HTTPStatusError(
+                        response.status_code, response.text,
+                        parse_retry_after(response.headers.get('retry-after'))
+                    )
+                return response
+            
+            async with self._semaphores['gemini']:
+                response = await self.embedding_limiter.acall(post, tokens=estimate_tokens(text))
+            response_json = response.json()
+            
+            if 'data' in response_json and len(response_json['data']) > 0:
+                return response_json['data'][0]['embedding']
+            else:
+                print(f"Gemini API返回格式错误: {response_json}")
+                return None
+        except Exception as e:
+            print(f"Gemini Embedding生成失败: {e}")
+            return None
+    
+    async def aclose(self):
+        """关闭异步连接池"""
+        stale_clients = (self._async_openai_client, self._async_http_client)
+        self._async_loop = None
+        self._async_openai_client = None
+        self._async_http_client = None
+        await self._close_async_clients(*stale_clients)
     
     def parse_json_response(self, response: str) -> Optional[Dict[str, Any]]:
         """
@@ -171,12 +574,82 @@ class LLMClient:
         Returns:
             Embedding向量
         """
+        model = self.embedding_model
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.get(model, text)
+            if cached is not None:
+                return cached
+        
         # 优先使用Gemini API（如果配置了）
         if self.use_gemini_embedding:
-            return self._embed_with_gemini(text)
+            embedding = self._embed_with_gemini(text)
         else:
             # 使用OpenAI API
-            return self._embed_with_openai(text)
+            embedding = self._embed_with_openai(text)
+        
+        if self.embedding_cache is not None and embedding is not None:
+            self.embedding_cache.put(model, text, embedding)
+        
+        return embedding
+    
+    @property
+    def embedding_model(self) -> str:
+        """当前使用的embedding模型名（缓存键的一部分）"""
+        if self.use_gemini_embedding:
+            return self.gemini_config.get('embedding_model', 'gemini-embedding-001')
+        return self.config.get('openai', {}).get('embedding_model', 'text-embedding-3-large')
+    
+    def embed_batch(
+        self,
+        texts: List[str],
+        batch_size: Optional[int] = None
+    ) -> List[Optional[list]]:
+        """
+        批量生成embedding（每个请求携带多条输入）
+        
+        先查缓存，只对未命中的文本（去重后）分批请求；重试由embedding限流器负责，仍失败的批次对应位置为None
+        
+        Args:
+            texts: 输入文本列表
+            batch_size: 每个请求的文本数，默认读取配置 embedding_batch_size
+            
+        Returns:
+            与输入一一对应的embedding列表
+        """
+        if not texts:
+            return []
+        
+        model = self.embedding_model
+        if batch_size is None:
+            provider_config = self.gemini_config if self.use_gemini_embedding else self.config.get('openai', {})
+            batch_size = provider_config.get('embedding_batch_size', 64)
+        
+        if self.embedding_cache is not None:
+            results = self.embedding_cache.get_many(model, texts)
+        else:
+            results = [None] * len(texts)
+        
+        # 未命中的文本去重后分批请求
+        pending = list(dict.fromkeys(text for text, vector in zip(texts, results) if vector is None))
+        computed: Dict[str, list] = {}
+        
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            
+            if self.use_gemini_embedding:
+                embeddings = self._embed_batch_with_gemini(chunk)
+            else:
+                embeddings = self._embed_batch_with_openai(chunk)
+            
+            if embeddings is None:
+                print(f"Embedding批次 {start // batch_size + 1} 重试后仍失败，跳过 {len(chunk)} 条文本")
+                continue
+            
+            computed.update(zip(chunk, embeddings))
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(model, chunk, embeddings)
+        
+        return [vector if vector is not None else computed.get(text) for text, vector in zip(texts, results)]
     
     def _embed_with_openai(self, text: str) -> Optional[list]:
         """
@@ -188,23 +661,43 @@ class LLMClient:
         Returns:
             Embedding向量
         """
+        embeddings = self._embed_batch_with_openai([text])
+        return embeddings[0] if embeddings else None
+    
+    def _embed_batch_with_openai(self, texts: List[str]) -> Optional[List[list]]:
+        """
+        使用OpenAI API批量生成embedding
+        
+        Args:
+            texts: 输入文本列表
+            
+        Returns:
+            与输入顺序一致的Embedding列表，失败返回None
+        """
         embedding_model = self.config.get('openai', {}).get('embedding_model', 'text-embedding-3-large')
         
+        estimated = sum(estimate_tokens(text) for text in texts)
         try:
             if self.use_new_api:
                 # 新API
-                response = self.openai_client.embeddings.create(
+                response = self.embedding_limiter.call(
+                    self.openai_client.embeddings.create,
+                    tokens=estimated,
                     model=embedding_model,
-                    input=text
+                    input=texts
                 )
-                return response.data[0].embedding
+                data = sorted(response.data, key=lambda item: item.index)
+                return [item.embedding for item in data]
             else:
                 # 旧API
-                response = openai.Embedding.create(
+                response = self.embedding_limiter.call(
+                    openai.Embedding.create,
+                    tokens=estimated,
                     model=embedding_model,
-                    input=text
+                    input=texts
                 )
-                return response['data'][0]['embedding']
+                data = sorted(response['data'], key=lambda item: item['index'])
+                return [item['embedding'] for item in data]
         except Exception as e:
             print(f"OpenAI Embedding生成失败: {e}")
             return None
@@ -219,6 +712,19 @@ class LLMClient:
         Returns:
             Embedding向量
         """
+        embeddings = self._embed_batch_with_gemini([text])
+        return embeddings[0] if embeddings else None
+    
+    def _embed_batch_with_gemini(self, texts: List[str]) -> Optional[List[list]]:
+        """
+        使用Gemini API批量生成embedding
+        
+        Args:
+            texts: 输入文本列表
+            
+        Returns:
+            与输入顺序一致的Embedding列表，失败返回None
+        """
         try:
             # 获取Gemini配置
             api_key = self.gemini_config.get('api_key', '')
@@ -230,15 +736,13 @@ class LLMClient:
                 return None
             
             # 解析API端点
-            import urllib.parse
             parsed_url = urllib.parse.urlparse(api_base)
             host = parsed_url.netloc
             path = parsed_url.path if parsed_url.path else '/v1/embeddings'
             
             # 准备请求
-            import json
             payload = json.dumps({
-                "input": text,
+                "input": texts,
                 "model": embedding_model,
                 "encoding_format": "float"
             })
@@ -248,17 +752,29 @@ class LLMClient:
                 'Content-Type': 'application/json'
             }
             
-            # 发送请求
-            conn = http.client.HTTPSConnection(host)
-            conn.request("POST", path, payload, headers)
-            res = conn.getresponse()
-            data = res.read()
-            conn.close()
+            # 发送请求（限流和服务端错误抛出异常交给限流器重试）
+            def post() -> bytes:
+                conn = http.client.HTTPSConnection(host)
+                try:
+                    conn.request("POST", path, payload, headers)
+                    res = conn.getresponse()
+                    body = res.read()
+                    if res.status in RETRYABLE_STATUS_CODES:
+                        raise HTTPStatusError(
+                            res.status, body.decode('utf-8', 'replace'),
+                            parse_retry_after(res.getheader('retry-after'))
+                        )
+                    return body
+                finally:
+                    conn.close()
+            
+            data = self.embedding_limiter.call(post, tokens=sum(estimate_tokens(text) for text in texts))
             
             response_json = json.loads(data.decode("utf-8"))
             
-            if 'data' in response_json and len(response_json['data']) > 0:
-                return response_json['data'][0]['embedding']
+            if 'data' in response_json and len(response_json['data']) == len(texts):
+                items = sorted(response_json['data'], key=lambda item: item.get('index', 0))
+                return [item['embedding'] for item in items]
             else:
                 print(f"Gemini API返回格式错误: {response_json}")
                 return None
@@ -3,8 +3,9 @@
 使用LLM将用户需求分解为原子需求
 """
 
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Optional, Tuple
 from .data_structures import AtomicNeed, DecomposedNeeds
+from .json_stream import IncrementalJSONParser
 from .llm_client import LLMClient
 from .utils import generate_need_id
 import prompts
@@ -13,21 +14,29 @@ import prompts
 class NeedDecomposer:
     """需求分解器"""
     
-    def __init__(self, llm_client: LLMClient):
+    def __init__(self, llm_client: LLMClient, streaming: bool = False):
         """
         初始化需求分解器
         
         Args:
             llm_client: LLM客户端
+            streaming: 是否流式调用LLM，每个原子需求一生成完就通过on_need回调交给下游
         """
         self.llm = llm_client
+        self.streaming = streaming
     
-    def decompose(self, user_request: str) -> DecomposedNeeds:
+    def decompose(
+        self,
+        user_request: str,
+        on_need: Optional[Callable[[AtomicNeed], None]] = None
+    ) -> DecomposedNeeds:
         """
         分解用户需求
         
         Args:
             user_request: 用户需求文本
+            on_need: 流式模式下每解析出一个原子需求就调用一次（早于整个回复结束），
+                回调收到的对象与返回结果中的对象相同
             
         Returns:
             分解后的需求
@@ -38,9 +47,7 @@ class NeedDecomposer:
         )
         
         # 调用LLM
-        response = self.llm.chat(
-            prompt=prompt,
-            system_message="""
+        system_message = """
             # 角色定义
 你是一个能够对用户自然语言需求进行任务分解的智能系统。
 你的目标是将复杂的用户意图拆解为若干可独立执行的原子需求（AtomicNeed），
@@ -253,9 +260,17 @@ Since the second task operates directly on the output of the first, the dependen
 
 # 现在请根据以上规则，对以下用户需求进行任务分解：
 
-            """,
-            json_mode=False
-        )
+            """
+        
+        if self.streaming:
+            response, streamed_needs = self._chat_streaming(prompt, system_message, on_need)
+        else:
+            response = self.llm.chat(
+                prompt=prompt,
+                system_message=system_message,
+                json_mode=False
+            )
+            streamed_needs = []
 
         # 解析响应
         parsed = self.llm.parse_json_response(response)
@@ -263,19 +278,11 @@ Since the second task operates directly on the output of the first, the dependen
             print("需求分解失败，使用默认单一需求")
             return self._fallback_decomposition(user_request)
         
-        # 构建AtomicNeed对象
-        atomic_needs = []
-        for need_data in parsed['atomic_needs']:
-            atomic_need = AtomicNeed(
-                need_id=need_data.get('need_id', generate_need_id()),
-                description=need_data.get('description', ''),
-                category=need_data.get('category', 'unknown'),
-                modality=need_data.get('modality', 'image'),
-                priority=need_data.get('priority', 5),
-                dependencies=need_data.get('dependencies', []),
-                constraints=need_data.get('constraints', {})
-            )
-            atomic_needs.append(atomic_need)
+        # 构建AtomicNeed对象（流式阶段已构建的直接复用，保证与回调拿到的是同一批对象）
+        if streamed_needs and len(streamed_needs) == len(parsed['atomic_needs']):
+            atomic_needs = streamed_needs
+        else:
+            atomic_needs = [self._build_atomic_need(need_data) for need_data in parsed['atomic_needs']]
         
         # 构建依赖图
         dependency_graph = self._build_dependency_graph(atomic_needs)
@@ -292,6 +299,57 @@ Since the second task operates directly on the output of the first, the dependen
 
         return DecomposedReqs
     
+    def _chat_streaming(
+        self,
+        prompt: str,
+        system_message: str,
+        on_need: Optional[Callable[[AtomicNeed], None]]
+    ) -> Tuple[str, List[AtomicNeed]]:
+        """
+        流式调用LLM，atomic_needs数组中的元素一闭合就构建AtomicNeed并回调
+        
+        Args:
+            prompt: 用户提示
+            system_message: 系统消息
+            on_need: 原子需求回调
+            
+        Returns:
+            (完整回复, 流式阶段构建的原子需求列表)
+        """
+        parser = IncrementalJSONParser()
+        streamed_needs = []
+        
+        for chunk in self.llm.chat_stream(prompt=prompt, system_message=system_message, json_mode=False):
+            for path, value in parser.feed(chunk):
+                if path[0] != 'atomic_needs' or len(path) != 2 or not isinstance(value, dict):
+                    continue
+                atomic_need = self._build_atomic_need(value)
+                streamed_needs.append(atomic_need)
+                if on_need is not None:
+                    on_need(atomic_need)
+        
+        return parser.buffer, streamed_needs
+    
+    def _build_atomic_need(self, need_data: Dict[str, Any]) -> AtomicNeed:
+        """
+        从LLM输出的字典构建原子需求
+        
+        Args:
+            need_data: 单个原子需求的JSON对象
+            
+        Returns:
+            原子需求
+        """
+        return AtomicNeed(
+            need_id=need_data.get('need_id', generate_need_id()),
+            description=need_data.get('description', ''),
+            category=need_data.get('category', 'unknown'),
+            modality=need_data.get('modality', 'image'),
+            priority=need_data.get('priority', 5),
+            dependencies=need_data.get('dependencies', []),
+            constraints=need_data.get('constraints', {})
+        )
+    
     def _fallback_decomposition(self, user_request: str) -> DecomposedNeeds:
         """
         回退方案：将整个需求作为单一原子需求
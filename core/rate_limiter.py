@@ -0,0 +1,392 @@
+"""
+限流模块
+按端点共享的令牌桶限流（请求数/分钟 + token数/分钟）+ 带抖动的指数退避重试（遵守Retry-After）
+"""
+
+import asyncio
+import random
+import threading
+import time
+from typing import Dict, Any, Optional, Callable
+
+
+# 可重试的HTTP状态码：限流和服务端错误
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# 网络层可重试的异常类名（避免直接依赖openai/requests/httpx）
+RETRYABLE_ERROR_NAMES = {
+    'APIConnectionError', 'APITimeoutError', 'ConnectTimeout', 'ReadTimeout',
+    'ConnectError', 'ConnectionError', 'Timeout', 'RemoteDisconnected'
+}
+
+
+class HTTPStatusError(Exception):
+    """非2xx的HTTP响应（用于没有自带异常的http.client/requests调用）"""
+    
+    def __init__(self, status_code: int, message: str = '', retry_after: Optional[float] = None):
+        super().__init__(f"HTTP {status_code}: {message[:200]}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的token数（中文约1字1token，英文约4字符1token，这里取折中）
+    
+    Args:
+        text: 文本
+    
+    Returns:
+        估算的token数
+    """
+    return max(1, len(text or '') // 2)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析Retry-After头（只支持秒数格式）
+    
+    Args:
+        value: 头部值
+    
+    Returns:
+        秒数，无法解析返回None
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """从各种HTTP客户端异常中提取状态码"""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        response = getattr(error, 'response', None)
+        status = getattr(response, 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def retry_after_from_error(error: Exception) -> Optional[float]:
+    """
+    从异常中提取服务端要求的等待时间
+    
+    Args:
+        error: 异常
+    
+    Returns:
+        秒数，没有Retry-After时返回None
+    """
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        return retry_after
+    
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers is None:
+        return None
+    
+    # retry-after-ms（OpenAI）优先于retry-after
+    retry_after_ms = parse_retry_after(headers.get('retry-after-ms'))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000.0
+    return parse_retry_after(headers.get('retry-after'))
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    判断异常是否值得重试（限流、服务端错误、网络错误）
+    
+    Args:
+        error: 异常
+    
+    Returns:
+        是否可重试
+    """
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+class TokenBucket:
+    """令牌桶（线程安全，允许单次消耗超过桶容量时透支）"""
+    
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        """
+        初始化令牌桶
+        
+        Args:
+            per_minute: 每分钟补充的令牌数
+            capacity: 桶容量（允许的突发量），默认为10秒的配额
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or max(1.0, per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self, now: float):
+        """按经过的时间补充令牌（调用方持有锁）"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def reserve(self, amount: float) -> float:
+        """
+        尝试取出令牌
+        
+        Args:
+            amount: 令牌数
+        
+        Returns:
+            0表示已取出；否则为需要等待的秒数（未取出）
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            # 超过容量的请求等桶满后透支，避免永远等不到
+            needed = min(amount, self.capacity)
+            if self.tokens >= needed:
+                self.tokens -= amount
+                return 0.0
+            return (needed - self.tokens) / self.rate
+    
+    def debit(self, amount: float):
+        """
+        直接扣除令牌（可为负数表示退还），用于按实际用量修正预估
+        
+        Args:
+            amount: 令牌数
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter:
+    """单个端点的限流器（请求数/token数令牌桶 + 退避重试）"""
+    
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0
+    ):
+        """
+        初始化限流器
+        
+        Args:
+            name: 端点名（日志用）
+            requests_per_minute: 每分钟请求数上限，None表示不限
+            tokens_per_minute: 每分钟token数上限，None表示不限
+            max_retries: 可重试错误的最大重试次数
+            base_delay: 指数退避的初始等待秒数
+            max_delay: 单次退避的最大等待秒数
+        """
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        
+        # 收到429后所有调用方一起暂停到这个时间点
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        
+        # 统计
+        self.retries = 0
+        self.throttled_seconds = 0.0
+    
+    def _wait_time(self, tokens: int) -> float:
+        """
+        计算还需等待的时间，为0时已占用配额
+        
+        Args:
+            tokens: 本次请求预估的token数
+        
+        Returns:
+            需要等待的秒数
+        """
+        with self._lock:
+            blocked = self._blocked_until - time.monotonic()
+        if blocked > 0:
+            return blocked
+        
+        if self.request_bucket:
+            wait = self.request_bucket.reserve(1)
+            if wait > 0:
+                return wait
+        if self.token_bucket and tokens:
+            wait = self.token_bucket.reserve(tokens)
+            if wait > 0:
+                # 请求配额已占用，token不足时退还
+                if self.request_bucket:
+                    self.request_bucket.debit(-1)
+                return wait
+        return 0.0
+    
+    def acquire(self, tokens: int = 0):
+        """
+        阻塞直到配额可用
+        
+        Args:
+            tokens: 本次请求预估的token数
+        """
+        while True:
+            wait = self._wait_time(tokens)
+            if wait <= 0:
+                return
+            self.throttled_seconds += wait
+            time.sleep(wait)
+    
+    async def aacquire(self, tokens: int = 0):
+        """
+        异步等待直到配额可用
+        
+        Args:
+            tokens: 本次请求预估的token数
+        """
+        while True:
+            wait = self._wait_time(tokens)
+            if wait <= 0:
+                return
+            self.throttled_seconds += wait
+            await asyncio.sleep(wait)
+    
+    def record_usage(self, actual_tokens: int, estimated_tokens: int):
+        """
+        按实际用量修正token桶（预估偏少时补扣，偏多时退还）
+        
+        Args:
+            actual_tokens: 实际消耗的token数
+            estimated_tokens: 请求前预估的token数
+        """
+        if self.token_bucket and actual_tokens:
+            self.token_bucket.debit(actual_tokens - estimated_tokens)
+    
+    def backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        计算退避时间：有Retry-After时遵守，否则为带抖动的指数退避
+        
+        Args:
+            attempt: 第几次重试（从0开始）
+            retry_after: 服务端要求的等待秒数
+        
+        Returns:
+            等待秒数
+        """
+        if retry_after is not None:
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay / 2)
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+    
+    def _on_error(self, error: Exception, attempt: int) -> float:
+        """
+        处理一次失败，返回重试前的等待时间；不可重试或重试次数用尽时重新抛出
+        
+        Args:
+            error: 异常
+            attempt: 第几次重试（从0开始）
+        
+        Returns:
+            等待秒数
+        """
+        if attempt >= self.max_retries or not is_retryable(error):
+            raise error
+        
+        delay = self.backoff_delay(attempt, retry_after_from_error(error))
+        if _status_code(error) == 429:
+            # 端点级限流：让共享该端点的所有调用方一起暂停
+            with self._lock:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        
+        self.retries += 1
+        self.throttled_seconds += delay
+        print(f"[RateLimiter] {self.name} 调用失败({error})，{delay:.1f}秒后第{attempt + 1}次重试")
+        return delay
+    
+    def call(self, func: Callable, *args, tokens: int = 0, **kwargs):
+        """
+        在限流和重试保护下调用函数
+        
+        Args:
+            func: 发起请求的函数
+            tokens: 本次请求预估的token数
+        
+        Returns:
+            函数返回值（重试用尽后抛出最后一次异常）
+        """
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                time.sleep(self._on_error(e, attempt))
+                attempt += 1
+    
+    async def acall(self, func: Callable, *args, tokens: int = 0, **kwargs):
+        """
+        在限流和重试保护下调用协程函数
+        
+        Args:
+            func: 返回协程的函数
+            tokens: 本次请求预估的token数
+        
+        Returns:
+            协程返回值（重试用尽后抛出最后一次异常）
+        """
+        attempt = 0
+        while True:
+            await self.aacquire(tokens)
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                await asyncio.sleep(self._on_error(e, attempt))
+                attempt += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取限流统计
+        
+        Returns:
+            {'retries', 'throttled_seconds'}
+        """
+        return {'retries': self.retries, 'throttled_seconds': round(self.throttled_seconds, 2)}
+
+
+# 进程内按端点共享的限流器
+_rate_limiters: Dict[str, RateLimiter] = {}
+_registry_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str, config: Optional[Dict[str, Any]] = None) -> RateLimiter:
+    """
+    获取端点共享的限流器（同名端点只创建一次，所有客户端共用配额）
+    
+    Args:
+        name: 端点名，如 "chat"、"embedding"、"rerank"
+        config: 限流配置（requests_per_minute/tokens_per_minute/max_retries/base_delay/max_delay），
+            仅在首次创建时生效
+    
+    Returns:
+        限流器
+    """
+    with _registry_lock:
+        if name not in _rate_limiters:
+            config = config or {}
+            _rate_limiters[name] = RateLimiter(
+                name=name,
+                requests_per_minute=config.get('requests_per_minute'),
+                tokens_per_minute=config.get('tokens_per_minute'),
+                max_retries=config.get('max_retries', 5),
+                base_delay=config.get('base_delay', 1.0),
+                max_delay=config.get('max_delay', 60.0)
+            )
+        return _rate_limiters[name]
@@ -264,6 +264,19 @@ def type_compatible(type1: str, type2: str) -> bool:
     return False
 
 
+def fragment_embedding_text(fragment) -> str:
+    """
+    片段用于生成embedding的文本（有描述时用描述，否则用代码本身）
+    
+    Args:
+        fragment: 工作流片段
+        
+    Returns:
+        文本
+    """
+    return fragment.description or fragment.code
+
+
 def generate_fragment_id() -> str:
     """生成唯一的片段ID"""
     import uuid
@@ -314,3 +327,36 @@ def load_json(file_path: str) -> Dict[str, Any]:
     """加载JSON文件"""
     with open(file_path, 'r', encoding='utf-8') as f:
         return json.load(f)
+
+
+def workflow_node_types(entry) -> List[str]:
+    """
+    工作流中的节点类型（按需加载的条目使用入库时保存的结果，不加载工作流JSON）
+    
+    Args:
+        entry: 工作流条目
+    
+    Returns:
+        节点类型列表
+    """
+    node_types = getattr(entry, 'node_types', None)
+    if node_types is not None:
+        return node_types
+    return extract_node_types_from_json(entry.workflow_json)
+
+
+def workflow_code_hash(entry) -> str:
+    """
+    工作流代码的内容哈希（按需加载的条目使用入库时保存的结果，不加载代码）
+    
+    Args:
+        entry: 工作流条目
+    
+    Returns:
+        sha256十六进制摘要
+    """
+    code_hash = getattr(entry, 'code_hash', None)
+    if code_hash is not None:
+        return code_hash
+    from .cache import content_hash
+    return content_hash(entry.workflow_code)
@@ -3,10 +3,20 @@
 基于FAISS的向量检索 + Reranker重排序
 """
 
-from typing import List, Dict, Any, Optional, Tuple
+import json
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Callable, Set, Sequence
 import numpy as np
-from .data_structures import WorkflowEntry, AtomicNeed
+from .data_structures import WorkflowEntry, AtomicNeed, WorkflowFragment
 from .llm_client import LLMClient
+from .lexical_search import BM25Index, reciprocal_rank_fusion
+from .cross_encoder import LocalCrossEncoder
+from .cache import RerankCache
+from .rate_limiter import get_rate_limiter, parse_retry_after, HTTPStatusError, RETRYABLE_STATUS_CODES
+from .utils import save_json, load_json
 
 try:
     import faiss
@@ -15,32 +25,345 @@ except ImportError:
     faiss = None
 
 import requests
-import json as json_module
+from requests.adapters import HTTPAdapter
 
 
 class VectorIndex:
     """向量索引管理器"""
     
-    def __init__(self, dimension: int = 3072):
+    # 支持的索引类型
+    INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+    
+    # 支持的相似度度量
+    METRICS = ('l2', 'cosine')
+    
+    # 追加日志文件后缀及记录类型
+    DELTA_SUFFIX = '.delta'
+    DELTA_OP_ADD = 1
+    DELTA_OP_REMOVE = 2
+    
+    # HNSW不支持物理删除，墓碑比例超过该值时需要重建
+    MAX_TOMBSTONE_RATIO = 0.2
+    
+    # ID映射文件后缀（二进制 / 旧版json）
+    IDS_SUFFIX = '.ids.npy'
+    LEGACY_MAPPING_SUFFIX = '.mapping.json'
+    # 训练信息文件后缀（IVF索引训练时的样本数）
+    TRAIN_INFO_SUFFIX = '.train.json'
+    
+    # 每个聚类中心（及每个PQ码字）至少需要的训练样本数（FAISS低于该值时会警告聚类质量差）
+    MIN_POINTS_PER_CENTROID = 39
+    # IVF索引的向量数增长到训练样本数的该倍数时重新训练
+    RETRAIN_GROWTH_FACTOR = 2
+    
+    def __init__(
+        self,
+        dimension: int = 3072,
+        index_type: str = 'flat',
+        metric: str = 'l2',
+        nlist: int = 100,
+        nprobe: int = 8,
+        pq_m: int = 64,
+        pq_nbits: int = 8,
+        hnsw_m: int = 32,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+        use_mmap: bool = False
+    ):
         """
         初始化向量索引
         
         Args:
             dimension: 向量维度（OpenAI text-embedding-3-large为3072）
+            index_type: 索引类型（flat / ivf_flat / ivf_pq / hnsw）
+            metric: 相似度度量（l2 / cosine，cosine会归一化向量并使用内积索引）
+            nlist: IVF聚类中心数量
+            nprobe: IVF检索时访问的聚类数量
+            pq_m: PQ子向量数量（需整除dimension）
+            pq_nbits: PQ每个子向量的编码位数
+            hnsw_m: HNSW每个节点的邻居数量
+            ef_construction: HNSW构建时的搜索宽度
+            ef_search: HNSW检索时的搜索宽度
+            use_mmap: 加载时是否以内存映射方式读取索引文件
         """
         self.dimension = dimension
         
         if faiss is None:
             raise ImportError("请安装faiss: pip install faiss-cpu")
         
-        # 使用L2距离的索引
-        self.index = faiss.IndexFlatL2(dimension)
+        if index_type not in self.INDEX_TYPES:
+            raise ValueError(f"不支持的索引类型: {index_type}，可选: {', '.join(self.INDEX_TYPES)}")
+        if metric not in self.METRICS:
+            raise ValueError(f"不支持的相似度度量: {metric}，可选: {', '.join(self.METRICS)}")
+        if index_type == 'ivf_pq' and dimension % pq_m != 0:
+            raise ValueError(f"pq_m={pq_m} 必须整除向量维度 {dimension}")
+        
+        self.index_type = index_type
+        self.metric = metric
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.use_mmap = use_mmap
+        
+        self.index = self._build_index(index_type)
+        self._mmapped = False
+        # 当前IVF索引训练时使用的样本数（未训练或无需训练时为0）
+        self.trained_size = 0
+        
+        # ID映射（索引ID单调递增、删除后不复用，因此与向量在索引中的物理位置无关）
+        self.id_to_workflow = {}  # {索引ID: workflow_id}
+        self.workflow_to_id = {}  # {workflow_id: 索引ID}
         
-        # ID映射
-        self.id_to_workflow = {}  # {索引位置: workflow_id}
-        self.workflow_to_id = {}  # {workflow_id: 索引位置}
+        self.current_index = 0  # 下一个可分配的索引ID
+        
+        # 尚未持久化的变更 [(记录类型, workflow_id, 预处理后的向量或None)]
+        self._pending: List[Tuple[int, str, Optional[np.ndarray]]] = []
+        # 追加日志中的记录数（压缩后清零）
+        self.delta_count = 0
+    
+    def _build_index(self, index_type: str):
+        """
+        创建指定类型的空FAISS索引
+        
+        IVF索引原生支持自定义ID和删除；flat/hnsw外包IndexIDMap2以支持自定义ID
+        
+        Args:
+            index_type: 索引类型
+            
+        Returns:
+            FAISS索引
+        """
+        metric_type = self._faiss_metric()
+        
+        if index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(self.dimension, self.hnsw_m, metric_type)
+            index.hnsw.efConstruction = self.ef_construction
+        elif index_type == 'ivf_flat':
+            quantizer = faiss.IndexFlat(self.dimension, metric_type)
+            index = faiss.IndexIVFFlat(quantizer, self.dimension, self.nlist, metric_type)
+        elif index_type == 'ivf_pq':
+            quantizer = faiss.IndexFlat(self.dimension, metric_type)
+            index = faiss.IndexIVFPQ(quantizer, self.dimension, self.nlist, self.pq_m, self.pq_nbits, metric_type)
+        else:
+            index = faiss.IndexFlat(self.dimension, metric_type)
+        
+        if not self._supports_ids(index):
+            index = faiss.IndexIDMap2(index)
+        
+        self._apply_search_params(index)
+        return index
+    
+    @staticmethod
+    def _base_index(index):
+        """去掉IndexIDMap包装后的底层索引"""
+        if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            return faiss.downcast_index(index.index)
+        return index
+    
+    @staticmethod
+    def _supports_ids(index) -> bool:
+        """索引是否支持自定义ID（IVF原生支持，其余需要IndexIDMap包装）"""
+        return isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexIVF))
+    
+    def _with_id_map(self, index):
+        """
+        将旧版按物理位置编号的flat/hnsw索引转换为IndexIDMap2（ID即原位置）
         
+        Args:
+            index: 从文件读取的索引
+            
+        Returns:
+            支持自定义ID的索引
+        """
+        print(f"[VectorIndex] 转换旧版索引为ID映射索引（{index.ntotal} 个向量）")
+        vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal else None
+        index.reset()
+        converted = faiss.IndexIDMap2(index)
+        if vectors is not None:
+            converted.add_with_ids(vectors, np.arange(len(vectors), dtype='int64'))
+        return converted
+    
+    def _faiss_metric(self) -> int:
+        """当前度量对应的FAISS度量类型"""
+        if self.metric == 'cosine':
+            return faiss.METRIC_INNER_PRODUCT
+        return faiss.METRIC_L2
+    
+    def _as_matrix(self, embeddings) -> np.ndarray:
+        """
+        转换为float32矩阵，cosine模式下按行L2归一化
+        
+        Args:
+            embeddings: 向量或向量列表
+            
+        Returns:
+            (n, dimension) 的float32矩阵
+        """
+        matrix = np.array(embeddings, dtype='float32').reshape(-1, self.dimension)
+        if self.metric == 'cosine':
+            faiss.normalize_L2(matrix)
+        return matrix
+    
+    def similarity(self, score: float) -> float:
+        """
+        将FAISS返回的原始分数转换为0-1相似度
+        
+        cosine模式下为截断到[0, 1]的余弦相似度；l2模式下为 1 / (1 + 距离)
+        
+        Args:
+            score: 内积或L2距离
+            
+        Returns:
+            0-1相似度
+        """
+        if self.metric == 'cosine':
+            return min(max(score, 0.0), 1.0)
+        return 1.0 / (1.0 + max(score, 0.0))
+    
+    def _apply_search_params(self, index):
+        """将nprobe/efSearch应用到索引上"""
+        index = self._base_index(index)
+        if isinstance(index, faiss.IndexIVF):
+            index.nprobe = self.nprobe
+        elif isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = self.ef_search
+    
+    def _search_parameters(self, selector):
+        """
+        构造带ID过滤器的搜索参数
+        
+        搜索参数会覆盖索引上的nprobe/efSearch，因此需要显式带上当前配置
+        
+        Args:
+            selector: FAISS IDSelector
+            
+        Returns:
+            FAISS搜索参数
+        """
+        index = self._base_index(self.index)
+        if isinstance(index, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=self.nprobe)
+        if isinstance(index, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.ef_search)
+        return faiss.SearchParameters(sel=selector)
+    
+    @property
+    def active_type(self) -> str:
+        """当前实际使用的索引类型（样本不足时可能退化为flat）"""
+        index = self._base_index(self.index)
+        if isinstance(index, faiss.IndexIVFPQ):
+            return 'ivf_pq'
+        if isinstance(index, faiss.IndexIVFFlat):
+            return 'ivf_flat'
+        if isinstance(index, faiss.IndexHNSW):
+            return 'hnsw'
+        return 'flat'
+    
+    @property
+    def tombstone_count(self) -> int:
+        """已删除但仍留在索引中的向量数（仅HNSW）"""
+        return self.index.ntotal - len(self.id_to_workflow)
+    
+    def min_train_size(self) -> int:
+        """训练当前配置的索引所需的最少向量数（每个聚类中心和PQ码字至少MIN_POINTS_PER_CENTROID个样本）"""
+        if self.index_type == 'ivf_flat':
+            return self.MIN_POINTS_PER_CENTROID * self.nlist
+        if self.index_type == 'ivf_pq':
+            return self.MIN_POINTS_PER_CENTROID * max(self.nlist, 2 ** self.pq_nbits)
+        return 0
+    
+    def needs_rebuild(self) -> bool:
+        """
+        当前索引是否需要按配置重建
+        
+        度量与配置不一致时总是需要重建；退化的flat索引在样本足够训练后需要升级；
+        IVF索引的向量数比训练时增长RETRAIN_GROWTH_FACTOR倍后需要重新训练；
+        配置变更后的其他类型索引总是需要重建；HNSW的墓碑过多时需要重建
+        """
+        if self.index.metric_type != self._faiss_metric():
+            return True
+        if self.tombstone_count > self.MAX_TOMBSTONE_RATIO * max(self.index.ntotal, 1):
+            return True
+        if self.active_type == self.index_type:
+            if self.active_type in ('ivf_flat', 'ivf_pq'):
+                return self.index.ntotal >= self.RETRAIN_GROWTH_FACTOR * max(self.trained_size, 1)
+            return False
+        if self.active_type == 'flat':
+            return self.index.ntotal >= self.min_train_size()
+        return True
+    
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """
+        调整检索参数（召回率与延迟的权衡）
+        
+        Args:
+            nprobe: IVF检索时访问的聚类数量
+            ef_search: HNSW检索时的搜索宽度
+        """
+        if nprobe is not None:
+            self.nprobe = nprobe
+        if ef_search is not None:
+            self.ef_search = ef_search
+        self._apply_search_params(self.index)
+    
+    def train(self, embeddings):
+        """
+        使用已有embedding训练索引（仅IVF类索引需要）
+        
+        样本不足时退化为flat索引，待库增长后通过rebuild升级
+        
+        Args:
+            embeddings: 训练向量矩阵 (n, dimension)
+        """
+        if self.index.is_trained:
+            return
+        self._train(self._as_matrix(embeddings))
+    
+    def _train(self, matrix: np.ndarray):
+        """使用已预处理的向量矩阵训练索引（flat/HNSW无需训练）"""
+        if self.index.is_trained:
+            return
+        if len(matrix) < self.min_train_size():
+            print(f"[VectorIndex] 训练样本不足 ({len(matrix)} < {self.min_train_size()})，"
+                  f"暂时使用flat索引代替 {self.index_type}")
+            self.index = self._build_index('flat')
+            self.trained_size = 0
+            return
+        
+        print(f"[VectorIndex] 训练 {self.index_type} 索引，样本数: {len(matrix)}")
+        self.index.train(matrix)
+        self.trained_size = len(matrix)
+    
+    def rebuild(self, workflows: List[WorkflowEntry]):
+        """
+        按配置的索引类型重建索引（训练 + 全量添加）
+        
+        Args:
+            workflows: 带embedding的工作流条目列表
+        """
+        workflows = [w for w in workflows if w.intent_embedding is not None]
+        
+        self.index = self._build_index(self.index_type)
+        self._mmapped = False
+        self.trained_size = 0
+        self.id_to_workflow = {}
+        self.workflow_to_id = {}
         self.current_index = 0
+        # 重建后需要全量保存，旧的追加记录不再有效
+        self._pending = []
+        
+        if not workflows:
+            return
+        
+        matrix = self._as_matrix([w.intent_embedding for w in workflows])
+        self._train(matrix)
+        self._add_vectors([w.workflow_id for w in workflows], matrix)
+        
+        print(f"[VectorIndex] 索引重建完成: {self.active_type}, {self.index.ntotal} 个向量")
     
     def add_workflow(self, workflow: WorkflowEntry):
         """
@@ -53,22 +376,87 @@ class VectorIndex:
             print(f"警告: 工作流 {workflow.workflow_id} 没有embedding")
             return
         
-        # 转换为numpy数组
-        embedding = np.array([workflow.intent_embedding], dtype='float32')
+        # 转换为numpy数组（cosine模式下归一化）
+        embedding = self._as_matrix(workflow.intent_embedding)
+        
+        # 已存在的工作流先删除旧向量
+        if workflow.workflow_id in self.workflow_to_id:
+            self.remove_workflow(workflow.workflow_id)
+        
+        self._add_vectors([workflow.workflow_id], embedding)
+        self._pending.append((self.DELTA_OP_ADD, workflow.workflow_id, embedding[0]))
+    
+    def replace_workflow(self, workflow: WorkflowEntry):
+        """
+        用工作流的新embedding替换索引中的旧向量（分配新的索引ID）
+        
+        Args:
+            workflow: 工作流条目
+        """
+        self.add_workflow(workflow)
+    
+    def remove_workflow(self, workflow_id: str) -> bool:
+        """
+        从索引中删除工作流
+        
+        Args:
+            workflow_id: 工作流ID
+            
+        Returns:
+            是否存在并已删除
+        """
+        if workflow_id not in self.workflow_to_id:
+            return False
+        
+        self._remove_vector(workflow_id)
+        self._pending.append((self.DELTA_OP_REMOVE, workflow_id, None))
+        return True
+    
+    def _remove_vector(self, workflow_id: str):
+        """
+        删除工作流的向量及映射
+        
+        HNSW不支持物理删除，只移除映射，向量作为墓碑在检索时过滤，重建时清理
+        
+        Args:
+            workflow_id: 工作流ID
+        """
+        label = self.workflow_to_id.pop(workflow_id)
+        del self.id_to_workflow[label]
+        
+        if self.active_type != 'hnsw':
+            self._ensure_writable()
+            self.index.remove_ids(np.array([label], dtype='int64'))
+    
+    def _add_vectors(self, workflow_ids: List[str], matrix: np.ndarray):
+        """
+        添加已预处理的向量并记录映射
+        
+        Args:
+            workflow_ids: 与矩阵行对应的workflow_id
+            matrix: 预处理后的向量矩阵
+        """
+        self._ensure_writable()
+        
+        # 未训练的索引先训练（样本不足时退化为flat）
+        if not self.index.is_trained:
+            self._train(matrix)
         
         # 添加到索引
-        self.index.add(embedding)
+        labels = np.arange(self.current_index, self.current_index + len(matrix), dtype='int64')
+        self.index.add_with_ids(matrix, labels)
         
         # 记录映射
-        self.id_to_workflow[self.current_index] = workflow.workflow_id
-        self.workflow_to_id[workflow.workflow_id] = self.current_index
-        
-        self.current_index += 1
+        for workflow_id, label in zip(workflow_ids, labels.tolist()):
+            self.id_to_workflow[label] = workflow_id
+            self.workflow_to_id[workflow_id] = label
+        self.current_index += len(matrix)
     
     def search(
         self,
         query_embedding: List[float],
-        top_k: int = 50
+        top_k: int = 50,
+        workflow_ids: Optional[Iterable[str]] = None
     ) -> List[Tuple[int, float]]:
         """
         搜索最相似的工作流
@@ -76,89 +464,562 @@ class VectorIndex:
         Args:
             query_embedding: 查询向量
             top_k: 返回数量
+            workflow_ids: 只在这些工作流中搜索，None表示不限制
             
         Returns:
-            [(索引位置, 距离)] 列表
+            [(索引ID, 距离)] 列表
         """
-        if self.index.ntotal == 0:
+        return self.search_batch([query_embedding], top_k, workflow_ids)[0]
+    
+    def search_batch(
+        self,
+        query_matrix,
+        top_k: int = 50,
+        workflow_ids: Optional[Iterable[str]] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        批量搜索（一次FAISS调用处理多个查询）
+        
+        指定workflow_ids时通过IDSelector在FAISS内部预过滤，只扫描候选集合
+        
+        Args:
+            query_matrix: 查询向量矩阵，形状为 (n, dimension)，也可以是向量列表
+            top_k: 每个查询的返回数量
+            workflow_ids: 只在这些工作流中搜索，None表示不限制
+            
+        Returns:
+            与查询一一对应的 [(索引ID, 距离)] 列表
+        """
+        if len(query_matrix) == 0:
             return []
+        query = self._as_matrix(query_matrix)
         
-        # 转换为numpy数组
-        query = np.array([query_embedding], dtype='float32')
+        if self.index.ntotal == 0:
+            return [[] for _ in range(len(query))]
         
-        # 搜索
-        distances, indices = self.index.search(query, min(top_k, self.index.ntotal))
+        if workflow_ids is None:
+            # 搜索（HNSW存在墓碑时多取一些，过滤后仍能凑够top_k）
+            k = min(top_k + self.tombstone_count, self.index.ntotal)
+            distances, indices = self.index.search(query, k)
+        else:
+            labels = [self.workflow_to_id[wid] for wid in workflow_ids if wid in self.workflow_to_id]
+            if not labels:
+                return [[] for _ in range(len(query))]
+            # 墓碑不在候选集合中，无需多取
+            k = min(top_k, len(labels))
+            selector = faiss.IDSelectorBatch(np.asarray(labels, dtype='int64'))
+            distances, indices = self.index.search(query, k, params=self._search_parameters(selector))
         
         # 返回结果
         results = []
-        for i, idx in enumerate(indices[0]):
-            if idx != -1:  # FAISS返回-1表示无结果
-                results.append((int(idx), float(distances[0][i])))
+        for row_distances, row_indices in zip(distances, indices):
+            row = []
+            for idx, distance in zip(row_indices, row_distances):
+                # FAISS返回-1表示无结果；不在映射中的是已删除的墓碑
+                if idx != -1 and int(idx) in self.id_to_workflow:
+                    row.append((int(idx), float(distance)))
+            results.append(row[:top_k])
         
         return results
     
     def get_workflow_id(self, index: int) -> Optional[str]:
         """
-        根据索引位置获取workflow_id
+        根据索引ID获取workflow_id
         
         Args:
-            index: 索引位置
+            index: 索引ID
             
         Returns:
             workflow_id或None
         """
         return self.id_to_workflow.get(index)
     
+    def has_pending(self) -> bool:
+        """是否有尚未持久化的变更"""
+        return bool(self._pending)
+    
+    def append_delta(self, file_path: str) -> int:
+        """
+        将尚未持久化的变更追加到日志文件（不重写整个索引）
+        
+        每条记录为: 类型(1字节) + id长度(2字节) + workflow_id [+ float32向量，仅新增记录]
+        
+        Args:
+            file_path: 索引文件路径（日志写入 file_path + DELTA_SUFFIX）
+            
+        Returns:
+            追加的记录数
+        """
+        if not self._pending:
+            return 0
+        
+        with open(file_path + self.DELTA_SUFFIX, 'ab') as f:
+            for op, workflow_id, vector in self._pending:
+                id_bytes = workflow_id.encode('utf-8')
+                f.write(struct.pack('<BH', op, len(id_bytes)))
+                f.write(id_bytes)
+                if op == self.DELTA_OP_ADD:
+                    f.write(np.asarray(vector, dtype='<f4').tobytes())
+        
+        count = len(self._pending)
+        self.delta_count += count
+        self._pending = []
+        return count
+    
+    def _replay_delta(self, file_path: str) -> int:
+        """
+        重放追加日志中的记录
+        
+        Args:
+            file_path: 索引文件路径
+            
+        Returns:
+            重放的记录数
+        """
+        delta_path = file_path + self.DELTA_SUFFIX
+        if not os.path.exists(delta_path):
+            return 0
+        
+        with open(delta_path, 'rb') as f:
+            data = f.read()
+        
+        vector_size = self.dimension * 4
+        header_size = struct.calcsize('<BH')
+        record_count = 0
+        # 连续的新增记录合并后批量添加
+        workflow_ids = []
+        vectors = []
+        offset = 0
+        while offset + header_size <= len(data):
+            op, id_length = struct.unpack_from('<BH', data, offset)
+            id_start = offset + header_size
+            record_end = id_start + id_length + (vector_size if op == self.DELTA_OP_ADD else 0)
+            if op not in (self.DELTA_OP_ADD, self.DELTA_OP_REMOVE) or record_end > len(data):
+                # 写入中断导致的残缺记录，忽略其后的内容
+                print(f"[VectorIndex] 追加日志在偏移 {offset} 处不完整，已忽略剩余内容")
+                break
+            
+            workflow_id = data[id_start:id_start + id_length].decode('utf-8')
+            if op == self.DELTA_OP_ADD:
+                if workflow_id in workflow_ids:
+                    self._flush_replayed(workflow_ids, vectors)
+                workflow_ids.append(workflow_id)
+                vectors.append(np.frombuffer(data, dtype='<f4', count=self.dimension, offset=id_start + id_length))
+            else:
+                self._flush_replayed(workflow_ids, vectors)
+                if workflow_id in self.workflow_to_id:
+                    self._remove_vector(workflow_id)
+            
+            record_count += 1
+            offset = record_end
+        
+        self._flush_replayed(workflow_ids, vectors)
+        
+        self.delta_count = record_count
+        return record_count
+    
+    def _flush_replayed(self, workflow_ids: List[str], vectors: List[np.ndarray]):
+        """将重放中累积的新增记录批量写入索引（同一工作流的旧向量先删除）"""
+        if not workflow_ids:
+            return
+        
+        for workflow_id in workflow_ids:
+            if workflow_id in self.workflow_to_id:
+                self._remove_vector(workflow_id)
+        self._add_vectors(list(workflow_ids), np.array(vectors, dtype='float32'))
+        workflow_ids.clear()
+        vectors.clear()
+    
     def save(self, file_path: str):
         """
-        保存索引到文件
+        保存索引到文件（全量写入，同时压缩掉追加日志）
+        
+        先写临时文件再原子替换，避免正在mmap该文件的其他进程读到半截数据
         
         Args:
             file_path: 文件路径
         """
-        faiss.write_index(self.index, file_path)
+        tmp_path = file_path + '.tmp'
+        faiss.write_index(self.index, tmp_path)
+        
+        # 保存映射（二进制格式，可直接mmap）
+        ids_tmp_path = file_path + '.ids.tmp'
+        self._save_id_mapping(ids_tmp_path)
         
-        # 保存映射（使用json）
-        import json
-        mapping_path = file_path + '.mapping.json'
-        with open(mapping_path, 'w') as f:
-            json.dump({
-                'id_to_workflow': self.id_to_workflow,
-                'workflow_to_id': self.workflow_to_id,
-                'current_index': self.current_index
-            }, f)
+        os.replace(tmp_path, file_path)
+        os.replace(ids_tmp_path, file_path + self.IDS_SUFFIX)
+        
+        # 训练样本数（IVF索引据此判断是否需要重新训练）
+        train_info_path = file_path + self.TRAIN_INFO_SUFFIX
+        if self.trained_size:
+            save_json({'trained_size': self.trained_size}, train_info_path + '.tmp')
+            os.replace(train_info_path + '.tmp', train_info_path)
+        elif os.path.exists(train_info_path):
+            os.remove(train_info_path)
+        
+        # 旧版json映射已被二进制映射取代
+        legacy_mapping_path = file_path + self.LEGACY_MAPPING_SUFFIX
+        if os.path.exists(legacy_mapping_path):
+            os.remove(legacy_mapping_path)
+        
+        # 全量文件已包含所有向量，清除追加日志
+        delta_path = file_path + self.DELTA_SUFFIX
+        if os.path.exists(delta_path):
+            os.remove(delta_path)
+        self._pending = []
+        self.delta_count = 0
     
-    def load(self, file_path: str):
+    def _save_id_mapping(self, path: str):
         """
-        从文件加载索引
+        以 (索引ID, workflow_id) 结构化数组保存ID映射
         
         Args:
-            file_path: 文件路径
+            path: 输出文件路径
         """
-        self.index = faiss.read_index(file_path)
+        items = sorted(self.id_to_workflow.items())
+        max_length = max((len(workflow_id) for _, workflow_id in items), default=1)
+        mapping = np.array(items, dtype=[('label', '<i8'), ('workflow_id', f'<U{max_length}')])
         
-        # 加载映射
-        import json
-        mapping_path = file_path + '.mapping.json'
+        # 传入文件对象，避免numpy自动追加.npy后缀
+        with open(path, 'wb') as f:
+            np.save(f, mapping, allow_pickle=False)
+    
+    def _load_id_mapping(self, file_path: str):
+        """
+        加载ID映射（优先二进制格式，兼容旧版json格式）
+        
+        Args:
+            file_path: 索引文件路径
+        """
+        ids_path = file_path + self.IDS_SUFFIX
+        if os.path.exists(ids_path):
+            mapping = np.load(ids_path, mmap_mode='r' if self.use_mmap else None, allow_pickle=False)
+            labels = mapping['label'].tolist()
+            workflow_ids = mapping['workflow_id'].tolist()
+            self.id_to_workflow = dict(zip(labels, workflow_ids))
+            self.workflow_to_id = dict(zip(workflow_ids, labels))
+            # HNSW墓碑的ID不在映射中，也不能被复用
+            self.current_index = max(max(labels, default=-1), self._max_stored_label()) + 1
+            return
+        
+        mapping_path = file_path + self.LEGACY_MAPPING_SUFFIX
         with open(mapping_path, 'r') as f:
             data = json.load(f)
             self.id_to_workflow = {int(k): v for k, v in data['id_to_workflow'].items()}
             self.workflow_to_id = data['workflow_to_id']
             self.current_index = data['current_index']
+    
+    def _max_stored_label(self) -> int:
+        """IndexIDMap2中已使用的最大ID（包括墓碑），没有时返回-1"""
+        if isinstance(self.index, (faiss.IndexIDMap, faiss.IndexIDMap2)) and self.index.ntotal:
+            return int(faiss.vector_to_array(self.index.id_map).max())
+        return -1
+    
+    def load(self, file_path: str):
+        """
+        从文件加载索引，并重放追加日志
+        
+        use_mmap=True时以内存映射方式加载，同机多进程共享页缓存；
+        之后第一次修改索引时才会复制为进程私有内存
+        
+        Args:
+            file_path: 文件路径
+        """
+        if os.path.exists(file_path):
+            if self.use_mmap:
+                self.index = faiss.read_index(file_path, self._mmap_flag())
+                self._mmapped = True
+            else:
+                self.index = faiss.read_index(file_path)
+                self._mmapped = False
+            
+            # 旧版索引按物理位置编号，转换为ID映射索引
+            if not self._supports_ids(self.index):
+                self._ensure_writable()
+                self.index = self._with_id_map(self.index)
+            self._apply_search_params(self.index)
+            
+            # 加载映射
+            self._load_id_mapping(file_path)
+            
+            # 旧版文件没有训练信息时，以当前向量数作为训练样本数
+            self.trained_size = 0
+            if self.active_type in ('ivf_flat', 'ivf_pq'):
+                train_info_path = file_path + self.TRAIN_INFO_SUFFIX
+                if os.path.exists(train_info_path):
+                    self.trained_size = load_json(train_info_path)['trained_size']
+                else:
+                    self.trained_size = self.index.ntotal
+        
+        self._pending = []
+        replayed = self._replay_delta(file_path)
+        if replayed:
+            print(f"[VectorIndex] 从追加日志恢复 {replayed} 个向量")
+    
+    @staticmethod
+    def _mmap_flag() -> int:
+        """FAISS内存映射读取标志（新版本对flat编码做真正的零拷贝映射）"""
+        return getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+    
+    def _ensure_writable(self):
+        """内存映射的索引是只读视图，修改前复制为进程私有的索引"""
+        if self._mmapped:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self._apply_search_params(self.index)
+            self._mmapped = False
+    
+    @classmethod
+    def exists(cls, file_path: str) -> bool:
+        """索引文件或其追加日志是否存在"""
+        return os.path.exists(file_path) or os.path.exists(file_path + cls.DELTA_SUFFIX)
+    
+    def recall_report(
+        self,
+        workflows: List[WorkflowEntry],
+        query_embeddings=None,
+        top_k: int = 10,
+        max_queries: int = 100
+    ) -> Dict[str, Any]:
+        """
+        以精确flat索引为基准评估当前索引的recall@k
+        
+        Args:
+            workflows: 索引中的工作流条目（用于构建精确基准）
+            query_embeddings: 查询向量矩阵，None时使用库中前max_queries个embedding
+            top_k: 评估的k
+            max_queries: 默认查询集的最大数量
+            
+        Returns:
+            评估报告
+        """
+        workflows = [w for w in workflows if w.intent_embedding is not None]
+        if not workflows:
+            return {'index_type': self.active_type, 'top_k': top_k, 'num_queries': 0, 'recall': 0.0}
+        
+        matrix = self._as_matrix([w.intent_embedding for w in workflows])
+        if query_embeddings is None:
+            queries = matrix[:max_queries]
+        else:
+            queries = self._as_matrix(query_embeddings)
+        
+        exact_index = faiss.IndexFlat(self.dimension, self._faiss_metric())
+        exact_index.add(matrix)
+        k = min(top_k, len(workflows))
+        
+        start = time.perf_counter()
+        _, exact_ids = exact_index.search(queries, k)
+        exact_ms = (time.perf_counter() - start) * 1000
+        
+        start = time.perf_counter()
+        approx_results = self.search_batch(queries, k)
+        approx_ms = (time.perf_counter() - start) * 1000
+        
+        hits = 0
+        for exact_row, approx_row in zip(exact_ids, approx_results):
+            expected = {workflows[i].workflow_id for i in exact_row if i != -1}
+            found = {self.get_workflow_id(idx) for idx, _ in approx_row}
+            hits += len(expected & found)
+        
+        return {
+            'index_type': self.active_type,
+            'top_k': k,
+            'num_queries': len(queries),
+            'recall': hits / (len(queries) * k),
+            'exact_ms': exact_ms,
+            'approx_ms': approx_ms
+        }
+
+
+def create_vector_index(config: Dict[str, Any], dimension: int) -> VectorIndex:
+    """
+    根据配置创建向量索引
+    
+    Args:
+        config: 完整配置字典（读取 workflow_library.vector_index）
+        dimension: 向量维度
+        
+    Returns:
+        向量索引
+    """
+    index_config = config.get('workflow_library', {}).get('vector_index', {}) or {}
+    
+    return VectorIndex(
+        dimension=dimension,
+        index_type=index_config.get('type', 'flat'),
+        metric=index_config.get('metric', 'l2'),
+        nlist=index_config.get('nlist', 100),
+        nprobe=index_config.get('nprobe', 8),
+        pq_m=index_config.get('pq_m', 64),
+        pq_nbits=index_config.get('pq_nbits', 8),
+        hnsw_m=index_config.get('hnsw_m', 32),
+        ef_construction=index_config.get('ef_construction', 200),
+        ef_search=index_config.get('ef_search', 64),
+        use_mmap=index_config.get('mmap', False)
+    )
+
+
+class FragmentIndex:
+    """
+    片段级向量索引（余弦相似度精确检索）
+    
+    跨所有工作流直接按需求检索片段，片段保留source_workflow_id用于溯源；
+    只在内存中维护向量和 (工作流, 片段序号)，启动时由工作流库从片段存储的embedding矩阵构建，
+    命中的片段通过fragment_loader从片段存储取回
+    """
+    
+    def __init__(
+        self,
+        dimension: int = 3072,
+        fragment_loader: Optional[Callable[[str], Optional[List[WorkflowFragment]]]] = None
+    ):
+        """
+        初始化片段索引
+        
+        Args:
+            dimension: 向量维度
+            fragment_loader: 根据workflow_id返回该工作流片段副本的函数（按添加时的片段顺序），
+                None时由工作流库设置为从片段存储读取
+        """
+        if faiss is None:
+            raise ImportError("请安装faiss: pip install faiss-cpu")
+        
+        self.dimension = dimension
+        self.fragment_loader = fragment_loader
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        
+        # 映射
+        self.positions: Dict[int, Tuple[str, int]] = {}  # {索引ID: (workflow_id, 片段序号)}
+        self.workflow_labels: Dict[str, List[int]] = {}  # {workflow_id: [索引ID]}
+        self.current_index = 0
+    
+    def __len__(self) -> int:
+        return len(self.positions)
+    
+    def add_fragments(self, workflow_id: str, fragments: List[WorkflowFragment]):
+        """
+        添加（替换）一个工作流的片段，没有embedding的片段跳过
+        
+        Args:
+            workflow_id: 来源工作流ID
+            fragments: 片段列表
+        """
+        self.add_embeddings(workflow_id, [fragment.embedding for fragment in fragments])
+    
+    def add_embeddings(self, workflow_id: str, embeddings: Sequence[Optional[Sequence[float]]]):
+        """
+        按片段顺序添加（替换）一个工作流的片段向量，None跳过
+        
+        Args:
+            workflow_id: 来源工作流ID
+            embeddings: 与片段一一对应的向量（可以是embedding矩阵行的只读视图）
+        """
+        self.remove_workflow(workflow_id)
+        
+        positions = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        if not positions:
+            return
+        
+        # 复制一份再归一化，不改动矩阵文件中的向量
+        matrix = np.array([embeddings[i] for i in positions], dtype='float32').reshape(-1, self.dimension)
+        faiss.normalize_L2(matrix)
+        labels = np.arange(self.current_index, self.current_index + len(positions), dtype='int64')
+        self.index.add_with_ids(matrix, labels)
+        
+        for position, label in zip(positions, labels.tolist()):
+            self.positions[label] = (workflow_id, position)
+        self.workflow_labels[workflow_id] = labels.tolist()
+        self.current_index += len(positions)
+    
+    def remove_workflow(self, workflow_id: str) -> bool:
+        """
+        删除一个工作流的所有片段
+        
+        Args:
+            workflow_id: 来源工作流ID
+            
+        Returns:
+            是否存在并已删除
+        """
+        labels = self.workflow_labels.pop(workflow_id, None)
+        if labels is None:
+            return False
+        
+        self.index.remove_ids(np.asarray(labels, dtype='int64'))
+        for label in labels:
+            del self.positions[label]
+        return True
+    
+    def search(
+        self,
+        query_embedding: List[float],
+        top_k: int = 10,
+        workflow_ids: Optional[Iterable[str]] = None
+    ) -> List[Tuple[WorkflowFragment, float]]:
+        """
+        检索与查询最相似的片段
+        
+        Args:
+            query_embedding: 查询向量
+            top_k: 返回数量
+            workflow_ids: 只检索这些工作流的片段，None表示不限制
+            
+        Returns:
+            按相似度降序的 [(片段副本, 0-1相似度)] 列表（片段已无法取回的结果跳过）
+        """
+        if self.index.ntotal == 0 or self.fragment_loader is None:
+            return []
+        
+        query = np.array(query_embedding, dtype='float32').reshape(1, self.dimension)
+        faiss.normalize_L2(query)
+        
+        if workflow_ids is None:
+            k = min(top_k, self.index.ntotal)
+            distances, indices = self.index.search(query, k)
+        else:
+            labels = [label for wid in workflow_ids for label in self.workflow_labels.get(wid, [])]
+            if not labels:
+                return []
+            k = min(top_k, len(labels))
+            selector = faiss.IDSelectorBatch(np.asarray(labels, dtype='int64'))
+            distances, indices = self.index.search(query, k, params=faiss.SearchParameters(sel=selector))
+        
+        # 同一工作流命中多个片段时只取回一次
+        loaded: Dict[str, Optional[List[WorkflowFragment]]] = {}
+        results = []
+        for idx, score in zip(indices[0], distances[0]):
+            if idx == -1 or int(idx) not in self.positions:
+                continue
+            workflow_id, position = self.positions[int(idx)]
+            if workflow_id not in loaded:
+                loaded[workflow_id] = self.fragment_loader(workflow_id)
+            fragments = loaded[workflow_id]
+            if fragments is None or position >= len(fragments):
+                continue
+            results.append((fragments[position], min(max(float(score), 0.0), 1.0)))
+        return results
 
 
 class Reranker:
     """重排序器 - 支持API和本地模型两种方式"""
     
-    def __init__(self, config: Dict[str, Any]):
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        rate_limit: Optional[Dict[str, Any]] = None,
+        cache: Optional[RerankCache] = None
+    ):
         """
         初始化Reranker
         
         Args:
             config: reranker配置字典
+            rate_limit: rerank端点的限流配置（见rate_limiter.get_rate_limiter）
+            cache: 相关性分数缓存，提供时只对未命中的 (查询, 工作流) 打分
         """
         self.config = config
         self.type = config.get('type', 'api')
+        self.rate_limiter = get_rate_limiter('rerank', rate_limit)
+        self.cache = cache
         
         if self.type == 'api':
             # API模式
@@ -167,10 +1028,27 @@ class Reranker:
             self.model_name = config.get('model', 'Pro/BAAI/bge-reranker-v2-m3')
             self.max_chunks_per_doc = config.get('max_chunks_per_doc', 1024)
             self.overlap_tokens = config.get('overlap_tokens', 80)
+            # 多个需求的rerank请求并发发出，复用连接池
+            self.max_concurrency = config.get('max_concurrency', 8)
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
             print(f"[Reranker] 使用API模式: {self.model_name}")
+        elif self.type == 'local':
+            # 本地交叉编码器（CPU批量推理，无网络往返）
+            self.model_name = config.get('model_path', './models/reranker')
+            self.cross_encoder = LocalCrossEncoder(
+                model_path=self.model_name,
+                backend=config.get('backend', 'torch'),
+                quantize=config.get('quantize', False),
+                batch_size=config.get('batch_size', 32),
+                max_length=config.get('max_length', 256),
+                num_threads=config.get('num_threads')
+            )
+            print(f"[Reranker] 使用本地模式: {self.model_name}")
         else:
-            # 本地模型模式（已废弃）
-            raise NotImplementedError("本地reranker已废弃，请使用API模式")
+            raise ValueError(f"不支持的reranker类型: {self.type}")
     
     def rerank(
         self,
@@ -189,6 +1067,25 @@ class Reranker:
         Returns:
             重排序后的工作流列表
         """
+        return [candidate for candidate, _ in self.rerank_scored(query, candidates, top_k)]
+    
+    def rerank_scored(
+        self,
+        query: str,
+        candidates: List[WorkflowEntry],
+        top_k: int = 10
+    ) -> List[Tuple[WorkflowEntry, Optional[float]]]:
+        """
+        重排序候选工作流并返回相关性分数
+        
+        Args:
+            query: 查询文本
+            candidates: 候选工作流列表
+            top_k: 返回数量
+            
+        Returns:
+            [(工作流, 0-1相关性分数)] 列表，重排序失败退回原始顺序时分数为None
+        """
         if not candidates:
             print("[Reranker] 警告: 候选列表为空")
             return []
@@ -199,29 +1096,153 @@ class Reranker:
             if self.type == 'api':
                 return self._rerank_api(query, candidates, top_k)
             else:
-                raise NotImplementedError("本地reranker已废弃")
+                return self._rerank_local([(query, candidates, top_k)])[0]
         except Exception as e:
             print(f"[Reranker] 错误: {e}, 使用原始顺序")
             import traceback
             traceback.print_exc()
-            return candidates[:top_k]
+            return [(candidate, None) for candidate in candidates[:top_k]]
+    
+    def rerank_many(
+        self,
+        jobs: List[Tuple[str, List[WorkflowEntry], int]]
+    ) -> List[List[Tuple[WorkflowEntry, Optional[float]]]]:
+        """
+        一次重排序多个需求的候选（API模式并发请求，本地模式打包成批推理）
+        
+        Args:
+            jobs: [(查询文本, 候选工作流列表, 返回数量)]
+            
+        Returns:
+            与jobs一一对应的 [(工作流, 0-1相关性分数)] 列表
+        """
+        if not jobs:
+            return []
+        
+        if self.type != 'api':
+            try:
+                return self._rerank_local(jobs)
+            except Exception as e:
+                print(f"[Reranker] 错误: {e}, 使用原始顺序")
+                return [[(candidate, None) for candidate in candidates[:top_k]] for _, candidates, top_k in jobs]
+        
+        if len(jobs) == 1:
+            return [self.rerank_scored(*jobs[0])]
+        
+        print(f"[Reranker] 并发重排序 {len(jobs)} 个需求")
+        with ThreadPoolExecutor(max_workers=min(len(jobs), self.max_concurrency)) as executor:
+            return list(executor.map(lambda job: self.rerank_scored(*job), jobs))
+    
+    def _cache_keys(self, query: str, candidates: List[WorkflowEntry]) -> List[str]:
+        """计算候选的分数缓存键"""
+        return [
+            RerankCache.make_key(self.model_name, query, candidate.workflow_id, candidate.intent.description)
+            for candidate in candidates
+        ]
+    
+    def _cached_scores(self, query: str, candidates: List[WorkflowEntry]) -> List[Optional[float]]:
+        """
+        查询候选的缓存分数
+        
+        Args:
+            query: 查询文本
+            candidates: 候选工作流列表
+            
+        Returns:
+            与候选一一对应的分数，未命中（或未启用缓存）的位置为None
+        """
+        if self.cache is None:
+            return [None] * len(candidates)
+        return self.cache.get_many(self._cache_keys(query, candidates))
+    
+    def _store_scores(self, query: str, candidates: List[WorkflowEntry], scores: List[Optional[float]]):
+        """将新打出的分数写入缓存"""
+        if self.cache is None:
+            return
+        keys = self._cache_keys(query, candidates)
+        self.cache.put_many([
+            (key, candidate.workflow_id, score)
+            for key, candidate, score in zip(keys, candidates, scores)
+            if score is not None
+        ])
+    
+    @staticmethod
+    def _ranked(
+        candidates: List[WorkflowEntry],
+        scores: List[Optional[float]],
+        top_k: int
+    ) -> List[Tuple[WorkflowEntry, Optional[float]]]:
+        """
+        按分数降序排列候选（分数相同时保持召回顺序，没有分数的候选不返回）
+        
+        Args:
+            candidates: 候选工作流列表
+            scores: 与候选一一对应的分数
+            top_k: 返回数量
+            
+        Returns:
+            [(工作流, 分数)] 列表
+        """
+        order = sorted(
+            (i for i, score in enumerate(scores) if score is not None),
+            key=lambda i: -scores[i]
+        )[:top_k]
+        for rank, i in enumerate(order[:3], 1):  # 只打印前3个
+            print(f"  {rank}. {candidates[i].workflow_id}: {candidates[i].intent.description[:60]}... (得分: {scores[i]:.4f})")
+        
+        print(f"[Reranker] 重排序完成")
+        return [(candidates[i], scores[i]) for i in order]
     
     def _rerank_api(
         self,
         query: str,
         candidates: List[WorkflowEntry],
         top_k: int
-    ) -> List[WorkflowEntry]:
-        """使用API进行重排序"""
+    ) -> List[Tuple[WorkflowEntry, Optional[float]]]:
+        """使用API进行重排序（只把缓存未命中的候选发给API）"""
+        scores = self._cached_scores(query, candidates)
+        missing = [i for i, score in enumerate(scores) if score is None]
+        
+        if missing:
+            api_scores = self._score_api(query, [candidates[i] for i in missing], top_k)
+            if api_scores is None:
+                return [(candidate, None) for candidate in candidates[:top_k]]
+            for position, score in api_scores.items():
+                scores[missing[position]] = score
+            self._store_scores(query, [candidates[i] for i in missing], [scores[i] for i in missing])
+        
+        if len(missing) < len(candidates):
+            print(f"[Reranker] 缓存命中 {len(candidates) - len(missing)}/{len(candidates)} 个候选")
+        
+        return self._ranked(candidates, scores, top_k)
+    
+    def _score_api(
+        self,
+        query: str,
+        candidates: List[WorkflowEntry],
+        top_k: int
+    ) -> Optional[Dict[int, float]]:
+        """
+        调用rerank API为候选打分
+        
+        Args:
+            query: 查询文本
+            candidates: 候选工作流列表
+            top_k: 需要的返回数量（启用缓存时对所有候选打分，以便缓存完整结果）
+            
+        Returns:
+            {候选位置: 相关性分数}，API出错或返回为空时为None
+        """
         # 构建 documents 列表（使用 workflow 的 intent.description）
         documents = [candidate.intent.description for candidate in candidates]
+        top_n = len(documents) if self.cache is not None else min(top_k, len(documents))
         
         # 构建 API 请求
         payload = {
             "model": self.model_name,
             "query": query,
             "documents": documents,
-            "top_n": min(top_k, len(documents)),  # 不超过候选数量
+            "top_n": top_n,  # 不超过候选数量
             "return_documents": True,
             "max_chunks_per_doc": self.max_chunks_per_doc,
             "overlap_tokens": self.overlap_tokens
@@ -232,14 +1253,24 @@ class Reranker:
             "Content-Type": "application/json"
         }
         
-        # 调用API
+        # 调用API（限流和服务端错误由限流器退避重试）
         print(f"[Reranker] 调用API: {self.api_url}")
-        response = requests.post(self.api_url, json=payload, headers=headers, timeout=30)
+        
+        def post():
+            response = self.session.post(self.api_url, json=payload, headers=headers, timeout=30)
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                raise HTTPStatusError(
+                    response.status_code, response.text,
+                    parse_retry_after(response.headers.get('retry-after'))
+                )
+            return response
+        
+        response = self.rate_limiter.call(post)
         
         if response.status_code != 200:
             print(f"[Reranker] API错误: {response.status_code}")
             print(response.text)
-            return candidates[:top_k]
+            return None
         
         # 解析结果
         data = response.json()
@@ -247,23 +1278,41 @@ class Reranker:
         
         if not results:
             print(f"[Reranker] API返回结果为空")
-            return candidates[:top_k]
+            return None
         
         print(f"[Reranker] API返回 {len(results)} 个结果")
         
-        # 根据返回的索引重新排序
-        reranked_candidates = []
-        for item in results:
-            index = item['index']
-            score = item['relevance_score']
-            
-            if 0 <= index < len(candidates):
-                reranked_candidates.append(candidates[index])
-                if len(reranked_candidates) <= 3:  # 只打印前3个
-                    print(f"  {len(reranked_candidates)}. {candidates[index].workflow_id}: {candidates[index].intent.description[:60]}... (得分: {score:.4f})")
+        return {
+            item['index']: item['relevance_score']
+            for item in results
+            if 0 <= item['index'] < len(candidates)
+        }
+    
+    def _rerank_local(
+        self,
+        jobs: List[Tuple[str, List[WorkflowEntry], int]]
+    ) -> List[List[Tuple[WorkflowEntry, Optional[float]]]]:
+        """使用本地交叉编码器进行重排序（所有需求中缓存未命中的文本对打包成批推理）"""
+        job_scores = []
+        queries = []
+        documents = []
+        for query, candidates, _ in jobs:
+            scores = self._cached_scores(query, candidates)
+            job_scores.append(scores)
+            for candidate, score in zip(candidates, scores):
+                if score is None:
+                    queries.append(query)
+                    documents.append(candidate.intent.description)
+        new_scores = iter(self.cross_encoder.score_pairs(queries, documents) if documents else [])
         
-        print(f"[Reranker] 重排序完成")
-        return reranked_candidates[:top_k]
+        results = []
+        for (query, candidates, top_k), scores in zip(jobs, job_scores):
+            missing = [i for i, score in enumerate(scores) if score is None]
+            for i in missing:
+                scores[i] = next(new_scores)
+            self._store_scores(query, [candidates[i] for i in missing], [scores[i] for i in missing])
+            results.append(self._ranked(candidates, scores, top_k))
+        return results
 
 
 class WorkflowRetriever:
@@ -274,7 +1323,14 @@ class WorkflowRetriever:
         llm_client: LLMClient,
         vector_index: VectorIndex,
         reranker: Reranker,
-        workflow_library: Dict[str, WorkflowEntry]
+        workflow_library: Dict[str, WorkflowEntry],
+        similarity_threshold: float = 0.0,
+        candidate_filter: Optional[Callable[[AtomicNeed], Optional[Set[str]]]] = None,
+        lexical_index: Optional[BM25Index] = None,
+        lexical_top_k: int = 20,
+        rrf_k: int = 60,
+        fragment_index: Optional[FragmentIndex] = None,
+        max_rerank_candidates: int = 4
     ):
         """
         初始化检索器
@@ -284,11 +1340,36 @@ class WorkflowRetriever:
             vector_index: 向量索引
             reranker: 重排序器
             workflow_library: 工作流库
+            similarity_threshold: 向量召回的0-1相似度阈值，低于阈值的候选不送入reranker
+            candidate_filter: 根据需求返回候选workflow_id集合的函数（元数据预过滤），
+                返回None表示不过滤
+            lexical_index: BM25词法索引，提供时与向量召回结果做倒数排名融合
+            lexical_top_k: 词法召回数量
+            rrf_k: 倒数排名融合的平滑常数
+            fragment_index: 片段级向量索引，提供时可直接按需求检索片段
+            max_rerank_candidates: 送入reranker的最大候选数（远程API较小，本地模型可放大）
         """
         self.llm = llm_client
         self.vector_index = vector_index
         self.reranker = reranker
         self.workflow_library = workflow_library
+        self.similarity_threshold = similarity_threshold
+        self.candidate_filter = candidate_filter
+        self.lexical_index = lexical_index
+        self.lexical_top_k = lexical_top_k
+        self.rrf_k = rrf_k
+        self.fragment_index = fragment_index
+        self.max_rerank_candidates = max_rerank_candidates
+        
+        # 最近一次检索调用的向量相似度 {need_id: {workflow_id: similarity}}
+        self.similarity_scores: Dict[str, Dict[str, float]] = {}
+        # 最近一次检索调用的rerank相关性分数 {need_id: {workflow_id: score}}（重排序失败时为空）
+        self.rerank_scores: Dict[str, Dict[str, float]] = {}
+    
+    def _reset_scores(self):
+        """每次检索调用开始时换用新的分数字典（need_id每个请求都不同，累积会无限增长）"""
+        self.similarity_scores = {}
+        self.rerank_scores = {}
     
     def retrieve(
         self,
@@ -307,6 +1388,8 @@ class WorkflowRetriever:
         Returns:
             工作流列表
         """
+        self._reset_scores()
+        
         # 1. 生成查询embedding
         query_text = atomic_need.description
         query_embedding = self.llm.embed(query_text)
@@ -315,54 +1398,260 @@ class WorkflowRetriever:
             print("生成embedding失败")
             return []
         
-        # 2. 向量召回
-        search_results = self.vector_index.search(query_embedding, top_k_recall)
+        # 2. 向量召回和词法召回（按元数据预过滤）
+        candidate_ids = self._candidate_ids(atomic_need)
+        search_results = self.vector_index.search(
+            query_embedding,
+            top_k_recall,
+            workflow_ids=candidate_ids
+        )
+        lexical_results = self._lexical_search(atomic_need, candidate_ids)
+        
+        # 3. 转换为WorkflowEntry对象并重排序
+        candidates = self._prepare_candidates(atomic_need, search_results, lexical_results)
+        return self._rerank_needs([(atomic_need, candidates)], top_k_rerank)[atomic_need.need_id]
+    
+    def retrieve_for_all_needs(
+        self,
+        atomic_needs: List[AtomicNeed],
+        top_k_per_need: int = 5,
+        top_k_recall: int = 20,
+        need_embeddings: Optional[Dict[str, Optional[List[float]]]] = None
+    ) -> Dict[str, List[WorkflowEntry]]:
+        """
+        为所有原子需求检索工作流
+        
+        候选集合相同的需求合并为一次批量搜索，所有需求的重排序一次并发完成
+        
+        Args:
+            atomic_needs: 原子需求列表
+            top_k_per_need: 每个需求重排序后返回的工作流数量
+            top_k_recall: 每个需求的向量召回数量
+            need_embeddings: embed_needs预先生成的查询embedding，None时在这里生成
+            
+        Returns:
+            {need_id: [workflows]} 映射
+        """
+        results = {need.need_id: [] for need in atomic_needs}
+        self._reset_scores()
+        
+        # 1. 批量生成所有需求的查询embedding
+        embedded_needs = []
+        query_embeddings = []
+        if need_embeddings is None:
+            need_embeddings = self.embed_needs(atomic_needs)
+        for need in atomic_needs:
+            query_embedding = need_embeddings.get(need.need_id)
+            if query_embedding is None:
+                print(f"生成embedding失败: {need.need_id}")
+                continue
+            embedded_needs.append(need)
+            query_embeddings.append(query_embedding)
+        
+        if not embedded_needs:
+            return results
+        
+        # 2. 按候选集合分组批量向量召回
+        groups: Dict[Optional[frozenset], List[int]] = {}
+        need_candidate_ids = []
+        for i, need in enumerate(embedded_needs):
+            candidate_ids = self._candidate_ids(need)
+            need_candidate_ids.append(candidate_ids)
+            key = frozenset(candidate_ids) if candidate_ids is not None else None
+            groups.setdefault(key, []).append(i)
+        
+        batch_results = [None] * len(embedded_needs)
+        for candidate_ids, positions in groups.items():
+            group_results = self.vector_index.search_batch(
+                [query_embeddings[i] for i in positions],
+                top_k=top_k_recall,
+                workflow_ids=candidate_ids
+            )
+            for i, search_results in zip(positions, group_results):
+                batch_results[i] = search_results
+        
+        # 3. 逐个需求融合词法召回，再一次性重排序所有需求
+        need_candidates = [
+            (need, self._prepare_candidates(need, search_results, self._lexical_search(need, candidate_ids)))
+            for need, search_results, candidate_ids in zip(embedded_needs, batch_results, need_candidate_ids)
+        ]
+        results.update(self._rerank_needs(need_candidates, top_k_per_need))
+        
+        return results
+    
+    def embed_needs(self, atomic_needs: List[AtomicNeed]) -> Dict[str, Optional[List[float]]]:
+        """
+        批量生成需求的查询embedding（工作流检索和片段检索共用）
+        
+        Args:
+            atomic_needs: 原子需求列表
+            
+        Returns:
+            {need_id: embedding}，生成失败时为None
+        """
+        vectors = self.llm.embed_batch([need.description for need in atomic_needs])
+        return {need.need_id: vector for need, vector in zip(atomic_needs, vectors)}
+    
+    def retrieve_fragments(
+        self,
+        atomic_need: AtomicNeed,
+        top_k: int = 8,
+        query_embedding: Optional[List[float]] = None
+    ) -> List[WorkflowFragment]:
+        """
+        跨所有工作流直接检索与需求最相似的片段（按元数据预过滤）
+        
+        Args:
+            atomic_need: 原子需求
+            top_k: 返回数量
+            query_embedding: 工作流检索时已生成的需求embedding，None时重新生成
+            
+        Returns:
+            片段列表（副本，source_workflow_id指向来源工作流），未启用片段索引时返回空列表
+        """
+        if self.fragment_index is None or len(self.fragment_index) == 0:
+            return []
+        
+        if query_embedding is None:
+            query_embedding = self.llm.embed(atomic_need.description)
+        if query_embedding is None:
+            return []
+        
+        candidate_ids = self._candidate_ids(atomic_need)
+        results = self.fragment_index.search(query_embedding, top_k, workflow_ids=candidate_ids)
+        
+        fragments = []
+        for fragment, similarity in results:
+            if similarity < self.similarity_threshold or fragment.source_workflow_id not in self.workflow_library:
+                continue
+            fragments.append(fragment)
+        
+        print(f"[VectorSearch] 片段检索: {atomic_need.need_id} 返回 {len(fragments)} 个片段")
+        return fragments
+    
+    def _candidate_ids(self, atomic_need: AtomicNeed) -> Optional[Set[str]]:
+        """
+        获取需求的候选工作流集合
+        
+        Args:
+            atomic_need: 原子需求
+            
+        Returns:
+            候选workflow_id集合，None表示不过滤
+        """
+        if not self.candidate_filter:
+            return None
+        
+        candidate_ids = self.candidate_filter(atomic_need)
+        if candidate_ids is not None:
+            print(f"[VectorSearch] 元数据预过滤: {atomic_need.need_id} 在 {len(candidate_ids)} 个工作流中检索")
+        return candidate_ids
+    
+    def _lexical_search(
+        self,
+        atomic_need: AtomicNeed,
+        candidate_ids: Optional[Set[str]] = None
+    ) -> Optional[List[Tuple[str, float]]]:
+        """
+        BM25词法召回
+        
+        Args:
+            atomic_need: 原子需求
+            candidate_ids: 候选workflow_id集合，None表示不过滤
+            
+        Returns:
+            [(workflow_id, BM25分数)] 列表，未启用词法检索时返回None
+        """
+        if self.lexical_index is None:
+            return None
+        return self.lexical_index.search(atomic_need.description, self.lexical_top_k, doc_ids=candidate_ids)
+    
+    def _prepare_candidates(
+        self,
+        atomic_need: AtomicNeed,
+        search_results: List[Tuple[int, float]],
+        lexical_results: Optional[List[Tuple[str, float]]] = None
+    ) -> List[WorkflowEntry]:
+        """
+        将向量召回结果转换为工作流，按相似度阈值过滤、与词法召回融合并截断到rerank候选上限
         
-        # 3. 转换为WorkflowEntry对象
+        Args:
+            atomic_need: 原子需求
+            search_results: 向量召回结果 [(索引位置, 距离)]
+            lexical_results: 词法召回结果 [(workflow_id, BM25分数)]，None表示只用向量召回
+            
+        Returns:
+            待重排序的工作流列表
+        """
         candidates = []
-        for index, distance in search_results:
+        similarities = {}
+        dropped = 0
+        for index, score in search_results:
             workflow_id = self.vector_index.get_workflow_id(index)
-            if workflow_id and workflow_id in self.workflow_library:
-                candidates.append(self.workflow_library[workflow_id])
+            if not workflow_id or workflow_id not in self.workflow_library:
+                continue
+            
+            similarity = self.vector_index.similarity(score)
+            if similarity < self.similarity_threshold:
+                dropped += 1
+                continue
+            
+            similarities[workflow_id] = similarity
+            candidates.append(self.workflow_library[workflow_id])
+        
+        self.similarity_scores[atomic_need.need_id] = similarities
+        
+        if dropped:
+            print(f"[VectorSearch] {dropped} 个候选相似度低于阈值 {self.similarity_threshold}，已丢弃")
+        
+        # 倒数排名融合（词法命中的候选不受相似度阈值限制）
+        if lexical_results:
+            lexical_ids = [wid for wid, _ in lexical_results if wid in self.workflow_library]
+            fused = reciprocal_rank_fusion(
+                [[wf.workflow_id for wf in candidates], lexical_ids],
+                k=self.rrf_k
+            )
+            candidates = [self.workflow_library[wid] for wid, _ in fused]
+            print(f"[VectorSearch] 融合 {len(lexical_ids)} 个词法召回结果")
         
         if not candidates:
             return []
         
         print(f"[VectorSearch] 向量检索返回 {len(candidates)} 个候选")
         
-        # 4. 重排序（限制最多20个候选，避免reranker崩溃）
-        max_rerank_candidates = 4
-        if len(candidates) > max_rerank_candidates:
-            print(f"[VectorSearch] 候选过多，只对前 {max_rerank_candidates} 个进行rerank")
-            candidates = candidates[:max_rerank_candidates]
-        
-        reranked = self.reranker.rerank(query_text, candidates, top_k_rerank)
+        # 限制候选数量，避免reranker过载
+        if len(candidates) > self.max_rerank_candidates:
+            print(f"[VectorSearch] 候选过多，只对前 {self.max_rerank_candidates} 个进行rerank")
+            candidates = candidates[:self.max_rerank_candidates]
         
-        return reranked
+        return candidates
     
-    def retrieve_for_all_needs(
+    def _rerank_needs(
         self,
-        atomic_needs: List[AtomicNeed],
-        top_k_per_need: int = 5
+        need_candidates: List[Tuple[AtomicNeed, List[WorkflowEntry]]],
+        top_k_rerank: int
     ) -> Dict[str, List[WorkflowEntry]]:
         """
-        为所有原子需求检索工作流
+        一次重排序多个需求的候选，分数记录到rerank_scores
         
         Args:
-            atomic_needs: 原子需求列表
-            top_k_per_need: 每个需求返回的工作流数量
+            need_candidates: [(原子需求, 待重排序的工作流列表)]
+            top_k_rerank: 每个需求重排序后返回数量
             
         Returns:
             {need_id: [workflows]} 映射
         """
-        results = {}
-        
-        for need in atomic_needs:
-            workflows = self.retrieve(
-                need,
-                top_k_recall=20,  # 降低召回数量，避免传给reranker过多
-                top_k_rerank=top_k_per_need
-            )
-            results[need.need_id] = workflows
+        results = {need.need_id: [] for need, _ in need_candidates}
+        jobs = [(need, candidates) for need, candidates in need_candidates if candidates]
+        if not jobs:
+            return results
         
+        ranked_lists = self.reranker.rerank_many(
+            [(need.description, candidates, top_k_rerank) for need, candidates in jobs]
+        )
+        for (need, _), ranked in zip(jobs, ranked_lists):
+            results[need.need_id] = [wf for wf, _ in ranked]
+            self.rerank_scores[need.need_id] = {
+                wf.workflow_id: score for wf, score in ranked if score is not None
+            }
         return results
@@ -4,12 +4,15 @@
 """
 
 import os
-import json
-from typing import Dict, List, Optional, Any, Tuple
-from core.data_structures import WorkflowEntry, WorkflowIntent, WorkflowComplexity
+from typing import Dict, List, Optional, Any, Tuple, Set
+from core.data_structures import WorkflowEntry, WorkflowIntent, WorkflowComplexity, AtomicNeed, WorkflowFragment
 from core.llm_client import LLMClient
-from core.vector_search import VectorIndex
-from core.utils import generate_workflow_id, extract_node_types_from_json, save_json, load_json
+from core.vector_search import VectorIndex, FragmentIndex
+from core.lexical_search import BM25Index
+from core.fragment_store import FragmentStore
+from core.embedding_store import EmbeddingMatrix
+from core.library_store import LibraryStore, entry_metadata, has_legacy_files, load_legacy_entries
+from core.utils import generate_workflow_id, extract_node_types_from_json, workflow_node_types, save_json
 import prompts
 
 
@@ -21,7 +24,14 @@ class WorkflowLibrary:
         data_path: str,
         llm_client: Optional[LLMClient] = None,
         vector_index: Optional[VectorIndex] = None,
-        vector_index_path: Optional[str] = None
+        vector_index_path: Optional[str] = None,
+        persistence_mode: str = 'full',
+        compact_threshold: int = 1000,
+        fragment_store: Optional[FragmentStore] = None,
+        fragment_index: Optional[FragmentIndex] = None,
+        storage: str = 'files',
+        lazy_load: bool = False,
+        body_cache_size: int = 256
     ):
         """
         初始化工作流库
@@ -31,11 +41,39 @@ class WorkflowLibrary:
             llm_client: LLM客户端（用于意图提取和embedding）
             vector_index: 向量索引
             vector_index_path: 向量索引保存路径
+            persistence_mode: 向量索引持久化方式
+                ("full": 每次添加后全量重写 / "append": 追加到日志，定期或flush()时压缩)
+            compact_threshold: append模式下追加日志达到多少条记录时压缩为全量文件
+            fragment_store: 片段存储，提供时入库即拆分并持久化片段，删除时一并清理
+            fragment_index: 片段级向量索引，启动时由片段存储中已有的片段构建，随入库和删除更新
+            storage: 工作流存储方式
+                ("files": 每个工作流一个元数据文件和一个JSON文件 /
+                 "sqlite": 所有工作流存放在 library.sqlite 中，首次启动时自动导入旧文件)
+            lazy_load: 启动时只加载意图、元数据和embedding，工作流JSON和代码在首次访问时读取（仅sqlite存储）
+            body_cache_size: 按需加载时内存中保留的工作流JSON和代码数量（LRU）
         """
+        if persistence_mode not in ('full', 'append'):
+            raise ValueError(f"不支持的持久化方式: {persistence_mode}")
+        if storage not in ('files', 'sqlite'):
+            raise ValueError(f"不支持的存储方式: {storage}")
+        
         self.data_path = data_path
         self.llm = llm_client
         self.vector_index = vector_index
         self.vector_index_path = vector_index_path or os.path.join(data_path, 'embeddings.faiss')
+        self.persistence_mode = persistence_mode
+        self.compact_threshold = compact_threshold
+        self.fragment_store = fragment_store
+        self.fragment_index = fragment_index
+        self.store = None
+        if storage == 'sqlite':
+            self.store = LibraryStore(os.path.join(data_path, LibraryStore.FILENAME), body_cache_size=body_cache_size)
+        self.lazy_load = lazy_load and self.store is not None
+        # 意图embedding的唯一存储（内存映射的float32矩阵），条目持有其中一行的只读视图
+        self.embeddings = EmbeddingMatrix(
+            os.path.join(data_path, EmbeddingMatrix.FILENAME),
+            dimension=vector_index.dimension if vector_index else None
+        )
         
         # 工作流字典
         self.workflows: Dict[str, WorkflowEntry] = {}
@@ -43,6 +81,8 @@ class WorkflowLibrary:
         # 索引
         self.tag_index: Dict[str, List[str]] = {}  # {tag: [workflow_ids]}
         self.category_index: Dict[str, List[str]] = {}  # {category: [workflow_ids]}
+        self.modality_index: Dict[str, List[str]] = {}  # {modality: [workflow_ids]}
+        self.lexical_index = BM25Index()  # 意图描述、关键词和节点类型的倒排索引
         
         # 创建目录
         os.makedirs(data_path, exist_ok=True)
@@ -54,6 +94,9 @@ class WorkflowLibrary:
         
         # 加载向量索引
         self._load_vector_index()
+        
+        # 构建片段索引
+        self._load_fragment_index()
     
     def add_workflow(
         self,
@@ -61,7 +104,8 @@ class WorkflowLibrary:
         workflow_code: str,
         intent: Optional[WorkflowIntent] = None,
         metadata: Optional[Dict[str, Any]] = None,
-        auto_annotate: bool = True
+        auto_annotate: bool = True,
+        intent_embedding: Optional[List[float]] = None
     ) -> WorkflowEntry:
         """
         添加工作流到库
@@ -72,6 +116,7 @@ class WorkflowLibrary:
             intent: 工作流意图（如果None且auto_annotate=True则自动提取）
             metadata: 元数据
             auto_annotate: 是否自动标注意图
+            intent_embedding: 预先生成的意图embedding（如批量生成），None时自动生成
             
         Returns:
             工作流条目
@@ -93,8 +138,7 @@ class WorkflowLibrary:
             )
         
         # 生成embedding
-        intent_embedding = None
-        if self.llm:
+        if intent_embedding is None and self.llm:
             intent_embedding = self.llm.embed(intent.description)
         
         # 创建工作流条目
@@ -103,13 +147,14 @@ class WorkflowLibrary:
             workflow_json=workflow_json,
             workflow_code=workflow_code,
             intent=intent,
-            intent_embedding=intent_embedding,
             source=metadata.get('source', 'unknown') if metadata else 'unknown',
             complexity=WorkflowComplexity(metadata.get('complexity', 'vanilla')) if metadata else WorkflowComplexity.VANILLA,
             tags=metadata.get('tags', []) if metadata else [],
             node_count=len(workflow_json)
         )
         
+        self._set_embedding(entry, intent_embedding)
+        
         # 保存到内存
         self.workflows[workflow_id] = entry
         
@@ -117,16 +162,236 @@ class WorkflowLibrary:
         self._update_indexes(entry)
         
         # 添加到向量索引
-        if self.vector_index and intent_embedding:
+        if self.vector_index and entry.intent_embedding is not None:
             self.vector_index.add_workflow(entry)
-            # 保存向量索引
-            self._save_vector_index()
+            self._persist_vector_index()
         
         # 持久化
         self._save_workflow(entry)
         
+        # 预拆分片段（请求时直接查表）
+        if self.fragment_store is not None and self.fragment_store.code_splitter is not None:
+            fragments = self.fragment_store.compute(entry)
+            if self.fragment_index is not None:
+                self.fragment_index.add_fragments(workflow_id, fragments)
+        
         return entry
     
+    def add_workflows(
+        self,
+        workflows: List[Tuple[Dict[str, Any], str, Optional[Dict[str, Any]]]],
+        auto_annotate: bool = True
+    ) -> List[WorkflowEntry]:
+        """
+        批量添加工作流（意图逐个提取，embedding一次批量生成）
+        
+        单个工作流失败时跳过该工作流，不影响其余工作流；批量embedding失败的工作流在入库时逐个重新生成
+        
+        Args:
+            workflows: [(workflow_json, workflow_code, metadata)] 列表
+            auto_annotate: 是否自动标注意图
+            
+        Returns:
+            成功添加的工作流条目列表
+        """
+        default_intent = WorkflowIntent(
+            task="unknown",
+            description="未标注的工作流",
+            keywords=[],
+            modality="image",
+            operation="generation"
+        )
+        
+        # 1. 提取意图
+        intents = []
+        for workflow_json, workflow_code, _ in workflows:
+            intent = default_intent
+            if auto_annotate and self.llm:
+                try:
+                    intent = self._extract_intent(workflow_json, workflow_code)
+                except Exception as e:
+                    print(f"[WARN] 提取工作流意图失败: {e}，使用规则提取")
+                    intent = self._rule_based_intent(extract_node_types_from_json(workflow_json))
+            intents.append(intent)
+        
+        # 2. 批量生成embedding（整体失败时入库阶段逐个生成）
+        embeddings = [None] * len(workflows)
+        if self.llm:
+            try:
+                embeddings = self.llm.embed_batch([intent.description for intent in intents])
+            except Exception as e:
+                print(f"[WARN] 批量生成embedding失败: {e}，将逐个生成")
+        
+        # 3. 逐个入库
+        entries = []
+        for (workflow_json, workflow_code, metadata), intent, embedding in zip(workflows, intents, embeddings):
+            try:
+                entries.append(self.add_workflow(
+                    workflow_json=workflow_json,
+                    workflow_code=workflow_code,
+                    intent=intent,
+                    metadata=metadata,
+                    intent_embedding=embedding
+                ))
+            except Exception as e:
+                print(f"[WARN] 添加工作流失败（{intent.description}）: {e}")
+        
+        return entries
+    
+    def remove_workflow(self, workflow_id: str) -> bool:
+        """
+        从库中删除工作流（内存、索引、向量索引和文件）
+        
+        Args:
+            workflow_id: 工作流ID
+            
+        Returns:
+            是否存在并已删除
+        """
+        entry = self.workflows.pop(workflow_id, None)
+        if entry is None:
+            return False
+        
+        self._remove_from_indexes(entry)
+        
+        if self.vector_index and self.vector_index.remove_workflow(workflow_id):
+            self._persist_vector_index()
+        
+        if self.store is not None:
+            self.store.delete(workflow_id)
+        # embedding矩阵中的行不复用（其他进程可能持有同一文件），由compact_embeddings离线回收
+        
+        for path in (
+            os.path.join(self.data_path, 'workflows', f'{workflow_id}.json'),
+            os.path.join(self.data_path, 'metadata', f'{workflow_id}.meta.json')
+        ):
+            if os.path.exists(path):
+                os.remove(path)
+        
+        if self.fragment_store is not None:
+            self.fragment_store.remove(workflow_id)
+        if self.fragment_index is not None:
+            self.fragment_index.remove_workflow(workflow_id)
+        
+        return True
+    
+    def update_intent(self, workflow_id: str, intent: WorkflowIntent) -> Optional[WorkflowEntry]:
+        """
+        更新工作流意图，只重新生成该工作流的embedding
+        
+        Args:
+            workflow_id: 工作流ID
+            intent: 新的工作流意图
+            
+        Returns:
+            更新后的工作流条目，不存在时返回None
+        """
+        entry = self.workflows.get(workflow_id)
+        if entry is None:
+            return None
+        
+        self._remove_from_indexes(entry)
+        description_changed = intent.description != entry.intent.description
+        entry.intent = intent
+        self._update_indexes(entry)
+        
+        # 描述变化时重新生成embedding并替换向量；生成失败时去掉旧的embedding和向量，
+        # 避免新描述沿用旧描述的向量
+        if description_changed and self.llm:
+            self._set_embedding(entry, self.llm.embed(intent.description))
+            if self.vector_index:
+                if entry.intent_embedding is not None:
+                    self.vector_index.replace_workflow(entry)
+                else:
+                    self.vector_index.remove_workflow(workflow_id)
+                self._persist_vector_index()
+        
+        self._save_workflow(entry)
+        
+        return entry
+    
+    def _set_embedding(self, entry: WorkflowEntry, embedding: Optional[List[float]]):
+        """
+        将embedding写入embedding矩阵（已有行时原地覆盖），条目改为持有该行的视图
+        
+        Args:
+            entry: 工作流条目
+            embedding: 新的embedding，None表示没有embedding（条目不再引用已有的行，由compact_embeddings离线回收）
+        """
+        if embedding is None:
+            entry.intent_embedding = None
+            entry.embedding_row = None
+            return
+        
+        if entry.embedding_row is None:
+            entry.embedding_row = self.embeddings.add(embedding)
+        else:
+            self.embeddings.write(entry.embedding_row, embedding)
+        entry.intent_embedding = self.embeddings.row(entry.embedding_row)
+    
+    def get_fragments(self, entry: WorkflowEntry) -> Optional[List[WorkflowFragment]]:
+        """
+        获取工作流的预拆分片段
+        
+        Args:
+            entry: 工作流条目
+            
+        Returns:
+            片段列表（副本），未配置片段存储或无法获得时返回None
+        """
+        if self.fragment_store is None:
+            return None
+        return self.fragment_store.get(entry)
+    
+    def _stored_fragments(self, workflow_id: str) -> Optional[List[WorkflowFragment]]:
+        """片段索引命中后取回片段（只读已存片段，不现场拆分）"""
+        entry = self.workflows.get(workflow_id)
+        if entry is None or self.fragment_store is None:
+            return None
+        return self.fragment_store.get(entry, compute=False)
+    
+    def precompute_fragments(self, force: bool = False) -> int:
+        """
+        为库中尚无有效片段的工作流拆分并保存片段（用于已有库的回填）
+        
+        Args:
+            force: 是否重新拆分所有工作流
+            
+        Returns:
+            重新拆分的工作流数量
+        """
+        if self.fragment_store is None or self.fragment_store.code_splitter is None:
+            return 0
+        
+        count = 0
+        for entry in self.workflows.values():
+            if force or not self.fragment_store.has_valid(entry):
+                fragments = self.fragment_store.compute(entry)
+                if self.fragment_index is not None:
+                    self.fragment_index.add_fragments(entry.workflow_id, fragments)
+                count += 1
+        return count
+    
+    def rebuild_vector_index(self):
+        """
+        使用库中已有的embedding重建向量索引（训练ANN索引）
+        """
+        if not self.vector_index:
+            return
+        
+        self.vector_index.rebuild(self.list_all())
+        self._save_vector_index()
+    
+    def flush(self):
+        """
+        将向量索引压缩为全量文件（append模式下批量导入结束或退出前调用）
+        """
+        if not self.vector_index:
+            return
+        
+        if self.vector_index.has_pending() or self.vector_index.delta_count > 0:
+            self._save_vector_index()
+    
     def get_workflow(self, workflow_id: str) -> Optional[WorkflowEntry]:
         """
         获取工作流
@@ -170,6 +435,62 @@ class WorkflowLibrary:
         workflow_ids = self.category_index.get(category, [])
         return [self.workflows[wid] for wid in workflow_ids if wid in self.workflows]
     
+    def filter_workflow_ids(
+        self,
+        modality: Optional[str] = None,
+        operation: Optional[str] = None,
+        complexity: Optional[WorkflowComplexity] = None,
+        tags: Optional[List[str]] = None
+    ) -> Set[str]:
+        """
+        根据元数据筛选工作流ID（各条件取交集，标签之间取并集）
+        
+        Args:
+            modality: 输出模态，如 "video" 或 "image->video"
+            operation: 操作类型（类别索引）
+            complexity: 复杂度
+            tags: 标签列表，命中任一标签即可
+            
+        Returns:
+            满足条件的workflow_id集合
+        """
+        workflow_ids = set(self.workflows)
+        
+        if modality:
+            workflow_ids &= set(self.modality_index.get(self._normalize_modality(modality), []))
+        if operation:
+            workflow_ids &= set(self.category_index.get(operation, []))
+        if complexity:
+            workflow_ids &= {wid for wid in workflow_ids if self.workflows[wid].complexity == complexity}
+        if tags:
+            tagged = set()
+            for tag in tags:
+                tagged.update(self.tag_index.get(tag, []))
+            workflow_ids &= tagged
+        
+        return workflow_ids
+    
+    def candidate_ids_for_need(self, atomic_need: AtomicNeed) -> Optional[Set[str]]:
+        """
+        根据需求的输出模态预过滤候选工作流（供WorkflowRetriever使用）
+        
+        库中没有该模态的工作流时不过滤，避免因标注偏差导致召回为空
+        
+        Args:
+            atomic_need: 原子需求
+            
+        Returns:
+            候选workflow_id集合，None表示不过滤
+        """
+        modality = self._normalize_modality(atomic_need.modality)
+        if not modality or modality not in self.modality_index:
+            return None
+        
+        candidate_ids = self.filter_workflow_ids(modality=modality)
+        if len(candidate_ids) == len(self.workflows):
+            return None
+        return candidate_ids
+    
     def list_all(self) -> List[WorkflowEntry]:
         """
         列出所有工作流
@@ -288,6 +609,73 @@ class WorkflowLibrary:
         if category not in self.category_index:
             self.category_index[category] = []
         self.category_index[category].append(entry.workflow_id)
+        
+        # 模态索引
+        modality = self._normalize_modality(entry.intent.modality)
+        if modality not in self.modality_index:
+            self.modality_index[modality] = []
+        self.modality_index[modality].append(entry.workflow_id)
+        
+        # 词法索引
+        self.lexical_index.add_document(entry.workflow_id, self._lexical_text(entry))
+    
+    def _remove_from_indexes(self, entry: WorkflowEntry):
+        """
+        从标签和类别索引中移除工作流
+        
+        Args:
+            entry: 工作流条目
+        """
+        for tag in entry.tags:
+            if entry.workflow_id in self.tag_index.get(tag, []):
+                self.tag_index[tag].remove(entry.workflow_id)
+                if not self.tag_index[tag]:
+                    del self.tag_index[tag]
+        
+        category = entry.intent.operation
+        if entry.workflow_id in self.category_index.get(category, []):
+            self.category_index[category].remove(entry.workflow_id)
+            if not self.category_index[category]:
+                del self.category_index[category]
+        
+        modality = self._normalize_modality(entry.intent.modality)
+        if entry.workflow_id in self.modality_index.get(modality, []):
+            self.modality_index[modality].remove(entry.workflow_id)
+            if not self.modality_index[modality]:
+                del self.modality_index[modality]
+        
+        self.lexical_index.remove_document(entry.workflow_id)
+    
+    @staticmethod
+    def _lexical_text(entry: WorkflowEntry) -> str:
+        """
+        拼接用于词法检索的文本（意图描述、关键词、标签和节点类型）
+        
+        Args:
+            entry: 工作流条目
+            
+        Returns:
+            文本
+        """
+        intent = entry.intent
+        parts = [intent.task, intent.description, intent.style or '']
+        parts.extend(intent.keywords)
+        parts.extend(entry.tags)
+        parts.extend(workflow_node_types(entry))
+        return ' '.join(parts)
+    
+    @staticmethod
+    def _normalize_modality(modality: Optional[str]) -> str:
+        """
+        归一化模态：需求的 "输入->输出" 格式取输出模态
+        
+        Args:
+            modality: 模态字符串，如 "video" 或 "image->video"
+            
+        Returns:
+            小写的输出模态
+        """
+        return (modality or '').split('->')[-1].strip().lower()
     
     def _save_workflow(self, entry: WorkflowEntry):
         """
@@ -296,6 +684,10 @@ class WorkflowLibrary:
         Args:
             entry: 工作流条目
         """
+        if self.store is not None:
+            self.store.put(entry)
+            return
+        
         # 保存JSON
         json_path = os.path.join(
             self.data_path,
@@ -305,91 +697,85 @@ class WorkflowLibrary:
         save_json(entry.workflow_json, json_path)
         
         # 保存元数据
-        metadata = {
-            'workflow_id': entry.workflow_id,
-            'workflow_code': entry.workflow_code,
-            'intent': {
-                'task': entry.intent.task,
-                'description': entry.intent.description,
-                'keywords': entry.intent.keywords,
-                'modality': entry.intent.modality,
-                'operation': entry.intent.operation,
-                'style': entry.intent.style
-            },
-            'intent_embedding': entry.intent_embedding,  # 保存embedding
-            'source': entry.source,
-            'complexity': entry.complexity.value,
-            'tags': entry.tags,
-            'node_count': entry.node_count,
-            'usage_count': entry.usage_count,
-            'success_rate': entry.success_rate,
-            'avg_execution_time': entry.avg_execution_time
-        }
-        
         metadata_path = os.path.join(
             self.data_path,
             'metadata',
             f'{entry.workflow_id}.meta.json'
         )
-        save_json(metadata, metadata_path)
+        save_json(entry_metadata(entry), metadata_path)
     
     def _load_library(self):
         """加载已有工作流"""
-        metadata_dir = os.path.join(self.data_path, 'metadata')
-        workflows_dir = os.path.join(self.data_path, 'workflows')
+        if self.store is not None:
+            # 首次使用单文件存储时从旧的逐工作流文件导入
+            if len(self.store) == 0 and has_legacy_files(self.data_path):
+                count = self.store.import_legacy(self.data_path)
+                print(f"[DEBUG] 已将 {count} 个工作流从旧文件导入 {self.store.path}")
+            entries = self.store.load_all(lazy=self.lazy_load)
+        else:
+            entries = load_legacy_entries(self.data_path)
+        
+        # 注意：不要重复添加到vector_index，因为已经从.faiss文件加载了
+        inline = []  # 元数据中仍内联embedding的旧版条目
+        for entry in entries:
+            if entry.embedding_row is not None:
+                if entry.embedding_row < len(self.embeddings):
+                    entry.intent_embedding = self.embeddings.row(entry.embedding_row)
+                else:
+                    print(f"[WARN] 工作流 {entry.workflow_id} 的embedding行 {entry.embedding_row} 不在embedding矩阵中")
+                    entry.embedding_row = None
+            elif entry.intent_embedding is not None:
+                inline.append(entry)
+            self.workflows[entry.workflow_id] = entry
+            self._update_indexes(entry)
+        
+        if inline:
+            self._migrate_inline_embeddings(inline)
+    
+    def compact_embeddings(self) -> int:
+        """
+        回收embedding矩阵中已删除工作流留下的行，并更新条目的行号（离线维护时调用，其他进程不能同时打开该库）
         
-        if not os.path.exists(metadata_dir):
-            return
+        Returns:
+            回收的行数
+        """
+        entries = [entry for entry in self.workflows.values() if entry.embedding_row is not None]
+        total = len(self.embeddings)
+        mapping = self.embeddings.compact(entry.embedding_row for entry in entries)
+        
+        moved = []
+        for entry in entries:
+            new_row = mapping[entry.embedding_row]
+            if new_row != entry.embedding_row:
+                entry.embedding_row = new_row
+                moved.append(entry)
+            entry.intent_embedding = self.embeddings.row(new_row)
+        
+        if self.store is not None:
+            self.store.put_many(moved)
+        else:
+            for entry in moved:
+                self._save_workflow(entry)
+        return total - len(self.embeddings)
+    
+    def _migrate_inline_embeddings(self, entries: List[WorkflowEntry]):
+        """
+        将元数据中内联的embedding列表一次性写入embedding矩阵，并重写这些条目的元数据（只保留行号）
         
-        for filename in os.listdir(metadata_dir):
-            if not filename.endswith('.meta.json'):
-                continue
-            
-            metadata_path = os.path.join(metadata_dir, filename)
-            workflow_id = filename.replace('.meta.json', '')
-            
-            try:
-                # 加载元数据
-                metadata = load_json(metadata_path)
-                
-                # 加载JSON
-                json_path = os.path.join(workflows_dir, f'{workflow_id}.json')
-                workflow_json = load_json(json_path)
-                
-                # 构建意图
-                intent_data = metadata['intent']
-                intent = WorkflowIntent(
-                    task=intent_data['task'],
-                    description=intent_data['description'],
-                    keywords=intent_data['keywords'],
-                    modality=intent_data['modality'],
-                    operation=intent_data['operation'],
-                    style=intent_data.get('style')
-                )
-                
-                # 创建条目
-                entry = WorkflowEntry(
-                    workflow_id=workflow_id,
-                    workflow_json=workflow_json,
-                    workflow_code=metadata['workflow_code'],
-                    intent=intent,
-                    intent_embedding=metadata.get('intent_embedding'),  # 从文件加载
-                    source=metadata.get('source', 'unknown'),
-                    complexity=WorkflowComplexity(metadata.get('complexity', 'vanilla')),
-                    tags=metadata.get('tags', []),
-                    node_count=metadata.get('node_count', 0),
-                    usage_count=metadata.get('usage_count', 0),
-                    success_rate=metadata.get('success_rate', 1.0),
-                    avg_execution_time=metadata.get('avg_execution_time', 0.0)
-                )
-                
-                self.workflows[workflow_id] = entry
-                self._update_indexes(entry)
-                
-                # 注意：不要重复添加到vector_index，因为已经从.faiss文件加载了
-                
-            except Exception as e:
-                print(f"加载工作流 {workflow_id} 失败: {e}")
+        Args:
+            entries: 尚未迁移的工作流条目
+        """
+        rows = self.embeddings.add_many([entry.intent_embedding for entry in entries])
+        for entry, row in zip(entries, rows):
+            entry.embedding_row = row
+            entry.intent_embedding = self.embeddings.row(row)
+        
+        if self.store is not None:
+            self.store.put_many(entries)
+        else:
+            for entry in entries:
+                self._save_workflow(entry)
+        print(f"[DEBUG] 已将 {len(entries)} 个工作流的embedding迁移到 {self.embeddings.path}")
     
     def _count_by_complexity(self) -> Dict[str, int]:
         """按复杂度统计"""
@@ -420,9 +806,33 @@ class WorkflowLibrary:
         sorted_tags = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)
         return sorted_tags[:n]
     
+    def _persist_vector_index(self):
+        """按持久化方式保存向量索引的变更"""
+        # 样本足够后将退化的flat索引升级为配置的索引类型，或清理过多的HNSW墓碑
+        if self.vector_index.needs_rebuild():
+            self.rebuild_vector_index()
+            return
+        
+        if self.persistence_mode == 'full':
+            self._save_vector_index()
+            return
+        
+        try:
+            self.vector_index.append_delta(self.vector_index_path)
+        except Exception as e:
+            print(f"[WARN] 追加向量索引日志失败: {e}")
+            return
+        
+        # 追加日志过长时压缩
+        if self.vector_index.delta_count >= self.compact_threshold:
+            self._save_vector_index()
+    
     def _save_vector_index(self):
         """保存向量索引"""
-        if self.vector_index and self.vector_index.index.ntotal > 0:
+        if not self.vector_index:
+            return
+        # 库被删空时也要覆盖旧文件
+        if self.vector_index.index.ntotal > 0 or VectorIndex.exists(self.vector_index_path):
             try:
                 self.vector_index.save(self.vector_index_path)
                 print(f"[DEBUG] 向量索引已保存到: {self.vector_index_path}")
@@ -431,9 +841,27 @@ class WorkflowLibrary:
     
     def _load_vector_index(self):
         """加载向量索引"""
-        if self.vector_index and os.path.exists(self.vector_index_path):
+        if self.vector_index and VectorIndex.exists(self.vector_index_path):
             try:
                 self.vector_index.load(self.vector_index_path)
                 print(f"[DEBUG] 向量索引已加载，包含 {self.vector_index.index.ntotal} 个向量")
+                if self.vector_index.needs_rebuild():
+                    print(f"[DEBUG] 向量索引 ({self.vector_index.active_type}) 与配置不一致或墓碑过多，重建索引")
+                    self.rebuild_vector_index()
             except Exception as e:
                 print(f"[WARN] 加载向量索引失败: {e}，将使用新索引")
+    
+    def _load_fragment_index(self):
+        """用片段存储中已有的有效片段的embedding构建片段索引（不触发拆分，缺失的片段由precompute_fragments回填）"""
+        if self.fragment_index is None or self.fragment_store is None:
+            return
+        
+        if self.fragment_index.fragment_loader is None:
+            self.fragment_index.fragment_loader = self._stored_fragments
+        
+        # 向量直接取自片段embedding矩阵，不读取片段文件
+        for entry in self.workflows.values():
+            embeddings = self.fragment_store.stored_embeddings(entry)
+            if embeddings:
+                self.fragment_index.add_embeddings(entry.workflow_id, embeddings)
+        print(f"[DEBUG] 片段索引已构建，包含 {len(self.fragment_index)} 个片段")
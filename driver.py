@@ -9,6 +9,9 @@ import json
 import os
 import sys
 import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Any, Tuple
 from core.data_structures import (
     AtomicNeed, DecomposedNeeds, WorkflowFragment, WorkflowFramework
@@ -18,12 +21,23 @@ from core.code_splitter import CodeSplitter
 from core.fragment_matcher import FragmentMatcher
 from core.workflow_assembler import WorkflowAssembler, CodeToJsonConverter
 from core.workflow_library import WorkflowLibrary
-from core.vector_search import VectorIndex, Reranker, WorkflowRetriever
+from core.fragment_store import FragmentStore
+from core.cache import RerankCache
+from core.vector_search import Reranker, WorkflowRetriever, create_vector_index, FragmentIndex
 from core.llm_client import LLMClient
 from core.utils import load_config, load_node_definitions
 from main import parse_code_to_prompt  # 从已有的双向解析器导入
 
 
+@dataclass
+class _NeedPipelines:
+    """一次请求中各原子需求的检索→拆分链（检索按批合并）"""
+    submitted: Dict[str, Tuple[AtomicNeed, Future]] = field(default_factory=dict)  # {need_id: (need, future)}
+    pending: List[Tuple[AtomicNeed, Future]] = field(default_factory=list)  # 等待下一批检索的需求
+    running: bool = False  # 是否有检索批次正在执行
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
 class ComfyUIWorkflowGenerator:
     """
     ComfyUI工作流生成系统主类
@@ -80,10 +94,23 @@ class ComfyUIWorkflowGenerator:
         """初始化所有组件"""
         try:
             # 1. 需求分解器
-            self.need_decomposer = NeedDecomposer(self.llm_client)
+            decomposition_config = self.config.get('need_decomposition', {})
+            self.need_decomposer = NeedDecomposer(
+                self.llm_client,
+                streaming=decomposition_config.get('streaming', False)
+            )
             self.logger.info("需求分解器初始化完成")
             
-            # 2. 工作流库（包含vector_index）
+            # 2. 代码拆分器（工作流库预拆分片段时也会用到）
+            split_config = self.config.get('code_splitting', {})
+            self.code_splitter = CodeSplitter(
+                llm_client=self.llm_client,
+                node_defs=self.node_defs,
+                strategy=split_config.get('strategy', 'hybrid')
+            )
+            self.logger.info("代码拆分器初始化完成")
+            
+            # 3. 工作流库（包含vector_index）
             library_config = self.config.get('workflow_library', {})
             library_path = library_config.get('data_path', './data/workflow_library')
             vector_index_path = library_config.get('vector_index_path', './data/workflow_library/embeddings.faiss')
@@ -97,44 +124,102 @@ class ComfyUIWorkflowGenerator:
             else:
                 dimension = 3072
             
-            vector_index = VectorIndex(dimension=dimension)
+            vector_index = create_vector_index(self.config, dimension)
+            
+            # 预拆分片段存储（与元数据文件放在一起）
+            fragments_config = library_config.get('fragments', {})
+            fragment_store = None
+            fragment_index = None
+            if fragments_config.get('enabled', False):
+                fragment_store = FragmentStore(
+                    directory=os.path.join(library_path, 'metadata'),
+                    code_splitter=self.code_splitter,
+                    llm_client=self.llm_client
+                )
+                # 片段级向量索引：需求直接跨工作流检索片段
+                if fragments_config.get('index', False):
+                    fragment_index = FragmentIndex(dimension)
             
             # 初始化工作流库
+            persistence_config = library_config.get('persistence', {})
             self.workflow_library = WorkflowLibrary(
                 data_path=library_path,
                 llm_client=self.llm_client,
                 vector_index=vector_index,
-                vector_index_path=vector_index_path
+                vector_index_path=vector_index_path,
+                persistence_mode=persistence_config.get('mode', 'full'),
+                compact_threshold=persistence_config.get('compact_threshold', 1000),
+                storage=library_config.get('storage', 'files'),
+                lazy_load=library_config.get('lazy_load', False),
+                body_cache_size=library_config.get('body_cache_size', 256),
+                fragment_store=fragment_store,
+                fragment_index=fragment_index
             )
             self.logger.info(f"工作流库初始化完成，包含 {len(self.workflow_library.workflows)} 个工作流")
             self.logger.info(f"向量索引包含 {vector_index.index.ntotal} 个向量")
             
-            # 3. 检索器（使用workflow_library中的vector_index）
+            # 4. 检索器（使用workflow_library中的vector_index）
             reranker_config = self.config.get('reranker', {})
-            reranker = Reranker(config=reranker_config)
+            rerank_cache_config = self.config.get('rerank_cache', {})
+            rerank_cache = None
+            if rerank_cache_config.get('enabled', False):
+                rerank_cache = RerankCache(
+                    path=rerank_cache_config.get('path', './data/cache/rerank_scores.sqlite'),
+                    max_entries=rerank_cache_config.get('max_entries', 200000)
+                )
+            reranker = Reranker(
+                config=reranker_config,
+                rate_limit=self.config.get('rate_limits', {}).get('rerank'),
+                cache=rerank_cache
+            )
+            retrieval_config = library_config.get('retrieval', {})
+            hybrid_config = retrieval_config.get('hybrid', {})
             self.workflow_retriever = WorkflowRetriever(
                 llm_client=self.llm_client,
                 vector_index=self.workflow_library.vector_index,  # 使用已加载的索引
                 reranker=reranker,
-                workflow_library=self.workflow_library.workflows
+                workflow_library=self.workflow_library.workflows,
+                similarity_threshold=retrieval_config.get('similarity_threshold', 0.0),
+                candidate_filter=(
+                    self.workflow_library.candidate_ids_for_need
+                    if retrieval_config.get('metadata_filter', False) else None
+                ),
+                lexical_index=(
+                    self.workflow_library.lexical_index
+                    if hybrid_config.get('enabled', False) else None
+                ),
+                lexical_top_k=hybrid_config.get('lexical_top_k', 20),
+                rrf_k=hybrid_config.get('rrf_k', 60),
+                fragment_index=fragment_index,
+                max_rerank_candidates=reranker_config.get(
+                    'max_candidates', 50 if reranker_config.get('type') == 'local' else 4
+                )
             )
+            self.fragment_top_k = fragments_config.get('top_k', 8)
+            # 每个需求的向量召回数量和重排序后保留数量（批量检索与逐个检索使用同一配置）
+            self.top_k_recall = retrieval_config.get('top_k_recall', 9)
+            self.top_k_rerank = retrieval_config.get('top_k_rerank', 3)
             self.logger.info("检索器初始化完成")
             
-            # 4. 代码拆分器
-            split_config = self.config.get('code_splitting', {})
-            self.code_splitter = CodeSplitter(
-                llm_client=self.llm_client,
-                node_defs=self.node_defs,
-                strategy=split_config.get('strategy', 'hybrid')
-            )
-            self.logger.info("代码拆分器初始化完成")
+            # 各原子需求的检索→拆分链和片段匹配在线程池中并行执行；
+            # 流式分解时每个需求一解析出来就提交，不等整个回复结束
+            pipeline_config = self.config.get('pipeline', {})
+            self.pipeline_executor = None
+            if pipeline_config.get('parallel', False) or self.need_decomposer.streaming:
+                self.pipeline_executor = ThreadPoolExecutor(
+                    max_workers=pipeline_config.get('max_workers', 8)
+                )
             
             # 5. 片段匹配器
             match_config = self.config.get('fragment_matching', {})
             self.fragment_matcher = FragmentMatcher(
                 llm_client=self.llm_client,
                 matching_threshold=match_config.get('matching_threshold', 0.65),
-                use_llm=match_config.get('use_llm', True)
+                use_llm=match_config.get('use_llm', True),
+                batch_size=match_config.get('batch_size', 1),
+                max_batch_chars=match_config.get('max_batch_chars', 12000),
+                prefilter_top_n=match_config.get('prefilter_top_n', 0),
+                prefilter_rule_weight=match_config.get('prefilter_rule_weight', 0.3)
             )
             self.logger.info("片段匹配器初始化完成")
             
@@ -169,7 +254,12 @@ class ComfyUIWorkflowGenerator:
             print("阶段1: 需求分解")
             print("="*80)
             self.logger.info("阶段1: 需求分解...")
-            decomposed_needs = self.need_decomposer.decompose(user_request)
+            pipelines = _NeedPipelines()
+            decomposed_needs = self.need_decomposer.decompose(
+                user_request,
+                on_need=(lambda need: self._submit_need_pipelines([need], pipelines, top_k_per_need=self.top_k_rerank))
+                if self.pipeline_executor is not None else None
+            )
             self.logger.info(f"分解结果: {len(decomposed_needs.atomic_needs)}个原子需求")
             
             print(f"\n分解为 {len(decomposed_needs.atomic_needs)} 个原子需求:")
@@ -184,10 +274,22 @@ class ComfyUIWorkflowGenerator:
             print("阶段1: 检索候选工作流")
             print("="*80)
             self.logger.info("阶段1: 检索候选工作流...")
-            candidate_workflows = self.workflow_retriever.retrieve_for_all_needs(
-                decomposed_needs.atomic_needs,
-                top_k_per_need=5
-            )
+            if self.pipeline_executor is not None:
+                # 并行模式：需求按批检索（一次批量搜索和重排序），之后各需求的拆分并行执行
+                candidate_workflows, need_fragments = self._collect_need_pipelines(
+                    decomposed_needs.atomic_needs,
+                    pipelines,
+                    top_k_per_need=self.top_k_rerank
+                )
+            else:
+                need_embeddings = self.workflow_retriever.embed_needs(decomposed_needs.atomic_needs)
+                candidate_workflows = self.workflow_retriever.retrieve_for_all_needs(
+                    decomposed_needs.atomic_needs,
+                    top_k_per_need=self.top_k_rerank,
+                    top_k_recall=self.top_k_recall,
+                    need_embeddings=need_embeddings
+                )
+                need_fragments = None
             
             print(f"\n检索结果:")
             for need in decomposed_needs.atomic_needs:
@@ -203,29 +305,30 @@ class ComfyUIWorkflowGenerator:
             print("阶段2: 工作流拆分和匹配")
             print("="*80)
             all_fragments = []
+            seen_fragments = set()
             
             self.logger.info("阶段2: 工作流拆分和匹配...")
             for need in decomposed_needs.atomic_needs:
-                need_candidates = candidate_workflows.get(need.need_id, [])
-                
-                if not need_candidates:
-                    self.logger.warning(f"需求 '{need.description}' 未找到匹配的工作流")
-                    continue
-                
-                self.logger.info(f"需求 '{need.description}' 找到 {len(need_candidates)} 个候选工作流")
-                
-                # 拆分最优候选工作流为片段
-                best_candidate = need_candidates[0]  # 最优工作流
-                fragments = self.code_splitter.split(best_candidate)
-                self.logger.info(f"拆分为 {len(fragments)} 个片段")
-                
-                all_fragments.extend(fragments)
+                if need_fragments is not None:
+                    # 并行模式下已在检索后立即拆分
+                    fragments = need_fragments.get(need.need_id, [])
+                else:
+                    fragments = self._need_fragments(
+                        need, candidate_workflows.get(need.need_id, []), need_embeddings.get(need.need_id)
+                    )
+                # 同一片段可能被多个需求直接检索到，只匹配一次
+                for fragment in fragments:
+                    key = (fragment.source_workflow_id, fragment.fragment_id)
+                    if key not in seen_fragments:
+                        seen_fragments.add(key)
+                        all_fragments.append(fragment)
             
-            # 将片段匹配到原子需求
+            # 将片段匹配到原子需求（并行模式下各需求的判断并发执行）
             self.logger.info("阶段2: 片段-需求匹配...")
             fragment_need_mapping = self.fragment_matcher.match_fragments_to_needs(
                 all_fragments,
-                decomposed_needs.atomic_needs
+                decomposed_needs.atomic_needs,
+                executor=self.pipeline_executor
             )
             
             # 收集所有匹配的片段
@@ -302,6 +405,10 @@ class ComfyUIWorkflowGenerator:
             }
             
             self.logger.info(f"工作流生成完成，成功状态: {result['success']}")
+            if self.llm_client.embedding_cache is not None:
+                self.logger.info(f"Embedding缓存统计: {self.llm_client.embedding_cache.stats()}")
+            if self.llm_client.chat_cache is not None:
+                self.logger.info(f"Chat回复缓存统计: {self.llm_client.chat_cache.stats()}")
             return result
             
         except Exception as e:
@@ -316,6 +423,181 @@ class ComfyUIWorkflowGenerator:
                 "error": str(e)
             }
     
+    def _split_best_candidate(self, need: AtomicNeed, candidates: List) -> List[WorkflowFragment]:
+        """
+        拆分需求的最优候选工作流为片段
+        
+        Args:
+            need: 原子需求
+            candidates: 按相关性排序的候选工作流
+            
+        Returns:
+            片段列表，没有候选时为空
+        """
+        if not candidates:
+            self.logger.warning(f"需求 '{need.description}' 未找到匹配的工作流")
+            return []
+        
+        self.logger.info(f"需求 '{need.description}' 找到 {len(candidates)} 个候选工作流")
+        
+        best_candidate = candidates[0]  # 最优工作流
+        # 优先使用入库时预拆分的片段，没有时现场拆分
+        fragments = self.workflow_library.get_fragments(best_candidate)
+        if fragments is None:
+            fragments = self.code_splitter.split(best_candidate)
+        self.logger.info(f"拆分为 {len(fragments)} 个片段")
+        return fragments
+    
+    def _need_fragments(
+        self,
+        need: AtomicNeed,
+        candidates: List,
+        query_embedding: Optional[List[float]] = None
+    ) -> List[WorkflowFragment]:
+        """
+        获取需求的候选片段：优先从片段索引跨工作流直接检索，没有命中时拆分最优候选工作流
+        
+        Args:
+            need: 原子需求
+            candidates: 按相关性排序的候选工作流
+            query_embedding: 工作流检索时已生成的需求embedding
+            
+        Returns:
+            片段列表
+        """
+        fragments = self.workflow_retriever.retrieve_fragments(
+            need, top_k=self.fragment_top_k, query_embedding=query_embedding
+        )
+        if fragments:
+            sources = {fragment.source_workflow_id for fragment in fragments}
+            self.logger.info(f"需求 '{need.description}' 从 {len(sources)} 个工作流直接检索到 {len(fragments)} 个片段")
+            return fragments
+        return self._split_best_candidate(need, candidates)
+    
+    def _submit_need_pipelines(
+        self,
+        needs: List[AtomicNeed],
+        pipelines: '_NeedPipelines',
+        top_k_per_need: int
+    ):
+        """
+        提交原子需求的检索→拆分链（流式分解的on_need回调）
+        
+        检索按批进行：没有批次在执行时立即开始一批，执行期间到达的需求并入下一批，
+        使rerank_many和批量向量搜索一次覆盖多个需求；检索完成后各需求的拆分并行执行
+        
+        Args:
+            needs: 原子需求列表
+            pipelines: 本次请求的流水线状态，就地更新
+            top_k_per_need: 每个需求返回的工作流数量
+        """
+        with pipelines.lock:
+            for need in needs:
+                self.logger.info(f"需求 {need.need_id} 加入检索队列")
+                future = Future()
+                pipelines.submitted[need.need_id] = (need, future)
+                pipelines.pending.append((need, future))
+            start = not pipelines.running and bool(pipelines.pending)
+            if start:
+                pipelines.running = True
+        
+        if start:
+            self.pipeline_executor.submit(self._run_retrieval_batches, pipelines, top_k_per_need)
+    
+    def _run_retrieval_batches(self, pipelines: '_NeedPipelines', top_k_per_need: int):
+        """
+        依次检索队列中的需求，直到队列为空（在线程池中执行）
+        
+        Args:
+            pipelines: 本次请求的流水线状态
+            top_k_per_need: 每个需求返回的工作流数量
+        """
+        while True:
+            with pipelines.lock:
+                batch = pipelines.pending
+                pipelines.pending = []
+                if not batch:
+                    pipelines.running = False
+                    return
+            
+            needs = [need for need, _ in batch]
+            self.logger.info(f"批量检索 {len(needs)} 个需求")
+            try:
+                need_embeddings = self.workflow_retriever.embed_needs(needs)
+                candidate_workflows = self.workflow_retriever.retrieve_for_all_needs(
+                    needs,
+                    top_k_per_need=top_k_per_need,
+                    top_k_recall=self.top_k_recall,
+                    need_embeddings=need_embeddings
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            for need, future in batch:
+                self.pipeline_executor.submit(
+                    self._split_need_pipeline,
+                    need,
+                    candidate_workflows.get(need.need_id, []),
+                    need_embeddings.get(need.need_id),
+                    future
+                )
+    
+    def _split_need_pipeline(
+        self,
+        need: AtomicNeed,
+        candidates: List,
+        query_embedding: Optional[List[float]],
+        future: Future
+    ):
+        """
+        单个原子需求检索之后的拆分（在线程池中执行），结果写入future
+        
+        Args:
+            need: 原子需求
+            candidates: 检索到的候选工作流
+            query_embedding: 检索时生成的需求embedding（片段检索复用）
+            future: 结果 (候选工作流列表, 候选片段列表)
+        """
+        try:
+            future.set_result((candidates, self._need_fragments(need, candidates, query_embedding)))
+        except Exception as e:
+            future.set_exception(e)
+    
+    def _collect_need_pipelines(
+        self,
+        atomic_needs: List[AtomicNeed],
+        pipelines: '_NeedPipelines',
+        top_k_per_need: int
+    ) -> Tuple[Dict[str, List], Dict[str, List[WorkflowFragment]]]:
+        """
+        将尚未提交的需求作为一批提交，并按需求顺序汇总结果
+        
+        Args:
+            atomic_needs: 最终的原子需求列表
+            pipelines: 流式分解阶段的流水线状态
+            top_k_per_need: 每个需求返回的工作流数量
+            
+        Returns:
+            ({need_id: [WorkflowEntry]}, {need_id: [WorkflowFragment]})
+        """
+        # 分解回退等情况下最终需求与已提交的不是同一对象，需重新提交
+        missing = [
+            need for need in atomic_needs
+            if need.need_id not in pipelines.submitted or pipelines.submitted[need.need_id][0] is not need
+        ]
+        if missing:
+            self._submit_need_pipelines(missing, pipelines, top_k_per_need)
+        
+        candidate_workflows = {}
+        need_fragments = {}
+        for need in atomic_needs:
+            candidates, fragments = pipelines.submitted[need.need_id][1].result()
+            candidate_workflows[need.need_id] = candidates
+            need_fragments[need.need_id] = fragments
+        return candidate_workflows, need_fragments
+    
     def generate_from_json(self, user_request: str, context: Optional[Dict] = None) -> str:
         """
         生成工作流并返回JSON字符串
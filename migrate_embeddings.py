@@ -2,13 +2,15 @@
 # -*- coding: utf-8 -*-
 """
 迁移脚本：为现有workflow添加embedding到metadata
-这样下次加载时就不需要重新生成了
+这样下次加载时就不需要重新生成了；最后回收embedding矩阵中不再被引用的行
 """
 
 import os
 import json
 from core.llm_client import LLMClient
 from core.utils import load_config
+from core.workflow_library import WorkflowLibrary
+from core.fragment_store import FragmentStore
 
 print("=" * 80)
 print("Embedding迁移脚本")
@@ -35,11 +37,13 @@ updated_count = 0
 skipped_count = 0
 error_count = 0
 
+# 1. 收集缺少embedding的workflow
+pending = []  # [(metadata_path, metadata)]
 for i, filename in enumerate(metadata_files, 1):
     metadata_path = os.path.join(metadata_dir, filename)
     workflow_id = filename.replace('.meta.json', '')
     
-    print(f"\n[{i}/{len(metadata_files)}] 处理: {workflow_id}")
+    print(f"\n[{i}/{len(metadata_files)}] 检查: {workflow_id}")
     
     try:
         # 加载metadata
@@ -47,18 +51,24 @@ for i, filename in enumerate(metadata_files, 1):
             metadata = json.load(f)
         
         # 检查是否已有embedding
-        if 'intent_embedding' in metadata and metadata['intent_embedding'] is not None:
+        if metadata.get('intent_embedding') is not None or metadata.get('embedding_row') is not None:
             print(f"  ✓ 已有embedding，跳过")
             skipped_count += 1
             continue
         
-        # 生成embedding
-        description = metadata['intent']['description']
-        print(f"  描述: {description}")
-        print(f"  生成embedding...")
-        
-        embedding = llm_client.embed(description)
-        
+        print(f"  描述: {metadata['intent']['description']}")
+        pending.append((metadata_path, metadata))
+            
+    except Exception as e:
+        print(f"  ❌ 处理失败: {e}")
+        error_count += 1
+
+# 2. 批量生成embedding
+if pending:
+    print(f"\n批量生成 {len(pending)} 个embedding...")
+    embeddings = llm_client.embed_batch([metadata['intent']['description'] for _, metadata in pending])
+    
+    for (metadata_path, metadata), embedding in zip(pending, embeddings):
         if embedding:
             # 更新metadata
             metadata['intent_embedding'] = embedding
@@ -67,15 +77,23 @@ for i, filename in enumerate(metadata_files, 1):
             with open(metadata_path, 'w', encoding='utf-8') as f:
                 json.dump(metadata, f, indent=2, ensure_ascii=False)
             
-            print(f"  ✅ 已更新 (维度: {len(embedding)})")
+            print(f"  ✅ 已更新 {metadata.get('workflow_id', metadata_path)} (维度: {len(embedding)})")
             updated_count += 1
         else:
-            print(f"  ❌ embedding生成失败")
+            print(f"  ❌ embedding生成失败: {metadata.get('workflow_id', metadata_path)}")
             error_count += 1
-            
-    except Exception as e:
-        print(f"  ❌ 处理失败: {e}")
-        error_count += 1
+
+# 3. 回收embedding矩阵中已删除工作流和重新拆分的片段留下的行
+#    矩阵只追加不复用行，运行本脚本前需停止driver和recorder
+library_config = config.get('workflow_library', {})
+print("\n回收embedding矩阵中的空行...")
+library = WorkflowLibrary(
+    data_path=workflow_lib_path,
+    storage=library_config.get('storage', 'files')
+)
+reclaimed_count = library.compact_embeddings()
+if os.path.exists(os.path.join(metadata_dir, FragmentStore.MATRIX_FILENAME)):
+    reclaimed_count += FragmentStore(metadata_dir).compact_embeddings()
 
 print("\n" + "=" * 80)
 print("迁移完成")
@@ -84,4 +102,5 @@ print(f"✅ 更新: {updated_count}")
 print(f"⏭  跳过: {skipped_count}")
 print(f"❌ 失败: {error_count}")
 print(f"📊 总计: {len(metadata_files)}")
+print(f"♻  回收embedding行: {reclaimed_count}")
 print("\n下次启动driver时将直接从文件加载embedding，无需重新生成！")
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+迁移脚本：将逐工作流的 metadata/{id}.meta.json + workflows/{id}.json 导入单文件存储 library.sqlite
+导入后在config.yaml中设置 workflow_library.storage: "sqlite"，启动时只需一次顺序读取
+"""
+
+import os
+import sys
+from core.library_store import LibraryStore, has_legacy_files
+from core.utils import load_config
+
+print("=" * 80)
+print("工作流库存储迁移脚本")
+print("=" * 80)
+
+# 工作流库路径
+config = load_config('config.yaml')
+workflow_lib_path = config.get('workflow_library', {}).get('data_path', './data/workflow_library')
+
+if not has_legacy_files(workflow_lib_path):
+    print(f"错误: 在 {workflow_lib_path}/metadata 中找不到 .meta.json 文件")
+    sys.exit(1)
+
+store = LibraryStore(os.path.join(workflow_lib_path, LibraryStore.FILENAME))
+before = len(store)
+
+print(f"\n导入到: {store.path}（已有 {before} 个工作流）")
+imported = store.import_legacy(workflow_lib_path)
+after = len(store)
+store.close()
+
+print("\n" + "=" * 80)
+print("迁移完成")
+print("=" * 80)
+print(f"✅ 导入: {imported}")
+print(f"📊 存储中共有: {after}")
+print("\n旧文件已保留；确认无误后可删除 metadata/*.meta.json 和 workflows/*.json")
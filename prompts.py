@@ -225,6 +225,50 @@ FRAGMENT_NEED_MATCHING_PROMPT = """你是ComfyUI工作流专家。请判断给
 只返回JSON，不要其他内容。
 """
 
+FRAGMENT_NEED_BATCH_MATCHING_PROMPT = """你是ComfyUI工作流专家。请逐个判断下面的每个代码片段是否能够满足用户的原子需求。
+
+用户的原子需求:
+描述: {need_description}
+类别: {need_category}
+模态: {need_modality}
+约束条件: {need_constraints}
+
+候选代码片段（共{fragment_count}个，编号从0开始）:
+{fragments}
+
+评判标准（重要）：
+1. **功能意图是否一致**（最重要，权重70%）
+   - 片段是否能实现需求描述的功能？
+   - 不需要完全相同，只要能达到目标即可
+   - 例如：需求是"生成图像"，KSampler可以满足
+
+2. **输入输出类型是否匹配**（权重20%）
+   - 片段的输入能否从上下文获得？
+   - 片段的输出是否是需求期望的类型？
+
+3. **约束条件是否满足**（权重10%）
+   - 如风格、尺寸、模型等特定要求
+   - 如果约束可以通过修改参数满足，也算满足
+
+每个片段独立评判，互不影响。对每个片段给出：是否满足、匹配置信度（0-1之间的浮点数）、简短理由。
+
+输出JSON格式（results中每个片段一项，index为片段编号）：
+{{
+    "results": [
+        {{"index": 0, "matched": true, "confidence": 0.85, "reason": "使用KSampler进行图像生成，能够满足核心功能"}},
+        {{"index": 1, "matched": false, "confidence": 0.2, "reason": "VAEDecode只负责解码，与超分辨率需求不一致"}}
+    ]
+}}
+
+只返回JSON，不要其他内容。
+"""
+
+FRAGMENT_BATCH_ITEM_TEMPLATE = """### 片段 {index}
+功能: {fragment_function}
+```python
+{code_fragment}
+```"""
+
 # ============================================================================
 # 片段组合可行性判断
 # ============================================================================
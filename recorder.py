@@ -9,11 +9,14 @@ import json
 import os
 import sys
 import argparse
-from typing import Dict, Any, Optional, List
+import dataclasses
+from typing import Dict, Any, Optional, List, Tuple
 from core.workflow_library import WorkflowLibrary
+from core.fragment_store import FragmentStore
+from core.code_splitter import CodeSplitter
 from core.llm_client import LLMClient
-from core.vector_search import VectorIndex
-from core.utils import load_config, load_json, save_json
+from core.vector_search import create_vector_index
+from core.utils import load_config, load_json, save_json, load_node_definitions
 from main import parse_prompt_to_code  # 从已有的双向解析器导入
 
 
@@ -47,18 +50,40 @@ class WorkflowRecorder:
         else:
             dimension = 3072  # text-embedding-3-large的维度
         
-        self.vector_index = VectorIndex(dimension=dimension)
+        self.vector_index = create_vector_index(self.config, dimension)
         
         # 初始化工作流库
         library_config = self.config.get('workflow_library', {})
         library_path = library_config.get('data_path', './data/workflow_library')
         vector_index_path = library_config.get('vector_index_path', './data/workflow_library/embeddings.faiss')
+        persistence_config = library_config.get('persistence', {})
+        
+        # 入库时预拆分片段（请求时直接查表，不再现场拆分）
+        fragment_store = None
+        if library_config.get('fragments', {}).get('enabled', False):
+            node_defs_path = self.config.get('node_definitions', {}).get('yaml_path', './previouswork/nodes.yaml')
+            code_splitter = CodeSplitter(
+                llm_client=self.llm_client,
+                node_defs=load_node_definitions(node_defs_path),
+                strategy=self.config.get('code_splitting', {}).get('strategy', 'hybrid')
+            )
+            fragment_store = FragmentStore(
+                directory=os.path.join(library_path, 'metadata'),
+                code_splitter=code_splitter,
+                llm_client=self.llm_client
+            )
         
         self.workflow_library = WorkflowLibrary(
             data_path=library_path,
             llm_client=self.llm_client,
             vector_index=self.vector_index,
-            vector_index_path=vector_index_path
+            vector_index_path=vector_index_path,
+            persistence_mode=persistence_config.get('mode', 'full'),
+            compact_threshold=persistence_config.get('compact_threshold', 1000),
+            storage=library_config.get('storage', 'files'),
+            lazy_load=library_config.get('lazy_load', False),
+            body_cache_size=library_config.get('body_cache_size', 256),
+            fragment_store=fragment_store
         )
         
         print(f"工作流库初始化完成，当前包含 {len(self.workflow_library.workflows)} 个工作流")
@@ -77,18 +102,7 @@ class WorkflowRecorder:
             添加是否成功
         """
         try:
-            # 加载工作流JSON
-            print(f"加载工作流文件: {workflow_path}")
-            with open(workflow_path, 'r', encoding='utf-8') as f:
-                workflow_json = json.load(f)
-            
-            # 转换为代码表示
-            print("转换为代码表示...")
-            try:
-                workflow_code = parse_prompt_to_code(workflow_json)
-            except Exception as e:
-                print(f"代码转换失败，使用JSON字符串作为代码表示: {e}")
-                workflow_code = f"# 从JSON转换失败\n# 原始JSON: {json.dumps(workflow_json, ensure_ascii=False)[:200]}..."
+            workflow_json, workflow_code = self._load_workflow_file(workflow_path)
             
             # 准备元数据
             metadata = {
@@ -119,6 +133,31 @@ class WorkflowRecorder:
             traceback.print_exc()
             return False
     
+    def _load_workflow_file(self, workflow_path: str) -> Tuple[Dict[str, Any], str]:
+        """
+        加载工作流JSON文件并转换为代码表示
+        
+        Args:
+            workflow_path: 工作流JSON文件路径
+            
+        Returns:
+            (工作流JSON, 代码表示)
+        """
+        # 加载工作流JSON
+        print(f"加载工作流文件: {workflow_path}")
+        with open(workflow_path, 'r', encoding='utf-8') as f:
+            workflow_json = json.load(f)
+        
+        # 转换为代码表示
+        print("转换为代码表示...")
+        try:
+            workflow_code = parse_prompt_to_code(workflow_json)
+        except Exception as e:
+            print(f"代码转换失败，使用JSON字符串作为代码表示: {e}")
+            workflow_code = f"# 从JSON转换失败\n# 原始JSON: {json.dumps(workflow_json, ensure_ascii=False)[:200]}..."
+        
+        return workflow_json, workflow_code
+    
     def add_workflow_from_dict(
         self, 
         workflow_json: Dict[str, Any],
@@ -202,14 +241,78 @@ class WorkflowRecorder:
         
         print(f"找到 {len(workflow_files)} 个工作流文件")
         
+        # 1. 加载所有文件
+        workflows = []
         for workflow_file in workflow_files:
             print(f"\n处理文件: {workflow_file}")
-            if self.add_workflow_from_json(workflow_file, source="batch"):
-                success_count += 1
+            try:
+                workflow_json, workflow_code = self._load_workflow_file(workflow_file)
+            except Exception as e:
+                print(f"加载工作流失败: {e}")
+                continue
+            workflows.append((workflow_json, workflow_code, {'source': 'batch', 'tags': []}))
+        
+        # 2. 批量入库（意图逐个提取，embedding批量生成）
+        if workflows:
+            try:
+                entries = self.workflow_library.add_workflows(workflows)
+                success_count = len(entries)
+                for entry in entries:
+                    print(f"成功添加工作流到库: {entry.workflow_id} ({entry.intent.description})")
+            except Exception as e:
+                print(f"批量添加工作流失败: {e}")
+                import traceback
+                traceback.print_exc()
+        
+        # 批量导入结束后一次性写出向量索引
+        self.workflow_library.flush()
         
         print(f"\n批量添加完成: {success_count}/{len(workflow_files)} 个成功")
+        if self.llm_client.embedding_cache is not None:
+            print(f"Embedding缓存统计: {self.llm_client.embedding_cache.stats()}")
+        if self.llm_client.chat_cache is not None:
+            print(f"Chat回复缓存统计: {self.llm_client.chat_cache.stats()}")
         return success_count
     
+    def update_description(self, workflow_id: str, description: Optional[str]) -> bool:
+        """
+        更新工作流的意图描述
+        
+        Args:
+            workflow_id: 工作流ID
+            description: 新描述
+            
+        Returns:
+            更新是否成功
+        """
+        entry = self.workflow_library.get_workflow(workflow_id)
+        if entry is None:
+            print(f"工作流不存在: {workflow_id}")
+            return False
+        if not description:
+            print("请通过 --description 提供新的描述")
+            return False
+        
+        intent = dataclasses.replace(entry.intent, description=description)
+        self.workflow_library.update_intent(workflow_id, intent)
+        print(f"已更新工作流 {workflow_id} 的描述: {description}")
+        return True
+    
+    def report_recall(self, top_k: int = 10):
+        """
+        报告当前向量索引相对精确检索的recall@k
+        
+        Args:
+            top_k: 评估的k
+        """
+        report = self.vector_index.recall_report(self.workflow_library.list_all(), top_k=top_k)
+        print("\n向量索引召回率报告:")
+        print(f"  索引类型: {report['index_type']}")
+        print(f"  查询数量: {report['num_queries']}")
+        if report['num_queries']:
+            print(f"  recall@{report['top_k']}: {report['recall']:.4f}")
+            print(f"  检索耗时: {report['approx_ms']:.2f} ms（精确检索 {report['exact_ms']:.2f} ms）")
+    
     def get_library_stats(self):
         """获取库统计信息"""
         stats = self.workflow_library.get_statistics()
@@ -236,6 +339,16 @@ def main():
                         help='工作流描述（用于单个添加）')
     parser.add_argument('--tags', '-t', type=str,
                         help='标签列表，用逗号分隔（例如: tag1,tag2,tag3）')
+    parser.add_argument('--remove', type=str, metavar='WORKFLOW_ID',
+                        help='从库中删除工作流')
+    parser.add_argument('--update', type=str, metavar='WORKFLOW_ID',
+                        help='用--description更新工作流描述（只重新生成该工作流的embedding）')
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='按配置的索引类型重建向量索引')
+    parser.add_argument('--recall-report', type=int, metavar='K',
+                        help='以flat索引为基准报告当前索引的recall@K')
+    parser.add_argument('--precompute-fragments', action='store_true',
+                        help='为尚无有效片段的工作流预拆分并保存片段（需启用workflow_library.fragments）')
     
     args = parser.parse_args()
     
@@ -261,10 +374,37 @@ def main():
             # 批量添加工作流
             recorder.batch_add_workflows(args.batch)
         
+        elif args.remove:
+            # 删除工作流
+            if recorder.workflow_library.remove_workflow(args.remove):
+                print(f"已删除工作流: {args.remove}")
+            else:
+                print(f"工作流不存在: {args.remove}")
+        
+        elif args.update:
+            # 更新工作流描述
+            recorder.update_description(args.update, args.description)
+        
+        elif args.rebuild_index:
+            # 重建向量索引
+            recorder.workflow_library.rebuild_vector_index()
+        
+        elif args.recall_report:
+            # 召回率报告
+            recorder.report_recall(args.recall_report)
+        
+        elif args.precompute_fragments:
+            # 回填片段存储
+            count = recorder.workflow_library.precompute_fragments()
+            print(f"已为 {count} 个工作流预拆分片段")
+        
         else:
             # 显示帮助
             parser.print_help()
             
+        # 压缩追加日志，写出完整的向量索引
+        recorder.workflow_library.flush()
+            
     except Exception as e:
         print(f"错误: {e}")
         import traceback
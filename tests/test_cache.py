@@ -0,0 +1,152 @@
+"""
+测试缓存模块
+"""
+
+from unittest.mock import Mock
+
+from core.cache import EmbeddingCache, content_hash
+from core.llm_client import LLMClient
+
+
+def test_embedding_cache_roundtrip_and_stats(tmp_path):
+    """缓存命中返回相同向量，并统计命中/未命中"""
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+
+    assert cache.get("model-a", "放大2倍") is None
+    cache.put("model-a", "放大2倍", [0.5, -1.0, 2.0])
+
+    assert cache.get("model-a", "放大2倍") == [0.5, -1.0, 2.0]
+    assert cache.get("model-b", "放大2倍") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["size"] == 1
+
+
+def test_embedding_cache_persists_and_evicts_lru(tmp_path):
+    """缓存跨实例持久化，超出上限时淘汰最久未访问的条目"""
+    path = str(tmp_path / "cache.sqlite")
+    cache = EmbeddingCache(path, max_entries=2)
+    cache.put("m", "a", [1.0])
+    cache.put("m", "b", [2.0])
+    cache.get("m", "a")
+    cache.put("m", "c", [3.0])
+    cache.close()
+
+    reopened = EmbeddingCache(path, max_entries=2)
+    assert reopened.get_many("m", ["a", "b", "c"]) == [[1.0], None, [3.0]]
+
+
+def test_cache_hits_defer_access_writes(tmp_path):
+    """命中只在内存中记录访问时间，批量写回；条目数在内存中维护"""
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_entries=10)
+    cache.put_many("m", ["a", "b"], [[1.0], [2.0]])
+    cache.put("m", "a", [1.5])
+    assert len(cache) == 2
+
+    changes = cache._conn.total_changes
+    for _ in range(5):
+        cache.get("m", "a")
+    assert cache._conn.total_changes == changes
+    assert set(cache._pending_access) == {content_hash("m", "a")}
+
+    cache.close()
+    reopened = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_entries=10)
+    assert len(reopened) == 2
+
+
+def test_llm_client_embed_uses_cache(tmp_path):
+    """重复文本只调用一次embedding API"""
+    client = LLMClient({
+        "openai": {"api_key": "test", "embedding_model": "test-embedding"},
+        "embedding_cache": {"enabled": True, "path": str(tmp_path / "cache.sqlite")}
+    })
+    client._embed_with_openai = Mock(return_value=[0.25, 0.75])
+
+    assert client.embed("文生图") == [0.25, 0.75]
+    assert client.embed("文生图") == [0.25, 0.75]
+    assert client._embed_with_openai.call_count == 1
+    assert client.embedding_cache.stats()["hits"] == 1
+
+
+def test_embed_batch_chunks_and_caches(tmp_path):
+    """批量embedding按批次请求、保持顺序，失败批次不在此重试（由限流器负责），并跳过已缓存的文本"""
+    client = LLMClient({
+        "openai": {"api_key": "test", "embedding_model": "test-embedding"},
+        "embedding_cache": {"enabled": True, "path": str(tmp_path / "cache.sqlite")}
+    })
+    client.embedding_cache.put("test-embedding", "c", [3.0])
+
+    failures = {"count": 1}
+
+    def fake_batch(texts):
+        if failures["count"]:
+            failures["count"] -= 1
+            return None
+        return [[float(ord(text) - ord("a") + 1)] for text in texts]
+
+    client._embed_batch_with_openai = Mock(side_effect=fake_batch)
+
+    result = client.embed_batch(["a", "b", "c", "a", "d"], batch_size=2)
+
+    assert result == [None, None, [3.0], None, [4.0]]
+    requested = [call.args[0] for call in client._embed_batch_with_openai.call_args_list]
+    assert requested == [["a", "b"], ["d"]]
+    assert client.embed("d") == [4.0]
+
+
+def test_response_cache_ttl_and_stats(tmp_path, monkeypatch):
+    """过期回复视为未命中并计入expired"""
+    from core.cache import ResponseCache
+
+    now = {"t": 1000.0}
+    monkeypatch.setattr("core.cache.time.time", lambda: now["t"])
+    cache = ResponseCache(str(tmp_path / "chat.sqlite"), ttl_seconds=60)
+    key = ResponseCache.make_key("gpt-4o", "系统", "提示", 0.3, True)
+
+    cache.put(key, "gpt-4o", '{"ok": true}')
+    assert cache.get(key) == '{"ok": true}'
+    assert cache.get(ResponseCache.make_key("gpt-4o", "系统", "提示", 0.7, True)) is None
+
+    now["t"] += 61
+    assert cache.get(key) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "expired": 1, "hit_rate": 1 / 3, "size": 0}
+
+
+def test_llm_client_chat_cache_and_opt_out(tmp_path):
+    """相同请求命中缓存，use_cache=False时总是调用API，JSON解析失败的回复不缓存"""
+    from types import SimpleNamespace
+
+    client = LLMClient({
+        "openai": {"api_key": "test", "chat_model": "gpt-4o"},
+        "chat_cache": {"enabled": True, "path": str(tmp_path / "chat.sqlite")}
+    })
+    replies = iter(['{"a": 1}', '{"a": 2}', 'not json', 'not json', '{"b": 1}'])
+    client.openai_client = Mock()
+    client.openai_client.chat.completions.create = Mock(side_effect=lambda **kwargs: SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=next(replies)))]
+    ))
+
+    assert client.chat("拆分代码", json_mode=True) == '{"a": 1}'
+    assert client.chat("拆分代码", json_mode=True) == '{"a": 1}'
+    assert client.chat("拆分代码", json_mode=True, use_cache=False) == '{"a": 2}'
+    assert client.chat("描述片段", json_mode=True) == 'not json'
+    assert client.chat("描述片段", json_mode=True) == 'not json'
+    assert client.chat("描述片段", json_mode=True, temperature=0.3) == '{"b": 1}'
+    assert client.chat_cache.stats()["hits"] == 1
+
+
+def test_rerank_cache_normalizes_query_and_tracks_description(tmp_path):
+    """查询忽略大小写和空白；工作流描述变化后缓存分数失效"""
+    from core.cache import RerankCache
+
+    cache = RerankCache(str(tmp_path / "rerank.sqlite"))
+    key = RerankCache.make_key("bge", "Upscale  image", "wf_1", "放大图片")
+    cache.put_many([(key, "wf_1", 0.8)])
+
+    assert cache.get_many([
+        RerankCache.make_key("bge", " upscale image ", "wf_1", "放大图片"),
+        RerankCache.make_key("bge", "upscale image", "wf_1", "超分辨率放大图片"),
+        RerankCache.make_key("other", "upscale image", "wf_1", "放大图片"),
+    ]) == [0.8, None, None]
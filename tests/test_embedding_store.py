@@ -0,0 +1,108 @@
+"""
+测试embedding矩阵存储
+"""
+
+import multiprocessing
+import os
+import struct
+
+import numpy as np
+
+from core.embedding_store import EmbeddingMatrix
+
+
+def _vector(value, dim=4):
+    return [float(value)] * dim
+
+
+def test_appends_share_few_mappings(tmp_path):
+    """逐个追加时按块扩容，已发出的行视图只引用少数几个映射，内容持久化"""
+    path = str(tmp_path / "emb.f32")
+    open_fds = (lambda: len(os.listdir('/proc/self/fd'))) if os.path.isdir('/proc/self/fd') else (lambda: 0)
+    before = open_fds()
+    matrix = EmbeddingMatrix(path, dimension=4)
+    views = [matrix.row(matrix.add(_vector(i))) for i in range(3000)]
+
+    # 1024 → 2048 → 4096 行容量，每个映射占用一个文件描述符
+    assert open_fds() - before <= 4
+    assert views[2999][0] == 2999.0 and not views[0].flags.writeable
+
+    reopened = EmbeddingMatrix(path)
+    assert len(reopened) == 3000
+    assert reopened.row(1234)[0] == 1234.0
+
+
+def test_concurrent_writers_get_distinct_rows(tmp_path):
+    """两个实例（模拟两个进程）交替追加同一文件，行号不重复"""
+    path = str(tmp_path / "emb.f32")
+    first = EmbeddingMatrix(path, dimension=4)
+    first.add(_vector(0))
+    second = EmbeddingMatrix(path, dimension=4)
+
+    rows = [first.add(_vector(1)), second.add(_vector(2)), first.add(_vector(3)), second.add(_vector(4))]
+
+    assert rows == [1, 2, 3, 4]
+    assert [EmbeddingMatrix(path).row(row)[0] for row in rows] == [1.0, 2.0, 3.0, 4.0]
+
+
+def _append_rows(path, value, count, queue):
+    """子进程：逐个追加count行，返回 (写入的值, 行号)"""
+    matrix = EmbeddingMatrix(path, dimension=4)
+    queue.put((value, [matrix.add(_vector(value)) for _ in range(count)]))
+
+
+def test_two_processes_never_share_rows(tmp_path):
+    """两个进程同时追加同一文件，行号不重复，各自写入的内容不被另一个进程覆盖"""
+    path = str(tmp_path / "emb.f32")
+    # 删除工作流后留下的空行也不会被另一个进程复用
+    EmbeddingMatrix(path, dimension=4).add_many([_vector(0)] * 3)
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    processes = [context.Process(target=_append_rows, args=(path, value, 200, queue)) for value in (1, 2)]
+    for process in processes:
+        process.start()
+    results = dict(queue.get(timeout=60) for _ in processes)
+    for process in processes:
+        process.join(timeout=60)
+
+    assert not set(results[1]) & set(results[2])
+    assert set(results[1]) | set(results[2]) == set(range(3, 403))
+
+    matrix = EmbeddingMatrix(path)
+    assert len(matrix) == 403
+    assert all(matrix.row(row)[0] == value for value, rows in results.items() for row in rows)
+
+
+def test_compact_keeps_referenced_rows(tmp_path):
+    """离线压缩只保留仍被引用的行，返回新旧行号映射；维度不符的向量被拒绝"""
+    path = str(tmp_path / "emb.f32")
+    matrix = EmbeddingMatrix(path, dimension=4)
+    rows = matrix.add_many([_vector(1), _vector(2), _vector(3)])
+
+    mapping = matrix.compact([rows[0], rows[2]])
+
+    assert mapping == {rows[0]: 0, rows[2]: 1}
+    assert len(matrix) == 2 and len(EmbeddingMatrix(path)) == 2
+    assert matrix.row(1)[0] == 3.0
+    assert matrix.add(_vector(4)) == 2
+
+    try:
+        matrix.add([1.0, 2.0])
+        assert False, "维度不符应抛出ValueError"
+    except ValueError:
+        pass
+
+
+def test_converts_legacy_file(tmp_path):
+    """旧版文件（无行数，无预分配）打开时转换"""
+    path = str(tmp_path / "emb.f32")
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<4sI', b'WEMB', 4))
+        f.write(np.array([_vector(1), _vector(2)], dtype='<f4').tobytes())
+
+    matrix = EmbeddingMatrix(path, dimension=4)
+    assert len(matrix) == 2
+    assert matrix.row(1)[0] == 2.0
+    assert matrix.add(_vector(3)) == 2
+    assert not os.path.exists(path + '.tmp')
@@ -165,3 +165,153 @@ def test_constraint_match_score(mock_llm_client):
     
     # 代码中包含"flux"，应该匹配
     assert score > 0
+
+
+def test_match_with_executor_runs_needs_concurrently(mock_llm_client):
+    """提供线程池时各需求并发判断，结果与顺序执行一致，片段描述只生成一次"""
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest.mock import Mock
+    
+    state = {"in_flight": 0, "peak": 0}
+    lock = threading.Lock()
+    
+    def slow_chat(prompt, **kwargs):
+        with lock:
+            state["in_flight"] += 1
+            state["peak"] = max(state["peak"], state["in_flight"])
+        time.sleep(0.02)
+        with lock:
+            state["in_flight"] -= 1
+        if "原子需求" in prompt:
+            return '{"matched": true, "confidence": 0.9, "reason": "ok"}'
+        return '{"function": "采样"}'
+    
+    mock_llm_client.chat = Mock(side_effect=slow_chat)
+    matcher = FragmentMatcher(mock_llm_client, matching_threshold=0.6, use_llm=True)
+    needs = [AtomicNeed(f"need_{i}", f"需求{i}", "generation", "image") for i in range(4)]
+    fragments = [
+        WorkflowFragment(fragment_id=f"frag_{i}", source_workflow_id="wf", code=f"x{i} = KSampler()", category="sampling")
+        for i in range(2)
+    ]
+    
+    sequential = matcher.match_fragments_to_needs(fragments, needs)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for fragment in fragments:
+            fragment.description = ""
+        mock_llm_client.chat.reset_mock()
+        parallel = matcher.match_fragments_to_needs(fragments, needs, executor=executor)
+    
+    assert {k: [f.fragment_id for f in v] for k, v in parallel.items()} == \
+        {k: [f.fragment_id for f in v] for k, v in sequential.items()}
+    assert state["peak"] > 1
+    # 2个片段描述 + 4个需求 × 2个片段的判断
+    assert mock_llm_client.chat.call_count == 2 + 8
+    assert fragments[0].mapped_need_id == "need_3"
+
+
+def test_batch_judging_uses_one_call_per_chunk(mock_llm_client):
+    """批量模式下同一需求的片段按batch_size分组，每组一次调用，缺失的片段回退到规则匹配"""
+    import json
+    from unittest.mock import Mock
+    
+    def batch_chat(prompt, **kwargs):
+        count = prompt.count("### 片段 ")
+        # 只返回前count-1个片段的结果，最后一个缺失
+        results = [{"index": i, "matched": True, "confidence": 0.9, "reason": "ok"} for i in range(count - 1)]
+        return json.dumps({"results": results})
+    
+    mock_llm_client.chat = Mock(side_effect=batch_chat)
+    matcher = FragmentMatcher(mock_llm_client, matching_threshold=0.6, use_llm=True, batch_size=3)
+    need = AtomicNeed("need_1", "生成图像", "generation", "image")
+    fragments = [
+        WorkflowFragment(
+            fragment_id=f"frag_{i}", source_workflow_id="wf", code=f"x{i} = VAEDecode()",
+            description="解码", category="decoding"
+        )
+        for i in range(5)
+    ]
+    
+    result = matcher.match_fragments_to_needs(fragments, [need])
+    
+    assert mock_llm_client.chat.call_count == 2
+    # 每组最后一个片段由规则匹配判断（类别不兼容，不匹配）
+    assert [f.fragment_id for f in result["need_1"]] == ["frag_0", "frag_1", "frag_3"]
+
+
+def test_chunk_fragments_respects_char_budget(mock_llm_client):
+    """分组同时受片段数和代码总长度限制，超长片段独占一组"""
+    matcher = FragmentMatcher(mock_llm_client, batch_size=10, max_batch_chars=100)
+    fragments = [
+        WorkflowFragment(fragment_id=f"frag_{i}", source_workflow_id="wf", code="x" * size)
+        for i, size in enumerate([40, 40, 40, 500, 10])
+    ]
+    
+    chunks = matcher._chunk_fragments(fragments)
+    
+    assert [[f.fragment_id for f in chunk] for chunk in chunks] == [
+        ["frag_0", "frag_1"], ["frag_2"], ["frag_3"], ["frag_4"]
+    ]
+
+
+def test_prefilter_sends_only_top_n_fragments_to_llm(mock_llm_client):
+    """预筛选按向量相似度保留前N个片段，片段向量只生成一次"""
+    from unittest.mock import Mock
+    
+    def embed_text(text):
+        return [1.0, 0.0] if "Upscale" in text or "放大" in text else [0.0, 1.0]
+    
+    mock_llm_client.embed = Mock(side_effect=embed_text)
+    mock_llm_client.embed_batch = Mock(side_effect=lambda texts: [embed_text(t) for t in texts])
+    matcher = FragmentMatcher(mock_llm_client, matching_threshold=0.6, use_llm=True, prefilter_top_n=1)
+    needs = [AtomicNeed(f"need_{i}", "放大视频", "upscaling", "video") for i in range(2)]
+    fragments = [
+        WorkflowFragment(fragment_id="save", source_workflow_id="wf", code="SaveImage(images=image)"),
+        WorkflowFragment(fragment_id="upscale", source_workflow_id="wf", code="image = ImageUpscaleWithModel(image=image)"),
+        WorkflowFragment(fragment_id="decode", source_workflow_id="wf", code="image = VAEDecode(samples=latent)"),
+    ]
+    judged = []
+    matcher._llm_judge_match = Mock(side_effect=lambda need, fragment: (judged.append(fragment.fragment_id), (True, 0.9, ""))[1])
+    
+    result = matcher.match_fragments_to_needs(fragments, needs)
+    
+    assert judged == ["upscale", "upscale"]
+    assert [f.fragment_id for f in result["need_0"]] == ["upscale"]
+    assert mock_llm_client.embed_batch.call_count == 1
+
+
+def test_parallel_prefilter_describes_only_survivors(mock_llm_client):
+    """并发模式下先预筛选，只为各需求保留片段的并集生成描述，每个需求只判断自己保留的片段"""
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest.mock import Mock
+    
+    def embed_text(text):
+        if "Upscale" in text or "放大" in text:
+            return [1.0, 0.0]
+        return [0.0, 1.0] if "Save" in text or "保存" in text else [0.6, 0.8]
+    
+    mock_llm_client.embed = Mock(side_effect=embed_text)
+    mock_llm_client.embed_batch = Mock(side_effect=lambda texts: [embed_text(t) for t in texts])
+    matcher = FragmentMatcher(mock_llm_client, matching_threshold=0.6, use_llm=True, prefilter_top_n=1)
+    needs = [
+        AtomicNeed("need_0", "放大视频", "upscaling", "video"),
+        AtomicNeed("need_1", "保存图像", "output", "image"),
+    ]
+    fragments = [
+        WorkflowFragment(fragment_id="save", source_workflow_id="wf", code="SaveImage(images=image)"),
+        WorkflowFragment(fragment_id="upscale", source_workflow_id="wf", code="image = ImageUpscaleWithModel(image=image)"),
+        WorkflowFragment(fragment_id="decode", source_workflow_id="wf", code="image = VAEDecode(samples=latent)"),
+    ]
+    described = []
+    matcher._generate_fragment_description = Mock(side_effect=lambda fragment: (described.append(fragment.fragment_id), "描述")[1])
+    judged = []
+    matcher._llm_judge_match = Mock(side_effect=lambda need, fragment: (judged.append((need.need_id, fragment.fragment_id)), (True, 0.9, ""))[1])
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        result = matcher.match_fragments_to_needs(fragments, needs, executor=executor)
+    
+    assert sorted(described) == ["save", "upscale"]
+    assert sorted(judged) == [("need_0", "upscale"), ("need_1", "save")]
+    assert [f.fragment_id for f in result["need_0"]] == ["upscale"]
+    assert mock_llm_client.embed_batch.call_count == 1
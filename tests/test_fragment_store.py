@@ -0,0 +1,186 @@
+"""
+测试片段存储模块
+"""
+
+import dataclasses
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from unittest.mock import Mock, patch
+
+from core.code_splitter import CodeSplitter
+from core.fragment_store import FragmentStore
+from core.utils import load_json
+
+
+@pytest.fixture
+def splitter(mock_llm_client, sample_node_defs):
+    """规则拆分器（不调用LLM），split调用次数可统计"""
+    splitter = CodeSplitter(mock_llm_client, sample_node_defs, strategy="rule")
+    splitter.split = Mock(side_effect=splitter.split)
+    return splitter
+
+
+@pytest.fixture
+def embedding_llm():
+    llm = Mock()
+    llm.embed_batch = Mock(side_effect=lambda texts: [[float(len(text)), 1.0] for text in texts])
+    return llm
+
+
+def test_compute_persists_fragments_with_embeddings(tmp_path, splitter, embedding_llm, sample_workflow_entry):
+    """预计算的片段连同描述、IO类型和embedding一起持久化，新实例直接读取不再拆分"""
+    store = FragmentStore(str(tmp_path), splitter, embedding_llm)
+    fragments = store.compute(sample_workflow_entry)
+    
+    assert fragments and all(f.embedding is not None for f in fragments)
+    assert os.path.exists(tmp_path / f"{sample_workflow_entry.workflow_id}{FragmentStore.SUFFIX}")
+    
+    reloaded = FragmentStore(str(tmp_path), splitter, embedding_llm)
+    loaded = reloaded.get(sample_workflow_entry)
+    
+    assert splitter.split.call_count == 1
+    assert [_without_embedding(f) for f in loaded] == [_without_embedding(f) for f in fragments]
+    for stored, original in zip(loaded, fragments):
+        np.testing.assert_array_equal(stored.embedding, original.embedding)
+    
+    # embedding保存在矩阵中，片段文件不再内联
+    data = load_json(str(tmp_path / f"{sample_workflow_entry.workflow_id}{FragmentStore.SUFFIX}"))
+    assert all("embedding" not in fragment for fragment in data["fragments"])
+
+
+def _without_embedding(fragment):
+    return dataclasses.asdict(dataclasses.replace(fragment, embedding=None))
+
+
+def test_stored_embeddings_read_without_fragment_files(tmp_path, splitter, embedding_llm, sample_workflow_entry):
+    """启动时从清单和矩阵取回片段embedding，不读取片段文件"""
+    FragmentStore(str(tmp_path), splitter, embedding_llm).compute(sample_workflow_entry)
+    
+    reloaded = FragmentStore(str(tmp_path), splitter, embedding_llm)
+    with patch("core.fragment_store.load_json", side_effect=AssertionError("不应读取片段文件")):
+        embeddings = reloaded.stored_embeddings(sample_workflow_entry)
+    
+    assert embeddings and all(isinstance(vector, np.ndarray) and not vector.flags.writeable for vector in embeddings)
+    
+    changed = dataclasses.replace(sample_workflow_entry, workflow_code="image = LoadImage(image='a.png')")
+    assert reloaded.stored_embeddings(changed) is None
+
+
+def test_recompute_appends_and_compaction_reclaims_rows(tmp_path, splitter, embedding_llm, sample_workflow_entry):
+    """重新拆分只追加新行（已返回的片段视图不变），删除和重新拆分留下的行由离线压缩回收"""
+    store = FragmentStore(str(tmp_path), splitter, embedding_llm)
+    first = store.compute(sample_workflow_entry)
+    rows = len(store.embeddings)
+    snapshot = [np.array(f.embedding) for f in first]
+    
+    store.compute(sample_workflow_entry)
+    assert len(store.embeddings) == 2 * rows
+    for fragment, vector in zip(first, snapshot):
+        np.testing.assert_array_equal(fragment.embedding, vector)
+    
+    assert store.compact_embeddings() == rows
+    reloaded = FragmentStore(str(tmp_path), splitter, embedding_llm)
+    assert len(reloaded.embeddings) == rows
+    for vector, original in zip(reloaded.stored_embeddings(sample_workflow_entry), snapshot):
+        np.testing.assert_array_equal(vector, original)
+    
+    reloaded.remove(sample_workflow_entry.workflow_id)
+    assert reloaded.compact_embeddings() == rows
+    assert len(reloaded.embeddings) == 0
+
+
+def test_concurrent_gets_split_once(tmp_path, splitter, embedding_llm, sample_workflow_entry):
+    """多个流水线线程同时获取同一工作流的片段时只拆分一次，返回的embedding一致"""
+    split = splitter.split.side_effect
+    splitter.split.side_effect = lambda entry: (time.sleep(0.05), split(entry))[1]
+    store = FragmentStore(str(tmp_path), splitter, embedding_llm)
+    
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: store.get(sample_workflow_entry), range(4)))
+    
+    assert splitter.split.call_count == 1
+    assert len(store.embeddings) == len(results[0])
+    for fragments in results[1:]:
+        for fragment, first in zip(fragments, results[0]):
+            np.testing.assert_array_equal(fragment.embedding, first.embedding)
+
+
+def test_get_returns_copies(tmp_path, splitter, sample_workflow_entry):
+    """请求时写入的匹配信息不会污染存储中的片段"""
+    store = FragmentStore(str(tmp_path), splitter)
+    first = store.get(sample_workflow_entry)
+    first[0].mapped_need_id = "need_1"
+    
+    assert store.get(sample_workflow_entry)[0].mapped_need_id is None
+    assert splitter.split.call_count == 1
+
+
+def test_fragments_invalidated_when_workflow_changes(tmp_path, splitter, sample_workflow_entry):
+    """工作流代码变化后已存片段失效并重新拆分"""
+    store = FragmentStore(str(tmp_path), splitter)
+    store.compute(sample_workflow_entry)
+    
+    changed = dataclasses.replace(sample_workflow_entry, workflow_code="image = LoadImage(image='a.png')")
+    assert not store.has_valid(changed)
+    
+    fragments = store.get(changed)
+    assert splitter.split.call_count == 2
+    assert "LoadImage" in fragments[0].code
+    assert store.has_valid(changed)
+
+
+def test_read_only_store_returns_none_without_fragments(tmp_path, sample_workflow_entry):
+    """没有拆分器且没有已存片段时返回None，由调用方现场拆分"""
+    assert FragmentStore(str(tmp_path)).get(sample_workflow_entry) is None
+
+
+def test_library_precomputes_on_ingest_and_cleans_up(tmp_path, splitter, embedding_llm, sample_workflow_json, sample_workflow_code):
+    """工作流库入库时预拆分片段，删除工作流时一并删除"""
+    from core.workflow_library import WorkflowLibrary
+    from core.data_structures import WorkflowIntent
+    
+    data_path = str(tmp_path / "library")
+    store = FragmentStore(os.path.join(data_path, "metadata"), splitter, embedding_llm)
+    library = WorkflowLibrary(data_path=data_path, fragment_store=store)
+    intent = WorkflowIntent(task="t2i", description="文生图", keywords=[], modality="image", operation="generation")
+    
+    entry = library.add_workflow(sample_workflow_json, sample_workflow_code, intent=intent)
+    assert splitter.split.call_count == 1
+    assert library.get_fragments(entry)[0].source_workflow_id == entry.workflow_id
+    assert library.precompute_fragments() == 0
+    
+    library.remove_workflow(entry.workflow_id)
+    assert not os.path.exists(os.path.join(data_path, "metadata", f"{entry.workflow_id}{FragmentStore.SUFFIX}"))
+
+
+def test_library_builds_fragment_index_from_store(tmp_path, splitter, embedding_llm, sample_workflow_json, sample_workflow_code):
+    """片段索引随入库和删除更新，重启时从已存片段构建而不重新拆分"""
+    pytest.importorskip("faiss")
+    from core.workflow_library import WorkflowLibrary
+    from core.vector_search import FragmentIndex
+    from core.data_structures import WorkflowIntent
+    
+    data_path = str(tmp_path / "library")
+    store = FragmentStore(os.path.join(data_path, "metadata"), splitter, embedding_llm)
+    library = WorkflowLibrary(data_path=data_path, fragment_store=store, fragment_index=FragmentIndex(dimension=2))
+    intent = WorkflowIntent(task="t2i", description="文生图", keywords=[], modality="image", operation="generation")
+    entry = library.add_workflow(sample_workflow_json, sample_workflow_code, intent=intent)
+    count = len(library.fragment_index)
+    assert count > 0
+    
+    reloaded = WorkflowLibrary(
+        data_path=data_path,
+        fragment_store=FragmentStore(os.path.join(data_path, "metadata"), splitter, embedding_llm),
+        fragment_index=FragmentIndex(dimension=2)
+    )
+    assert len(reloaded.fragment_index) == count
+    assert splitter.split.call_count == 1
+    # 命中的片段从片段存储取回
+    fragment, _ = reloaded.fragment_index.search([1.0, 1.0], top_k=1)[0]
+    assert fragment.source_workflow_id == entry.workflow_id and fragment.code
+    
+    reloaded.remove_workflow(entry.workflow_id)
+    assert len(reloaded.fragment_index) == 0
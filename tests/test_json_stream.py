@@ -0,0 +1,70 @@
+"""
+测试流式JSON解析模块
+"""
+
+import pytest
+from core.json_stream import IncrementalJSONParser
+
+
+RESPONSE = '''分解结果如下：
+```json
+{
+    "reasoning": "先生成图像 {草稿}，再放大",
+    "atomic_needs": [
+        {"need_id": "N1", "description": "生成\\"粘土\\"风格图像", "constraints": {"size": [512, 512]}},
+        {"need_id": "N2", "description": "放大", "dependencies": ["N1"]}
+    ],
+    "execution_order": ["N1", "N2"],
+    "confidence": 0.9,
+    "note": null
+}
+```'''
+
+
+def _feed_in_chunks(text, size):
+    parser = IncrementalJSONParser()
+    events = []
+    for start in range(0, len(text), size):
+        events.extend(parser.feed(text[start:start + size]))
+    return parser, events
+
+
+@pytest.mark.parametrize("size", [1, 5, len(RESPONSE)])
+def test_parser_emits_fields_and_elements(size):
+    """任意切分下都按闭合顺序得到顶层字段和数组元素"""
+    parser, events = _feed_in_chunks(RESPONSE, size)
+    paths = [path for path, _ in events]
+
+    assert paths == [
+        ("reasoning",),
+        ("atomic_needs", 0), ("atomic_needs", 1), ("atomic_needs",),
+        ("execution_order", 0), ("execution_order", 1), ("execution_order",),
+        ("confidence",), ("note",),
+    ]
+    assert parser.done
+    assert parser.result["reasoning"] == "先生成图像 {草稿}，再放大"
+    assert parser.result["atomic_needs"][0]["description"] == '生成"粘土"风格图像'
+    assert parser.result["note"] is None
+
+
+def test_parser_emits_element_before_array_closes():
+    """数组中的元素闭合后立即返回，不等待数组结束"""
+    parser = IncrementalJSONParser()
+    head = RESPONSE[:RESPONSE.index('{"need_id": "N2"')]
+
+    events = parser.feed(head)
+
+    assert events[-1] == (("atomic_needs", 0), {
+        "need_id": "N1", "description": '生成"粘土"风格图像', "constraints": {"size": [512, 512]}
+    })
+    assert "atomic_needs" not in parser.result
+    assert not parser.done
+
+
+def test_parser_ignores_text_after_object():
+    """顶层对象闭合后忽略后续文本"""
+    parser = IncrementalJSONParser()
+    parser.feed('{"a": 1} {"b": 2}')
+
+    assert parser.done
+    assert parser.result == {"a": 1}
@@ -0,0 +1,53 @@
+"""
+测试词法检索模块
+"""
+
+from core.lexical_search import tokenize, BM25Index, reciprocal_rank_fusion
+
+
+def test_tokenize_mixed_text():
+    """英文按词并拆分驼峰，中文按二元组"""
+    tokens = tokenize("使用AnimateDiff生成视频")
+
+    assert "animatediff" in tokens
+    assert "animate" in tokens and "diff" in tokens
+    assert "生成" in tokens and "视频" in tokens
+    assert "k" not in tokenize("KSampler")
+
+
+def test_bm25_ranks_exact_keyword_first():
+    """包含精确节点名的文档排在前面"""
+    index = BM25Index()
+    index.add_document("wf_a", "文生图 KSampler CheckpointLoaderSimple")
+    index.add_document("wf_b", "图生视频 AnimateDiffLoader KSampler")
+    index.add_document("wf_c", "图像放大 UpscaleModelLoader")
+
+    results = index.search("用AnimateDiff做动画")
+
+    assert results[0][0] == "wf_b"
+    assert "wf_c" not in [doc_id for doc_id, _ in results]
+
+
+def test_bm25_incremental_update_and_filter():
+    """增量添加/替换/删除，检索可限定在候选集合内"""
+    index = BM25Index()
+    index.add_document("wf_a", "IPAdapter 人物")
+    index.add_document("wf_b", "IPAdapter 风格迁移")
+
+    assert [d for d, _ in index.search("IPAdapter", doc_ids={"wf_b"})] == ["wf_b"]
+
+    index.add_document("wf_a", "ControlNet 姿态")
+    assert [d for d, _ in index.search("IPAdapter")] == ["wf_b"]
+
+    assert index.remove_document("wf_b")
+    assert index.search("IPAdapter") == []
+    assert len(index) == 1
+    assert "ipadapter" not in index.postings
+
+
+def test_reciprocal_rank_fusion():
+    """两路都靠前的结果融合后排第一"""
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=60)
+
+    assert fused[0][0] == "b"
+    assert [doc_id for doc_id, _ in fused] == ["b", "a", "d", "c"]
@@ -0,0 +1,92 @@
+"""
+测试LLM客户端模块
+"""
+
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from core import llm_client as llm_client_module
+from core.llm_client import LLMClient
+
+
+pytestmark = pytest.mark.skipif(llm_client_module.AsyncOpenAI is None, reason="需要openai>=1.0")
+
+
+def _client(max_concurrency=2):
+    return LLMClient({
+        "openai": {"api_key": "test", "chat_model": "gpt-4o", "max_concurrency": max_concurrency}
+    })
+
+
+def test_achat_limits_in_flight_requests():
+    """并发调用受max_concurrency限制，结果与调用一一对应"""
+    client = _client(max_concurrency=2)
+    state = {"in_flight": 0, "peak": 0}
+
+    async def fake_create(**kwargs):
+        state["in_flight"] += 1
+        state["peak"] = max(state["peak"], state["in_flight"])
+        await asyncio.sleep(0.01)
+        state["in_flight"] -= 1
+        message = SimpleNamespace(content=kwargs["messages"][-1]["content"].upper())
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    async def run():
+        await client._ensure_async_clients()
+        client._async_openai_client.chat.completions.create = fake_create
+        return await asyncio.gather(*(client.achat(f"p{i}") for i in range(6)))
+
+    assert asyncio.run(run()) == [f"P{i}" for i in range(6)]
+    assert state["peak"] == 2
+
+
+def test_achat_returns_empty_string_on_failure():
+    """调用失败时与同步接口一致返回空字符串"""
+    client = _client()
+
+    async def run():
+        await client._ensure_async_clients()
+        client._async_openai_client.chat.completions.create = Mock(side_effect=RuntimeError("429"))
+        return await client.achat("prompt")
+
+    assert asyncio.run(run()) == ""
+
+
+def test_async_clients_recreated_per_event_loop():
+    """每个事件循环使用各自的连接池和信号量"""
+    client = _client()
+
+    async def current_client():
+        await client._ensure_async_clients()
+        return client._async_openai_client
+
+    first = asyncio.run(current_client())
+    second = asyncio.run(current_client())
+
+    assert first is not second
+    assert first.is_closed()
+    assert not second.is_closed()
+
+
+def _stream_chunk(content):
+    delta = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+def test_chat_stream_yields_deltas_and_caches(tmp_path):
+    """流式调用逐段返回文本，结束后写入回复缓存，再次调用直接命中缓存"""
+    client = LLMClient({
+        "openai": {"api_key": "test", "chat_model": "gpt-4o"},
+        "chat_cache": {"enabled": True, "path": str(tmp_path / "chat.sqlite")}
+    })
+    create = Mock(return_value=iter([_stream_chunk('{"a": '), SimpleNamespace(choices=[]), _stream_chunk('1}')]))
+    client.openai_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    assert list(client.chat_stream("prompt")) == ['{"a": ', '1}']
+    assert create.call_args.kwargs["stream"] is True
+
+    assert list(client.chat_stream("prompt")) == ['{"a": 1}']
+    assert create.call_count == 1
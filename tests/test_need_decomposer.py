@@ -3,6 +3,7 @@
 """
 
 import pytest
+from unittest.mock import Mock
 from core.need_decomposer import NeedDecomposer
 from core.data_structures import AtomicNeed, DecomposedNeeds
 
@@ -130,3 +131,33 @@ def test_topological_sort_with_cycle(mock_llm_client):
     # 应该返回所有节点但不保证顺序
     order = decomposer._topological_sort(graph)
     assert len(order) == 3
+
+
+def test_need_decomposer_streaming_calls_on_need_early(mock_llm_client):
+    """流式模式下每个原子需求闭合时立即回调，回调对象即最终结果中的对象"""
+    response = '''{
+        "reasoning": "先生成再放大",
+        "atomic_needs": [
+            {"need_id": "need_1", "description": "生成图像", "category": "generation", "dependencies": []},
+            {"need_id": "need_2", "description": "超分辨率", "category": "upscaling", "dependencies": ["need_1"]}
+        ]
+    }'''
+    received = []
+    
+    def mock_chat_stream(prompt, **kwargs):
+        for start in range(0, len(response), 7):
+            received.append(start)  # 记录回调发生时已输出的位置
+            yield response[start:start + 7]
+    
+    mock_llm_client.chat_stream = Mock(side_effect=mock_chat_stream)
+    callbacks = []
+    
+    decomposer = NeedDecomposer(mock_llm_client, streaming=True)
+    result = decomposer.decompose("生成图像并超分", on_need=lambda need: callbacks.append((need, received[-1])))
+    
+    assert [need.need_id for need, _ in callbacks] == ["need_1", "need_2"]
+    assert callbacks[0][1] < response.index("need_2")
+    assert [need for need, _ in callbacks] == result.atomic_needs
+    assert all(a is b for (a, _), b in zip(callbacks, result.atomic_needs))
+    assert result.execution_order == ["need_1", "need_2"]
+    mock_llm_client.chat.assert_not_called()
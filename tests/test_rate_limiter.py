@@ -0,0 +1,107 @@
+"""
+测试限流模块
+"""
+
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from core import rate_limiter
+from core.rate_limiter import RateLimiter, TokenBucket, HTTPStatusError, is_retryable, retry_after_from_error
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """用虚拟时钟代替sleep，记录每次等待的时长"""
+    recorded = []
+    clock = {"t": 1000.0}
+
+    def fake_sleep(seconds):
+        recorded.append(seconds)
+        clock["t"] += seconds
+
+    monkeypatch.setattr(rate_limiter.time, "sleep", fake_sleep)
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: clock["t"])
+    return recorded
+
+
+def test_token_bucket_reports_wait_time(monkeypatch):
+    """令牌不足时返回需要等待的秒数，超过容量的请求在桶满时透支"""
+    now = {"t": 100.0}
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now["t"])
+    bucket = TokenBucket(per_minute=60, capacity=2)
+
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+
+    now["t"] += 2
+    assert bucket.reserve(5) == 0
+    assert bucket.tokens == pytest.approx(-3)
+
+
+def test_call_honors_retry_after(sleeps):
+    """429时按Retry-After等待后重试"""
+    limiter = RateLimiter("test", base_delay=0.1)
+    func = Mock(side_effect=[HTTPStatusError(429, "slow down", retry_after=7), "ok"])
+
+    assert limiter.call(func, 1, key="v") == "ok"
+    assert func.call_count == 2
+    func.assert_called_with(1, key="v")
+    assert 7 <= max(sleeps) <= 7.05
+    assert limiter.retries == 1
+
+
+def test_call_gives_up_on_non_retryable_or_exhausted(sleeps):
+    """不可重试的错误立即抛出，可重试错误用尽次数后抛出"""
+    limiter = RateLimiter("test", max_retries=2, base_delay=0.1)
+
+    with pytest.raises(HTTPStatusError):
+        limiter.call(Mock(side_effect=HTTPStatusError(400, "bad request")))
+    assert sleeps == []
+
+    failing = Mock(side_effect=HTTPStatusError(503, "unavailable"))
+    with pytest.raises(HTTPStatusError):
+        limiter.call(failing)
+    assert failing.call_count == 3
+    assert len(sleeps) == 2
+
+
+def test_retry_after_and_retryable_from_sdk_style_errors():
+    """兼容SDK异常：从response中读取状态码和Retry-After头"""
+    class APIConnectionError(Exception):
+        pass
+
+    error = Exception("rate limited")
+    error.response = SimpleNamespace(status_code=429, headers={"retry-after-ms": "1500"})
+
+    assert is_retryable(error)
+    assert retry_after_from_error(error) == 1.5
+    assert is_retryable(APIConnectionError())
+    assert not is_retryable(ValueError())
+
+
+def test_reranker_retries_rate_limited_api(sleeps, monkeypatch):
+    """rerank接口返回429时退避重试而不是直接退回原始顺序"""
+    from core.vector_search import Reranker
+    from core.data_structures import WorkflowEntry, WorkflowIntent
+
+    responses = [
+        SimpleNamespace(status_code=429, text="busy", headers={"retry-after": "2"}),
+        SimpleNamespace(status_code=200, text="", headers={}, json=lambda: {
+            "results": [{"index": 1, "relevance_score": 0.9}, {"index": 0, "relevance_score": 0.1}]
+        }),
+    ]
+    monkeypatch.setattr("core.vector_search.requests.Session.post", Mock(side_effect=responses))
+    monkeypatch.setattr(rate_limiter, "_rate_limiters", {})
+
+    def entry(workflow_id):
+        intent = WorkflowIntent(task="t", description=workflow_id, keywords=[], modality="image", operation="generation")
+        return WorkflowEntry(workflow_id=workflow_id, workflow_json={}, workflow_code="", intent=intent)
+
+    reranker = Reranker({"type": "api", "api_key": "test"})
+    results = reranker.rerank("query", [entry("wf_a"), entry("wf_b")], top_k=2)
+
+    assert [wf.workflow_id for wf in results] == ["wf_b", "wf_a"]
+    assert 2 <= max(sleeps) <= 2.5
@@ -0,0 +1,663 @@
+"""
+测试向量检索模块
+"""
+
+import dataclasses
+import numpy as np
+import pytest
+from unittest.mock import Mock
+
+faiss = pytest.importorskip("faiss")
+
+from core.vector_search import VectorIndex, WorkflowRetriever, FragmentIndex
+from core.data_structures import WorkflowEntry, WorkflowIntent, AtomicNeed, WorkflowFragment
+
+
+DIM = 8
+
+
+def _one_hot(i, dim=DIM):
+    vec = [0.0] * dim
+    vec[i] = 1.0
+    return vec
+
+
+def _make_entry(workflow_id, embedding, description="测试工作流"):
+    intent = WorkflowIntent(
+        task="text-to-image",
+        description=description,
+        keywords=[],
+        modality="image",
+        operation="generation"
+    )
+    return WorkflowEntry(
+        workflow_id=workflow_id,
+        workflow_json={},
+        workflow_code="",
+        intent=intent,
+        intent_embedding=embedding
+    )
+
+
+def _mock_reranker():
+    """保持召回顺序的reranker，rerank_many逐个委托给rerank便于统计调用"""
+    reranker = Mock()
+    reranker.rerank = Mock(side_effect=lambda query, candidates, top_k: candidates[:top_k])
+    reranker.rerank_many = Mock(side_effect=lambda jobs: [
+        [(wf, None) for wf in reranker.rerank(*job)] for job in jobs
+    ])
+    return reranker
+
+
+@pytest.fixture
+def small_library():
+    """4个互相正交的工作流"""
+    return {f"wf_{i}": _make_entry(f"wf_{i}", _one_hot(i)) for i in range(4)}
+
+
+@pytest.fixture
+def small_index(small_library):
+    index = VectorIndex(dimension=DIM)
+    for entry in small_library.values():
+        index.add_workflow(entry)
+    return index
+
+
+def test_search_batch_matches_single_search(small_index):
+    """批量搜索与逐个搜索结果一致"""
+    queries = [_one_hot(2), _one_hot(0), _one_hot(3)]
+
+    batch = small_index.search_batch(queries, top_k=2)
+
+    assert len(batch) == 3
+    for query, results in zip(queries, batch):
+        assert results == small_index.search(query, top_k=2)
+    assert small_index.get_workflow_id(batch[0][0][0]) == "wf_2"
+    assert small_index.get_workflow_id(batch[1][0][0]) == "wf_0"
+
+
+def test_search_batch_empty_index():
+    """空索引返回与查询数量相同的空结果"""
+    index = VectorIndex(dimension=DIM)
+    assert index.search_batch([_one_hot(0), _one_hot(1)], top_k=5) == [[], []]
+
+
+def test_retrieve_for_all_needs_uses_one_batch_search(small_index, small_library):
+    """所有需求只触发一次批量向量搜索"""
+    llm = Mock()
+    llm.embed = Mock(side_effect=lambda text: _one_hot(int(text[-1])))
+    llm.embed_batch = Mock(side_effect=lambda texts: [llm.embed(text) for text in texts])
+    reranker = _mock_reranker()
+
+    retriever = WorkflowRetriever(llm, small_index, reranker, small_library)
+    small_index.search = Mock(side_effect=AssertionError("不应逐个搜索"))
+
+    needs = [
+        AtomicNeed(need_id=f"need_{i}", description=f"需求{i}", category="generation", modality="image")
+        for i in (1, 3)
+    ]
+    results = retriever.retrieve_for_all_needs(needs, top_k_per_need=1)
+
+    assert results["need_1"][0].workflow_id == "wf_1"
+    assert results["need_3"][0].workflow_id == "wf_3"
+    assert reranker.rerank.call_count == 2
+    assert reranker.rerank_many.call_count == 1
+
+
+def _random_library(n, seed=0):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    return [_make_entry(f"wf_{i}", rng.random(DIM).tolist()) for i in range(n)]
+
+
+def test_unsupported_index_type():
+    """不支持的索引类型直接报错"""
+    with pytest.raises(ValueError):
+        VectorIndex(dimension=DIM, index_type="lsh")
+
+
+@pytest.mark.parametrize("index_type", ["ivf_flat", "ivf_pq", "hnsw"])
+def test_ann_index_rebuild_and_recall(index_type):
+    """ANN索引重建后可检索，recall报告以flat索引为基准"""
+    workflows = _random_library(300)
+    index = VectorIndex(dimension=DIM, index_type=index_type, nlist=4, nprobe=4, pq_m=4, pq_nbits=2)
+
+    index.rebuild(workflows)
+    report = index.recall_report(workflows, top_k=5)
+
+    assert index.active_type == index_type
+    assert report["num_queries"] == 100
+    assert 0.0 < report["recall"] <= 1.0
+
+
+def test_ivf_falls_back_to_flat_until_trainable():
+    """样本不足（每个聚类中心少于39个）时退化为flat，足够后提示重建"""
+    workflows = _random_library(160)
+    index = VectorIndex(dimension=DIM, index_type="ivf_flat", nlist=4)
+    assert index.min_train_size() == 156
+
+    index.rebuild(workflows[:100])
+    assert index.active_type == "flat"
+    assert not index.needs_rebuild()
+
+    for workflow in workflows[100:]:
+        index.add_workflow(workflow)
+    assert index.needs_rebuild()
+
+    index.rebuild(workflows)
+    assert index.active_type == "ivf_flat"
+    assert index.trained_size == 160 and not index.needs_rebuild()
+    assert index.get_workflow_id(index.search(workflows[3].intent_embedding, 1)[0][0]) == "wf_3"
+
+
+def test_ivf_retrains_after_growth(tmp_path):
+    """IVF索引的向量数比训练时增长到RETRAIN_GROWTH_FACTOR倍后提示重新训练，训练样本数随索引持久化"""
+    workflows = _random_library(320)
+    index = VectorIndex(dimension=DIM, index_type="ivf_flat", nlist=4)
+    index.rebuild(workflows[:160])
+
+    path = str(tmp_path / "index.faiss")
+    index.save(path)
+    reloaded = VectorIndex(dimension=DIM, index_type="ivf_flat", nlist=4)
+    reloaded.load(path)
+    assert reloaded.trained_size == 160
+
+    for workflow in workflows[160:319]:
+        reloaded.add_workflow(workflow)
+    assert not reloaded.needs_rebuild()
+    reloaded.add_workflow(workflows[319])
+    assert reloaded.needs_rebuild()
+
+
+def test_cosine_metric_normalizes_and_reports_similarity():
+    """cosine模式下向量归一化，分数为0-1相似度"""
+    index = VectorIndex(dimension=DIM, metric="cosine")
+    index.add_workflow(_make_entry("wf_a", [3.0] + [0.0] * (DIM - 1)))
+    index.add_workflow(_make_entry("wf_b", [1.0, 1.0] + [0.0] * (DIM - 2)))
+
+    results = index.search([10.0] + [0.0] * (DIM - 1), top_k=2)
+
+    assert index.get_workflow_id(results[0][0]) == "wf_a"
+    assert index.similarity(results[0][1]) == pytest.approx(1.0)
+    assert index.similarity(results[1][1]) == pytest.approx(2 ** -0.5, rel=1e-5)
+
+
+def test_metric_change_requires_rebuild(tmp_path):
+    """已保存索引的度量与配置不一致时需要重建"""
+    l2_index = VectorIndex(dimension=DIM)
+    l2_index.add_workflow(_make_entry("wf_0", _one_hot(0)))
+    l2_index.save(str(tmp_path / "index.faiss"))
+
+    cosine_index = VectorIndex(dimension=DIM, metric="cosine")
+    cosine_index.load(str(tmp_path / "index.faiss"))
+
+    assert cosine_index.needs_rebuild()
+
+
+def test_retriever_drops_candidates_below_threshold(small_library):
+    """低于相似度阈值的候选不送入reranker"""
+    index = VectorIndex(dimension=DIM, metric="cosine")
+    for entry in small_library.values():
+        index.add_workflow(entry)
+
+    llm = Mock()
+    llm.embed = Mock(return_value=[1.0, 0.5] + [0.0] * (DIM - 2))
+    reranker = _mock_reranker()
+
+    retriever = WorkflowRetriever(llm, index, reranker, small_library, similarity_threshold=0.6)
+    need = AtomicNeed(need_id="need_1", description="需求", category="generation", modality="image")
+    results = retriever.retrieve(need, top_k_recall=4, top_k_rerank=4)
+
+    assert [wf.workflow_id for wf in results] == ["wf_0"]
+    assert set(retriever.similarity_scores["need_1"]) == {"wf_0"}
+    assert retriever.similarity_scores["need_1"]["wf_0"] == pytest.approx(0.894, abs=1e-3)
+
+
+def test_append_delta_replayed_on_load(tmp_path):
+    """追加日志中的向量在加载时恢复，全量保存后日志被清除"""
+    path = str(tmp_path / "index.faiss")
+    index = VectorIndex(dimension=DIM)
+    index.add_workflow(_make_entry("wf_0", _one_hot(0)))
+    index.save(path)
+
+    index.add_workflow(_make_entry("wf_1", _one_hot(1)))
+    index.add_workflow(_make_entry("wf_2", _one_hot(2)))
+    assert index.append_delta(path) == 2
+    assert index.append_delta(path) == 0
+
+    restored = VectorIndex(dimension=DIM)
+    restored.load(path)
+    assert restored.index.ntotal == 3
+    assert restored.delta_count == 2
+    assert restored.get_workflow_id(restored.search(_one_hot(2), 1)[0][0]) == "wf_2"
+
+    restored.save(path)
+    assert not (tmp_path / "index.faiss.delta").exists()
+
+
+def test_truncated_delta_record_is_ignored(tmp_path):
+    """写入中断的残缺记录不影响之前的记录"""
+    path = str(tmp_path / "index.faiss")
+    index = VectorIndex(dimension=DIM)
+    index.add_workflow(_make_entry("wf_0", _one_hot(0)))
+    index.add_workflow(_make_entry("wf_1", _one_hot(1)))
+    index.append_delta(path)
+
+    delta_path = tmp_path / "index.faiss.delta"
+    delta_path.write_bytes(delta_path.read_bytes()[:-5])
+
+    restored = VectorIndex(dimension=DIM)
+    assert VectorIndex.exists(path)
+    restored.load(path)
+    assert restored.index.ntotal == 1
+    assert restored.get_workflow_id(0) == "wf_0"
+
+
+def test_mmap_load_then_add(tmp_path, small_library):
+    """内存映射加载的索引可检索，修改时自动复制为私有索引"""
+    path = str(tmp_path / "index.faiss")
+    index = VectorIndex(dimension=DIM)
+    for entry in small_library.values():
+        index.add_workflow(entry)
+    index.save(path)
+
+    assert (tmp_path / "index.faiss.ids.npy").exists()
+    assert not (tmp_path / "index.faiss.mapping.json").exists()
+
+    mapped = VectorIndex(dimension=DIM, use_mmap=True)
+    mapped.load(path)
+    assert mapped.workflow_to_id == index.workflow_to_id
+    assert mapped.get_workflow_id(mapped.search(_one_hot(3), 1)[0][0]) == "wf_3"
+
+    mapped.add_workflow(_make_entry("wf_new", _one_hot(5)))
+    assert mapped.index.ntotal == 5
+    assert mapped.get_workflow_id(mapped.search(_one_hot(5), 1)[0][0]) == "wf_new"
+
+
+def test_load_legacy_json_mapping(tmp_path):
+    """兼容旧版json格式的ID映射"""
+    import json
+
+    path = str(tmp_path / "index.faiss")
+    flat = faiss.IndexFlatL2(DIM)
+    flat.add(__import__("numpy").array([_one_hot(0), _one_hot(1)], dtype="float32"))
+    faiss.write_index(flat, path)
+    with open(path + ".mapping.json", "w") as f:
+        json.dump({
+            "id_to_workflow": {"0": "wf_a", "1": "wf_b"},
+            "workflow_to_id": {"wf_a": 0, "wf_b": 1},
+            "current_index": 2
+        }, f)
+
+    index = VectorIndex(dimension=DIM)
+    index.load(path)
+
+    assert index.get_workflow_id(1) == "wf_b"
+    assert index.current_index == 2
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf_flat", "hnsw"])
+def test_remove_and_replace_keep_labels_stable(index_type):
+    """删除/替换后其余工作流的标签不变，被删除的工作流不再出现在结果中"""
+    workflows = _random_library(300)
+    index = VectorIndex(dimension=DIM, index_type=index_type, nlist=4, nprobe=4)
+    index.rebuild(workflows)
+    label_of_5 = index.workflow_to_id["wf_5"]
+
+    assert index.remove_workflow("wf_3")
+    assert not index.remove_workflow("wf_3")
+    results = index.search(workflows[3].intent_embedding, top_k=10)
+    assert "wf_3" not in [index.get_workflow_id(label) for label, _ in results]
+    assert index.workflow_to_id["wf_5"] == label_of_5
+
+    index.replace_workflow(_make_entry("wf_5", workflows[3].intent_embedding))
+    assert index.workflow_to_id["wf_5"] != label_of_5
+    top = index.search(workflows[3].intent_embedding, top_k=1)[0]
+    assert index.get_workflow_id(top[0]) == "wf_5"
+
+
+def test_hnsw_tombstones_trigger_rebuild():
+    """HNSW无法物理删除，墓碑过多时提示重建"""
+    workflows = _random_library(20)
+    index = VectorIndex(dimension=DIM, index_type="hnsw")
+    index.rebuild(workflows)
+
+    for workflow in workflows[:5]:
+        index.remove_workflow(workflow.workflow_id)
+    assert index.tombstone_count == 5
+    assert index.needs_rebuild()
+
+    index.rebuild(workflows[5:])
+    assert index.tombstone_count == 0
+    assert not index.needs_rebuild()
+
+
+def test_remove_replayed_from_delta(tmp_path, small_index):
+    """删除记录写入追加日志，加载时回放"""
+    path = str(tmp_path / "index.faiss")
+    small_index.save(path)
+
+    small_index.remove_workflow("wf_1")
+    small_index.add_workflow(_make_entry("wf_0", _one_hot(6)))
+    assert small_index.append_delta(path) == 3
+
+    restored = VectorIndex(dimension=DIM, use_mmap=True)
+    restored.load(path)
+    assert set(restored.workflow_to_id) == {"wf_0", "wf_2", "wf_3"}
+    assert restored.get_workflow_id(restored.search(_one_hot(6), 1)[0][0]) == "wf_0"
+    assert restored.current_index == small_index.current_index
+
+
+def test_legacy_flat_index_converted_to_id_map(tmp_path):
+    """旧版无ID映射的flat索引加载后可按ID删除"""
+    path = str(tmp_path / "index.faiss")
+    flat = faiss.IndexFlatL2(DIM)
+    flat.add(__import__("numpy").array([_one_hot(0), _one_hot(1)], dtype="float32"))
+    faiss.write_index(flat, path)
+
+    legacy = VectorIndex(dimension=DIM)
+    legacy.index = faiss.read_index(path)
+    legacy.id_to_workflow = {0: "wf_a", 1: "wf_b"}
+    legacy.workflow_to_id = {"wf_a": 0, "wf_b": 1}
+    legacy.current_index = 2
+    legacy._save_id_mapping(path + VectorIndex.IDS_SUFFIX)
+
+    index = VectorIndex(dimension=DIM)
+    index.load(path)
+    assert index.remove_workflow("wf_a")
+    assert index.index.ntotal == 1
+    assert index.get_workflow_id(index.search(_one_hot(1), 1)[0][0]) == "wf_b"
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf_flat", "ivf_pq", "hnsw"])
+def test_search_restricted_to_workflow_ids(index_type):
+    """指定候选集合时只返回集合内的工作流"""
+    workflows = _random_library(300)
+    index = VectorIndex(dimension=DIM, index_type=index_type, nlist=4, nprobe=4, pq_m=4, pq_nbits=2)
+    index.rebuild(workflows)
+    allowed = {f"wf_{i}" for i in range(0, 300, 10)}
+
+    results = index.search(workflows[5].intent_embedding, top_k=5, workflow_ids=allowed)
+
+    assert len(results) == 5
+    assert {index.get_workflow_id(label) for label, _ in results} <= allowed
+    assert index.search(workflows[5].intent_embedding, top_k=5, workflow_ids={"missing"}) == []
+
+
+def test_retriever_groups_needs_by_candidate_filter(small_index, small_library):
+    """候选集合相同的需求合并搜索，结果限定在候选集合内"""
+    llm = Mock()
+    llm.embed = Mock(return_value=_one_hot(0))
+    llm.embed_batch = Mock(side_effect=lambda texts: [llm.embed(text) for text in texts])
+    reranker = _mock_reranker()
+    video_ids = {"wf_2", "wf_3"}
+
+    retriever = WorkflowRetriever(
+        llm, small_index, reranker, small_library,
+        candidate_filter=lambda need: video_ids if need.modality.endswith("video") else None
+    )
+    search_batch = Mock(wraps=small_index.search_batch)
+    small_index.search_batch = search_batch
+
+    needs = [
+        AtomicNeed(need_id="n1", description="需求1", category="图生视频", modality="image->video"),
+        AtomicNeed(need_id="n2", description="需求2", category="图生视频", modality="image->video"),
+        AtomicNeed(need_id="n3", description="需求3", category="文生图", modality="text->image"),
+    ]
+    results = retriever.retrieve_for_all_needs(needs, top_k_per_need=2)
+
+    assert search_batch.call_count == 2
+    assert {wf.workflow_id for wf in results["n1"]} == video_ids
+    assert results["n3"][0].workflow_id == "wf_0"
+
+
+def test_retriever_fuses_lexical_results(small_index, small_library):
+    """词法召回命中的工作流即使向量相似度低于阈值也能进入候选"""
+    from core.lexical_search import BM25Index
+
+    lexical_index = BM25Index()
+    lexical_index.add_document("wf_3", "AnimateDiffLoader 图生视频")
+    lexical_index.add_document("wf_1", "KSampler 文生图")
+
+    llm = Mock()
+    llm.embed = Mock(return_value=_one_hot(0))
+    llm.embed_batch = Mock(side_effect=lambda texts: [llm.embed(text) for text in texts])
+    reranker = _mock_reranker()
+
+    retriever = WorkflowRetriever(
+        llm, small_index, reranker, small_library,
+        similarity_threshold=0.9, lexical_index=lexical_index
+    )
+    need = AtomicNeed(need_id="n1", description="AnimateDiff动画", category="图生视频", modality="image->video")
+    results = retriever.retrieve_for_all_needs([need], top_k_per_need=3)["n1"]
+
+    assert [wf.workflow_id for wf in results] == ["wf_0", "wf_3"]
+
+
+def _make_fragment(fragment_id, workflow_id, embedding):
+    return WorkflowFragment(
+        fragment_id=fragment_id,
+        source_workflow_id=workflow_id,
+        code=f"# {fragment_id}",
+        embedding=embedding
+    )
+
+
+def _fragment_loader(fragments_by_workflow):
+    """模拟片段存储：按工作流返回片段副本"""
+    return lambda workflow_id: [dataclasses.replace(f) for f in fragments_by_workflow.get(workflow_id, [])]
+
+
+def test_fragment_index_search_filter_and_remove():
+    """片段索引跨工作流检索，可按工作流过滤，删除工作流后其片段不再返回"""
+    fragments = {
+        "wf_0": [_make_fragment("f0", "wf_0", _one_hot(0)), _make_fragment("f1", "wf_0", _one_hot(1))],
+        "wf_1": [_make_fragment("f3", "wf_1", None), _make_fragment("f2", "wf_1", [0.9, 0.1] + [0.0] * (DIM - 2))]
+    }
+    index = FragmentIndex(dimension=DIM, fragment_loader=_fragment_loader(fragments))
+    for workflow_id, workflow_fragments in fragments.items():
+        index.add_fragments(workflow_id, workflow_fragments)
+    assert len(index) == 3
+
+    results = index.search(_one_hot(0), top_k=2)
+    assert [(f.source_workflow_id, f.fragment_id) for f, _ in results] == [("wf_0", "f0"), ("wf_1", "f2")]
+    assert results[0][1] == pytest.approx(1.0)
+
+    # 返回副本
+    results[0][0].mapped_need_id = "n1"
+    assert index.search(_one_hot(0), top_k=1)[0][0].mapped_need_id is None
+
+    assert [f.fragment_id for f, _ in index.search(_one_hot(0), top_k=2, workflow_ids={"wf_1"})] == ["f2"]
+
+    # 重新添加同一工作流替换旧片段
+    fragments["wf_0"] = [_make_fragment("f4", "wf_0", _one_hot(0))]
+    index.add_fragments("wf_0", fragments["wf_0"])
+    assert len(index) == 2
+    assert index.search(_one_hot(0), top_k=1)[0][0].fragment_id == "f4"
+
+    assert index.remove_workflow("wf_0")
+    assert not index.remove_workflow("wf_0")
+    assert [f.fragment_id for f, _ in index.search(_one_hot(0), top_k=5)] == ["f2"]
+
+
+def test_fragment_index_does_not_modify_source_vectors():
+    """按embedding矩阵的只读视图添加，归一化在副本上进行"""
+    vector = np.array([2.0, 0.0] + [0.0] * (DIM - 2), dtype=np.float32)
+    vector.flags.writeable = False
+    index = FragmentIndex(dimension=DIM, fragment_loader=_fragment_loader({"wf_0": [_make_fragment("f0", "wf_0", None)]}))
+    index.add_embeddings("wf_0", [vector])
+
+    assert vector[0] == 2.0
+    assert index.search(_one_hot(0), top_k=1)[0][0].fragment_id == "f0"
+
+
+def test_retriever_retrieve_fragments(small_index, small_library):
+    """需求直接检索片段，遵守元数据预过滤和相似度阈值"""
+    fragments = {f"wf_{i}": [_make_fragment(f"f{i}", f"wf_{i}", _one_hot(i))] for i in range(4)}
+    index = FragmentIndex(dimension=DIM, fragment_loader=_fragment_loader(fragments))
+    for workflow_id, workflow_fragments in fragments.items():
+        index.add_fragments(workflow_id, workflow_fragments)
+
+    llm = Mock()
+    llm.embed = Mock(return_value=_one_hot(2))
+    retriever = WorkflowRetriever(
+        llm, small_index, Mock(), small_library,
+        similarity_threshold=0.5,
+        candidate_filter=lambda need: {"wf_1", "wf_2"},
+        fragment_index=index
+    )
+    need = AtomicNeed(need_id="n1", description="需求", category="图生视频", modality="image->video")
+    fragments = retriever.retrieve_fragments(need, top_k=4)
+
+    assert [f.source_workflow_id for f in fragments] == ["wf_2"]
+
+    # 复用工作流检索时已生成的需求embedding，不再调用embed
+    llm.embed.reset_mock()
+    fragments = retriever.retrieve_fragments(need, top_k=4, query_embedding=_one_hot(1))
+    assert [f.source_workflow_id for f in fragments] == ["wf_1"]
+    llm.embed.assert_not_called()
+
+    # 未启用片段索引时返回空列表
+    assert WorkflowRetriever(llm, small_index, Mock(), small_library).retrieve_fragments(need) == []
+
+
+def test_local_reranker_scores_with_cross_encoder(monkeypatch, small_library):
+    """本地reranker按交叉编码器分数排序，不发网络请求"""
+    from core.vector_search import Reranker
+
+    encoder = Mock()
+    encoder.score_pairs = Mock(side_effect=lambda queries, documents: [0.1, 0.9, 0.5, 0.9][:len(documents)])
+    monkeypatch.setattr("core.vector_search.LocalCrossEncoder", Mock(return_value=encoder))
+    monkeypatch.setattr("core.vector_search.requests.Session.post", Mock(side_effect=AssertionError("不应调用API")))
+
+    reranker = Reranker({"type": "local", "model_path": "./models/reranker", "batch_size": 16})
+    candidates = [small_library[f"wf_{i}"] for i in range(4)]
+    results = reranker.rerank("查询", candidates, top_k=3)
+
+    assert [wf.workflow_id for wf in results] == ["wf_1", "wf_3", "wf_2"]
+    encoder.score_pairs.assert_called_once_with(["查询"] * 4, [wf.intent.description for wf in candidates])
+
+
+def test_retriever_max_rerank_candidates(small_index, small_library):
+    """送入reranker的候选数由max_rerank_candidates控制"""
+    llm = Mock()
+    llm.embed = Mock(return_value=_one_hot(0))
+    llm.embed_batch = Mock(side_effect=lambda texts: [llm.embed(text) for text in texts])
+    reranker = _mock_reranker()
+    need = AtomicNeed(need_id="n1", description="需求", category="文生图", modality="text->image")
+
+    WorkflowRetriever(llm, small_index, reranker, small_library, max_rerank_candidates=2).retrieve_for_all_needs([need])
+    assert len(reranker.rerank.call_args[0][1]) == 2
+
+    WorkflowRetriever(llm, small_index, reranker, small_library, max_rerank_candidates=50).retrieve_for_all_needs([need])
+    assert len(reranker.rerank.call_args[0][1]) == len(small_library)
+
+
+def test_retrieve_for_all_needs_uses_configured_recall(small_index, small_library):
+    """批量检索的向量召回数量由调用方（配置中的top_k_recall）决定"""
+    llm = Mock()
+    llm.embed_batch = Mock(return_value=[_one_hot(0)])
+    small_index.search_batch = Mock(side_effect=small_index.search_batch)
+    need = AtomicNeed(need_id="n1", description="需求", category="文生图", modality="text->image")
+
+    WorkflowRetriever(llm, small_index, _mock_reranker(), small_library).retrieve_for_all_needs([need], top_k_recall=3)
+
+    assert small_index.search_batch.call_args.kwargs["top_k"] == 3
+
+
+def test_api_rerank_many_runs_jobs_concurrently(monkeypatch, small_library):
+    """多个需求的rerank请求并发发出，分数随结果返回"""
+    import threading
+    from types import SimpleNamespace
+    from core import rate_limiter
+    from core.vector_search import Reranker
+
+    monkeypatch.setattr(rate_limiter, "_rate_limiters", {})
+    barrier = threading.Barrier(3, timeout=5)
+
+    def post(url, json, headers, timeout):
+        # 三个请求同时在途时才会全部通过屏障
+        barrier.wait()
+        n = len(json["documents"])
+        return SimpleNamespace(status_code=200, text="", headers={}, json=lambda: {
+            "results": [{"index": n - 1 - i, "relevance_score": 0.9 - 0.1 * i} for i in range(n)]
+        })
+
+    monkeypatch.setattr("core.vector_search.requests.Session.post", Mock(side_effect=post))
+    reranker = Reranker({"type": "api", "api_key": "test"})
+    candidates = [small_library["wf_0"], small_library["wf_1"]]
+    results = reranker.rerank_many([(f"查询{i}", candidates, 2) for i in range(3)])
+
+    assert len(results) == 3
+    for ranked in results:
+        assert [(wf.workflow_id, score) for wf, score in ranked] == [("wf_1", 0.9), ("wf_0", pytest.approx(0.8))]
+
+
+def test_local_rerank_many_packs_all_needs(monkeypatch, small_library):
+    """本地reranker把所有需求的文本对打包成一次推理"""
+    from core.vector_search import Reranker
+
+    encoder = Mock()
+    encoder.score_pairs = Mock(side_effect=lambda queries, documents: [0.2, 0.8, 0.7, 0.3])
+    monkeypatch.setattr("core.vector_search.LocalCrossEncoder", Mock(return_value=encoder))
+
+    reranker = Reranker({"type": "local"})
+    pair = [small_library["wf_0"], small_library["wf_1"]]
+    results = reranker.rerank_many([("q1", pair, 2), ("q2", pair, 1)])
+
+    encoder.score_pairs.assert_called_once()
+    assert encoder.score_pairs.call_args[0][0] == ["q1", "q1", "q2", "q2"]
+    assert [(wf.workflow_id, score) for wf, score in results[0]] == [("wf_1", 0.8), ("wf_0", 0.2)]
+    assert [(wf.workflow_id, score) for wf, score in results[1]] == [("wf_0", 0.7)]
+
+
+def test_retriever_records_rerank_scores(small_index, small_library):
+    """rerank分数按需求记录在检索器上"""
+    llm = Mock()
+    llm.embed_batch = Mock(return_value=[_one_hot(0), _one_hot(1)])
+    reranker = Mock()
+    reranker.rerank_many = Mock(side_effect=lambda jobs: [
+        [(wf, 1.0 - 0.1 * i) for i, wf in enumerate(candidates[:top_k])] for _, candidates, top_k in jobs
+    ])
+    needs = [
+        AtomicNeed(need_id=f"n{i}", description=f"需求{i}", category="文生图", modality="text->image")
+        for i in range(2)
+    ]
+    retriever = WorkflowRetriever(llm, small_index, reranker, small_library)
+    results = retriever.retrieve_for_all_needs(needs, top_k_per_need=2)
+
+    assert reranker.rerank_many.call_count == 1
+    assert results["n1"][0].workflow_id == "wf_1"
+    assert retriever.rerank_scores["n1"] == {"wf_1": 1.0, results["n1"][1].workflow_id: pytest.approx(0.9)}
+
+
+def test_api_rerank_sends_only_cache_misses(tmp_path, monkeypatch, small_library):
+    """缓存命中的候选不再发给API，缓存分数与新分数合并排序"""
+    from types import SimpleNamespace
+    from core import rate_limiter
+    from core.cache import RerankCache
+    from core.vector_search import Reranker
+
+    monkeypatch.setattr(rate_limiter, "_rate_limiters", {})
+    posted = []
+
+    def post(url, json, headers, timeout):
+        # 分数按打分顺序递增：wf_0=0.2, wf_1=0.3, wf_2=0.4, wf_3=0.5
+        offset = sum(len(documents) for documents in posted)
+        posted.append(json["documents"])
+        return SimpleNamespace(status_code=200, text="", headers={}, json=lambda: {
+            "results": [{"index": i, "relevance_score": 0.2 + 0.1 * (offset + i)} for i in range(len(json["documents"]))]
+        })
+
+    monkeypatch.setattr("core.vector_search.requests.Session.post", Mock(side_effect=post))
+    reranker = Reranker({"type": "api", "api_key": "test"}, cache=RerankCache(str(tmp_path / "rerank.sqlite")))
+    first = [small_library["wf_0"], small_library["wf_1"]]
+    reranker.rerank_scored("查询", first, top_k=1)
+
+    candidates = [small_library[f"wf_{i}"] for i in range(4)]
+    results = reranker.rerank_scored("查询", candidates, top_k=4)
+
+    assert len(posted) == 2
+    assert len(posted[1]) == 2
+    assert [wf.workflow_id for wf, _ in results] == ["wf_3", "wf_2", "wf_1", "wf_0"]
+    assert [score for _, score in results] == pytest.approx([0.5, 0.4, 0.3, 0.2])
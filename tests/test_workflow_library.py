@@ -0,0 +1,374 @@
+"""
+测试工作流库模块
+"""
+
+import json
+import os
+import numpy as np
+import pytest
+from unittest.mock import Mock
+
+pytest.importorskip("faiss")
+
+from core.workflow_library import WorkflowLibrary
+from core.vector_search import VectorIndex
+from core.fragment_store import FragmentStore
+from core.data_structures import WorkflowIntent
+
+
+DIM = 8
+
+
+def _make_intent(description="测试工作流", modality="image", operation="generation"):
+    return WorkflowIntent(
+        task="text-to-image",
+        description=description,
+        keywords=[],
+        modality=modality,
+        operation=operation
+    )
+
+
+@pytest.fixture
+def embedding_llm():
+    """按调用顺序返回正交向量的LLM客户端"""
+    llm = Mock()
+    counter = {'n': 0}
+
+    def embed(text):
+        vec = [0.0] * DIM
+        vec[counter['n'] % DIM] = 1.0
+        counter['n'] += 1
+        return vec
+
+    llm.embed = Mock(side_effect=embed)
+    llm.embed_batch = Mock(side_effect=lambda texts: [embed(text) for text in texts])
+    return llm
+
+
+def test_append_mode_defers_full_index_write(tmp_path, embedding_llm, sample_workflow_json):
+    """append模式下添加工作流只写追加日志，flush()后压缩为全量文件"""
+    data_path = str(tmp_path / 'library')
+    library = WorkflowLibrary(
+        data_path=data_path,
+        llm_client=embedding_llm,
+        vector_index=VectorIndex(dimension=DIM),
+        persistence_mode='append'
+    )
+
+    for i in range(3):
+        library.add_workflow(sample_workflow_json, "", intent=_make_intent(f"工作流{i}"))
+
+    index_path = os.path.join(data_path, 'embeddings.faiss')
+    assert not os.path.exists(index_path)
+    assert os.path.exists(index_path + VectorIndex.DELTA_SUFFIX)
+
+    reloaded = WorkflowLibrary(data_path=data_path, vector_index=VectorIndex(dimension=DIM))
+    assert reloaded.vector_index.index.ntotal == 3
+
+    library.flush()
+    assert os.path.exists(index_path)
+    assert not os.path.exists(index_path + VectorIndex.DELTA_SUFFIX)
+
+
+def test_append_mode_compacts_at_threshold(tmp_path, embedding_llm, sample_workflow_json):
+    """追加日志达到阈值时自动压缩"""
+    data_path = str(tmp_path / 'library')
+    library = WorkflowLibrary(
+        data_path=data_path,
+        llm_client=embedding_llm,
+        vector_index=VectorIndex(dimension=DIM),
+        persistence_mode='append',
+        compact_threshold=2
+    )
+
+    library.add_workflow(sample_workflow_json, "", intent=_make_intent())
+    library.add_workflow(sample_workflow_json, "", intent=_make_intent())
+
+    assert os.path.exists(os.path.join(data_path, 'embeddings.faiss'))
+    assert library.vector_index.delta_count == 0
+
+
+def test_remove_workflow_deletes_files_and_vectors(tmp_path, embedding_llm, sample_workflow_json):
+    """删除工作流同时清理文件、索引和向量"""
+    data_path = str(tmp_path / 'library')
+    library = WorkflowLibrary(
+        data_path=data_path,
+        llm_client=embedding_llm,
+        vector_index=VectorIndex(dimension=DIM)
+    )
+    keep = library.add_workflow(sample_workflow_json, "", intent=_make_intent("保留")).workflow_id
+    drop = library.add_workflow(sample_workflow_json, "", intent=_make_intent("删除")).workflow_id
+
+    assert library.remove_workflow(drop)
+    assert not library.remove_workflow(drop)
+    assert not os.path.exists(os.path.join(data_path, 'workflows', f'{drop}.json'))
+    assert drop not in library.category_index.get('generation', [])
+
+    reloaded = WorkflowLibrary(data_path=data_path, vector_index=VectorIndex(dimension=DIM))
+    assert set(reloaded.workflows) == {keep}
+    assert set(reloaded.vector_index.workflow_to_id) == {keep}
+
+
+def test_update_intent_reembeds_only_changed_entry(tmp_path, embedding_llm, sample_workflow_json):
+    """更新描述时只重新生成该工作流的embedding"""
+    library = WorkflowLibrary(
+        data_path=str(tmp_path / 'library'),
+        llm_client=embedding_llm,
+        vector_index=VectorIndex(dimension=DIM)
+    )
+    first = library.add_workflow(sample_workflow_json, "", intent=_make_intent("一")).workflow_id
+    library.add_workflow(sample_workflow_json, "", intent=_make_intent("二"))
+    calls = embedding_llm.embed.call_count
+
+    library.update_intent(first, _make_intent("一", operation="editing"))
+    assert embedding_llm.embed.call_count == calls
+    assert first in library.category_index['editing']
+
+    library.update_intent(first, _make_intent("新描述"))
+    assert embedding_llm.embed.call_count == calls + 1
+    label, _ = library.vector_index.search(library.workflows[first].intent_embedding, 1)[0]
+    assert library.vector_index.get_workflow_id(label) == first
+
+
+def test_update_intent_drops_stale_embedding_when_embed_fails(tmp_path, embedding_llm, sample_workflow_json):
+    """新描述的embedding生成失败时不保留旧向量，重启后也不会恢复"""
+    data_path = str(tmp_path / 'library')
+    library = WorkflowLibrary(data_path=data_path, llm_client=embedding_llm, vector_index=VectorIndex(dimension=DIM))
+    workflow_id = library.add_workflow(sample_workflow_json, "", intent=_make_intent("一")).workflow_id
+
+    embedding_llm.embed.side_effect = lambda text: None
+    entry = library.update_intent(workflow_id, _make_intent("新描述"))
+
+    assert entry.intent_embedding is None and entry.embedding_row is None
+    assert workflow_id not in library.vector_index.workflow_to_id
+    reloaded = WorkflowLibrary(data_path=data_path)
+    assert reloaded.workflows[workflow_id].intent_embedding is None
+
+
+def test_candidate_ids_for_need_filters_by_output_modality(tmp_path, embedding_llm, sample_workflow_json):
+    """按需求的输出模态预过滤，库中无该模态时不过滤"""
+    from core.data_structures import AtomicNeed
+
+    library = WorkflowLibrary(
+        data_path=str(tmp_path / 'library'),
+        llm_client=embedding_llm,
+        vector_index=VectorIndex(dimension=DIM)
+    )
+    image_id = library.add_workflow(sample_workflow_json, "", intent=_make_intent(modality="image")).workflow_id
+    video_id = library.add_workflow(sample_workflow_json, "", intent=_make_intent(modality="video")).workflow_id
+
+    def need(modality):
+        return AtomicNeed(need_id="n1", description="需求", category="图生视频", modality=modality)
+
+    assert library.candidate_ids_for_need(need("image->video")) == {video_id}
+    assert library.candidate_ids_for_need(need("Image")) == {image_id}
+    assert library.candidate_ids_for_need(need("text->audio")) is None
+    assert library.filter_workflow_ids(modality="video", operation="editing") == set()
+
+    library.remove_workflow(video_id)
+    assert "video" not in library.modality_index
+
+
+def test_lexical_index_tracks_library(tmp_path, embedding_llm, sample_workflow_json):
+    """词法索引随工作流添加/删除增量更新，包含节点类型"""
+    library = WorkflowLibrary(
+        data_path=str(tmp_path / 'library'),
+        llm_client=embedding_llm,
+        vector_index=VectorIndex(dimension=DIM)
+    )
+    workflow_id = library.add_workflow(sample_workflow_json, "", intent=_make_intent()).workflow_id
+    node_type = next(node['class_type'] for node in sample_workflow_json.values())
+
+    assert library.lexical_index.search(node_type)[0][0] == workflow_id
+
+    library.remove_workflow(workflow_id)
+    assert len(library.lexical_index) == 0
+
+
+def test_add_workflows_embeds_in_one_batch(tmp_path, embedding_llm, sample_workflow_json):
+    """批量入库只调用一次批量embedding"""
+    library = WorkflowLibrary(
+        data_path=str(tmp_path / 'library'),
+        llm_client=embedding_llm,
+        vector_index=VectorIndex(dimension=DIM)
+    )
+    entries = library.add_workflows(
+        [(sample_workflow_json, "", {'source': 'batch'}) for _ in range(3)],
+        auto_annotate=False
+    )
+
+    assert len(entries) == 3
+    assert embedding_llm.embed_batch.call_count == 1
+    assert embedding_llm.embed.call_count == 0
+    assert library.vector_index.index.ntotal == 3
+
+
+def test_add_workflows_isolates_failed_items(tmp_path, embedding_llm, sample_workflow_json):
+    """批量入库中单个工作流失败只跳过该工作流，批量embedding缺失的条目逐个补生成"""
+    library = WorkflowLibrary(
+        data_path=str(tmp_path / 'library'),
+        llm_client=embedding_llm,
+        vector_index=VectorIndex(dimension=DIM)
+    )
+    embedding_llm.embed_batch = Mock(side_effect=lambda texts: [None] + [[1.0] + [0.0] * (DIM - 1)] * (len(texts) - 1))
+    entries = library.add_workflows(
+        [
+            (sample_workflow_json, "", {'source': 'batch'}),
+            (sample_workflow_json, "", {'source': 'batch', 'complexity': 'not-a-complexity'}),
+            (sample_workflow_json, "", {'source': 'batch'}),
+        ],
+        auto_annotate=False
+    )
+
+    assert len(entries) == 2
+    assert embedding_llm.embed.call_count == 1
+    assert all(entry.intent_embedding is not None for entry in entries)
+    assert library.vector_index.index.ntotal == 2
+
+
+def test_sqlite_storage_round_trip(tmp_path, embedding_llm, sample_workflow_json, sample_workflow_code):
+    """sqlite存储下工作流写入library.sqlite，重启后原样加载，删除同步生效"""
+    data_path = str(tmp_path / 'library')
+    library = WorkflowLibrary(data_path=data_path, llm_client=embedding_llm, storage='sqlite')
+    kept = library.add_workflow(sample_workflow_json, sample_workflow_code, intent=_make_intent("保留"),
+                                metadata={'tags': ['flux'], 'source': 'test'})
+    removed = library.add_workflow(sample_workflow_json, "", intent=_make_intent("删除"))
+    library.remove_workflow(removed.workflow_id)
+
+    assert os.listdir(os.path.join(data_path, 'metadata')) == []
+    assert os.path.exists(os.path.join(data_path, 'library.sqlite'))
+
+    reloaded = WorkflowLibrary(data_path=data_path, storage='sqlite')
+    assert list(reloaded.workflows) == [kept.workflow_id]
+    entry = reloaded.workflows[kept.workflow_id]
+    assert entry.workflow_json == sample_workflow_json
+    assert entry.workflow_code == sample_workflow_code
+    assert entry.intent == kept.intent
+    assert entry.tags == ['flux'] and entry.source == 'test'
+    assert np.array_equal(entry.intent_embedding, kept.intent_embedding)
+    assert reloaded.search_by_tags(['flux'])[0].workflow_id == kept.workflow_id
+
+
+def test_sqlite_storage_imports_legacy_files(tmp_path, embedding_llm, sample_workflow_json):
+    """首次以sqlite存储启动时自动导入旧的逐工作流文件"""
+    data_path = str(tmp_path / 'library')
+    legacy = WorkflowLibrary(data_path=data_path, llm_client=embedding_llm)
+    ids = {legacy.add_workflow(sample_workflow_json, "", intent=_make_intent(f"工作流{i}")).workflow_id for i in range(3)}
+
+    library = WorkflowLibrary(data_path=data_path, storage='sqlite')
+    assert set(library.workflows) == ids
+    assert len(library.store) == 3
+
+    with pytest.raises(ValueError):
+        WorkflowLibrary(data_path=data_path, storage='parquet')
+
+
+def test_lazy_load_reads_bodies_on_access(tmp_path, embedding_llm, sample_workflow_json, sample_workflow_code):
+    """按需加载时启动不读取工作流JSON和代码，首次访问时读取并保留在LRU中"""
+    data_path = str(tmp_path / 'library')
+    library = WorkflowLibrary(data_path=data_path, llm_client=embedding_llm, storage='sqlite')
+    ids = [library.add_workflow(sample_workflow_json, sample_workflow_code, intent=_make_intent(f"工作流{i}")).workflow_id
+           for i in range(3)]
+    eager = WorkflowLibrary(data_path=data_path, storage='sqlite')
+
+    lazy = WorkflowLibrary(data_path=data_path, storage='sqlite', lazy_load=True, body_cache_size=2)
+    assert len(lazy.store._bodies) == 0
+    node_type = next(node['class_type'] for node in sample_workflow_json.values())
+    assert {doc_id for doc_id, _ in lazy.lexical_index.search(node_type)} == set(ids)
+    assert len(lazy.store._bodies) == 0
+
+    for workflow_id in ids:
+        entry = lazy.workflows[workflow_id]
+        assert entry.workflow_json == sample_workflow_json
+        assert entry.workflow_code == sample_workflow_code
+        assert np.array_equal(entry.intent_embedding, eager.workflows[workflow_id].intent_embedding)
+    assert list(lazy.store._bodies) == ids[1:]
+
+    # 片段指纹不依赖是否按需加载
+    fragment_store = FragmentStore(str(tmp_path / 'fragments'))
+    assert fragment_store._fingerprint(lazy.workflows[ids[0]]) == fragment_store._fingerprint(eager.workflows[ids[0]])
+
+
+def test_library_store_migrates_code_column(tmp_path, embedding_llm, sample_workflow_json, sample_workflow_code):
+    """旧版library.sqlite（代码在元数据JSON中）打开时迁移到workflow_code列"""
+    import json
+    import sqlite3
+    from core.library_store import entry_metadata
+
+    data_path = str(tmp_path / 'library')
+    entry = WorkflowLibrary(data_path=data_path, llm_client=embedding_llm).add_workflow(
+        sample_workflow_json, sample_workflow_code, intent=_make_intent())
+    metadata = entry_metadata(entry)
+    metadata.pop('intent_embedding')
+    conn = sqlite3.connect(os.path.join(data_path, 'library.sqlite'))
+    conn.execute('CREATE TABLE workflows (workflow_id TEXT PRIMARY KEY, metadata TEXT NOT NULL, '
+                 'workflow_json TEXT NOT NULL, intent_embedding BLOB)')
+    conn.execute('INSERT INTO workflows VALUES (?, ?, ?, NULL)',
+                 (entry.workflow_id, json.dumps(metadata), json.dumps(sample_workflow_json)))
+    conn.commit()
+    conn.close()
+
+    library = WorkflowLibrary(data_path=data_path, storage='sqlite', lazy_load=True)
+    migrated = library.workflows[entry.workflow_id]
+    assert migrated.code_hash is not None and migrated.node_types
+    assert migrated.workflow_code == sample_workflow_code
+    assert migrated.workflow_json == sample_workflow_json
+
+
+def test_embeddings_live_in_shared_matrix(tmp_path, embedding_llm, sample_workflow_json):
+    """embedding只保存在embedding矩阵中，条目持有行视图，删除留下的空行由离线压缩回收"""
+    data_path = str(tmp_path / 'library')
+    library = WorkflowLibrary(data_path=data_path, llm_client=embedding_llm)
+    first = library.add_workflow(sample_workflow_json, "", intent=_make_intent("第一个"))
+    second = library.add_workflow(sample_workflow_json, "", intent=_make_intent("第二个"))
+
+    assert (first.embedding_row, second.embedding_row) == (0, 1)
+    assert isinstance(first.intent_embedding, np.ndarray) and not first.intent_embedding.flags.writeable
+    meta_path = os.path.join(data_path, 'metadata', f'{first.workflow_id}.meta.json')
+    with open(meta_path, encoding='utf-8') as f:
+        assert json.load(f)['intent_embedding'] is None
+
+    # 描述变化时原地覆盖同一行
+    library.update_intent(first.workflow_id, _make_intent("第一个（修改）"))
+    assert first.embedding_row == 0
+    assert np.argmax(first.intent_embedding) == 2
+
+    library.remove_workflow(first.workflow_id)
+    reloaded = WorkflowLibrary(data_path=data_path, llm_client=embedding_llm)
+    assert np.array_equal(reloaded.workflows[second.workflow_id].intent_embedding, second.intent_embedding)
+    # 空行不复用：其他进程可能仍持有该行号
+    third = reloaded.add_workflow(sample_workflow_json, "", intent=_make_intent("第三个"))
+    assert third.embedding_row == 2
+
+    assert reloaded.compact_embeddings() == 1
+    assert (reloaded.workflows[second.workflow_id].embedding_row, third.embedding_row) == (0, 1)
+    compacted = WorkflowLibrary(data_path=data_path, llm_client=embedding_llm)
+    assert len(compacted.embeddings) == 2
+    for entry in (second, third):
+        assert np.array_equal(compacted.workflows[entry.workflow_id].intent_embedding, entry.intent_embedding)
+
+
+def test_inline_embeddings_migrate_to_matrix(tmp_path, embedding_llm, sample_workflow_json):
+    """旧版元数据中内联的embedding列表在启动时迁移到embedding矩阵"""
+    data_path = str(tmp_path / 'library')
+    entry = WorkflowLibrary(data_path=data_path, llm_client=embedding_llm).add_workflow(
+        sample_workflow_json, "", intent=_make_intent())
+    embedding = entry.intent_embedding.tolist()
+    meta_path = os.path.join(data_path, 'metadata', f'{entry.workflow_id}.meta.json')
+    with open(meta_path, encoding='utf-8') as f:
+        metadata = json.load(f)
+    metadata.pop('embedding_row')
+    metadata['intent_embedding'] = embedding
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+    os.remove(os.path.join(data_path, 'intent_embeddings.f32'))
+
+    library = WorkflowLibrary(data_path=data_path, storage='sqlite')
+    migrated = library.workflows[entry.workflow_id]
+    assert migrated.embedding_row == 0
+    assert np.allclose(migrated.intent_embedding, embedding)
+
+    reloaded = WorkflowLibrary(data_path=data_path, storage='sqlite')
+    assert reloaded.workflows[entry.workflow_id].embedding_row == 0
+    assert len(reloaded.embeddings) == 1